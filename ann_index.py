@@ -0,0 +1,223 @@
+import os
+import numpy as np
+from retrieval import top_k_indices
+
+ANN_INDEX_FILE = "ivf_index.npz"  # файл индекса в каталоге базы знаний
+ANN_FORMAT_VERSION = 1
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Нормирует строки матрицы (нулевые строки остаются нулевыми)."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, metric: str, block: int = 65536) -> np.ndarray:
+    """Номер ближайшего центроида для каждого вектора (по блокам, чтобы не строить матрицу n x k целиком)."""
+    labels = np.empty(len(vectors), dtype=np.int32)
+    centroid_sq = (centroids * centroids).sum(axis=1) if metric == "l2" else None
+    for start in range(0, len(vectors), block):
+        products = np.asarray(vectors[start:start + block], dtype=np.float32) @ centroids.T
+        if metric == "l2":
+            # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, ||x||^2 на выбор не влияет
+            labels[start:start + block] = np.argmin(centroid_sq - 2 * products, axis=1)
+        else:
+            labels[start:start + block] = np.argmax(products, axis=1)
+    return labels
+
+
+def kmeans(
+    vectors: np.ndarray, # обучающая выборка (n, dim)
+    k: int, # число кластеров
+    n_iter: int = 20, # число итераций Ллойда
+    metric: str = "cosine", # "cosine" - сферический k-means, "l2" - обычный
+    seed: int = 0,
+) -> np.ndarray:
+    """Обучает центроиды k-means на numpy, возвращает матрицу (k, dim)."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(vectors, centroids, metric)
+        # Суммы по кластерам через сортировку и reduceat (np.add.at на порядок медленнее)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        present = counts > 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[present]
+        sums[present] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = counts == 0
+        # Пустые кластеры пересеиваем случайными точками выборки
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if metric == "cosine":
+            centroids = _normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Приближенный поиск ближайших соседей: инвертированные списки (IVF) поверх k-means.
+
+    Векторы разбиваются на n_lists кластеров; запрос сравнивается только с векторами
+    из nprobe ближайших кластеров. Опционально остатки векторов относительно центроида
+    сжимаются произведением квантователей (PQ): pq_m подвекторов по 1 байту, схожесть
+    считается по таблицам (ADC), а лучшие кандидаты при наличии исходной матрицы
+    пересчитываются точно.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray, # центроиды кластеров (n_lists, dim)
+        list_offsets: np.ndarray, # границы списков в list_ids (n_lists + 1)
+        list_ids: np.ndarray, # номера векторов, упорядоченные по спискам
+        codebooks: np.ndarray | None = None, # кодовые книги PQ (pq_m, 256, dim / pq_m)
+        codes: np.ndarray | None = None, # коды PQ в порядке list_ids (n, pq_m) uint8
+        fingerprint: str | None = None, # отпечаток базы знаний, по которой построен индекс
+    ):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.fingerprint = fingerprint
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def uses_pq(self) -> bool:
+        return self.codebooks is not None
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray, # матрица эмбедингов (n, dim)
+        n_lists: int | None = None, # число кластеров, по умолчанию ~sqrt(n)
+        pq_m: int | None = None, # число подвекторов PQ, None - без сжатия
+        n_iter: int = 20, # итерации k-means
+        train_size: int | None = None, # размер обучающей выборки, по умолчанию 64 точки на кластер
+        fingerprint: str | None = None,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Строит индекс по матрице эмбедингов."""
+        n, dim = embeddings.shape
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+        if train_size is None:
+            train_size = 64 * n_lists
+        train_ids = np.sort(rng.choice(n, size=min(n, train_size), replace=False))
+        train = _normalize_rows(np.asarray(embeddings[train_ids], dtype=np.float32))
+
+        centroids = kmeans(train, n_lists, n_iter=n_iter, metric="cosine", seed=seed)
+        labels = np.concatenate([
+            _assign(_normalize_rows(np.asarray(embeddings[start:start + 65536], dtype=np.float32)), centroids, "cosine")
+            for start in range(0, n, 65536)
+        ])
+        list_ids = np.argsort(labels, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=n_lists), out=list_offsets[1:])
+
+        codebooks = codes = None
+        if pq_m:
+            if dim % pq_m:
+                raise ValueError(f"Размерность {dim} не делится на число подвекторов PQ {pq_m}")
+            sub_dim = dim // pq_m
+            # Квантуем остатки относительно центроида своего кластера - они мельче самих векторов
+            train_residuals = train - centroids[_assign(train, centroids, "cosine")]
+            codebooks = np.stack([
+                kmeans(train_residuals[:, j * sub_dim:(j + 1) * sub_dim], 256, n_iter=n_iter, metric="l2", seed=seed + j)
+                for j in range(pq_m)
+            ])
+            codes = np.empty((n, pq_m), dtype=np.uint8)
+            sorted_labels = labels[list_ids]
+            for start in range(0, n, 65536):
+                block = _normalize_rows(np.asarray(embeddings[list_ids[start:start + 65536]], dtype=np.float32))
+                block -= centroids[sorted_labels[start:start + 65536]]
+                for j in range(pq_m):
+                    codes[start:start + len(block), j] = _assign(block[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j], "l2")
+
+        return cls(centroids, list_offsets, list_ids, codebooks, codes, fingerprint)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Позиции (в порядке list_ids), номера векторов и схожесть запроса с центроидом их списка
+        для nprobe ближайших списков."""
+        centroid_scores = self.centroids @ query
+        probe = top_k_indices(centroid_scores, min(nprobe, self.n_lists))
+        sizes = self.list_offsets[probe + 1] - self.list_offsets[probe]
+        positions = np.concatenate([np.empty(0, dtype=np.int64)] + [
+            np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probe
+        ])
+        return positions, self.list_ids[positions], np.repeat(centroid_scores[probe], sizes)
+
+    def search(
+        self,
+        query_embedding, # эмбединг запроса
+        top_n: int = 100, # число результатов
+        nprobe: int = 8, # число просматриваемых списков: больше - точнее и медленнее
+        embeddings: np.ndarray | None = None, # нормированная матрица базы для точного пересчета
+        rerank: int = 4, # во сколько раз больше кандидатов PQ пересчитывать точно
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Возвращает номера и схожести top_n приближенно ближайших векторов."""
+        query = _normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        positions, ids, coarse_scores = self.candidates(query, nprobe)
+        if len(ids) == 0:
+            return ids, np.empty(0, dtype=np.float32)
+
+        if self.uses_pq:
+            # ADC: q.x = q.c + q.r, q.r - сумма по кодам из таблиц схожести подвекторов запроса с кодовыми книгами
+            sub_queries = query.reshape(len(self.codebooks), -1)
+            tables = np.einsum("mkd,md->mk", self.codebooks, sub_queries)
+            codes = self.codes[positions]
+            scores = coarse_scores + tables[np.arange(len(self.codebooks)), codes].sum(axis=1)
+            if embeddings is not None and rerank:
+                shortlist = top_k_indices(scores, top_n * rerank)
+                ids = ids[shortlist]
+                scores = np.asarray(embeddings[ids], dtype=np.float32) @ query
+        elif embeddings is not None:
+            scores = np.asarray(embeddings[ids], dtype=np.float32) @ query
+        else:
+            raise ValueError("Для индекса без PQ нужна матрица эмбедингов")
+
+        best = top_k_indices(scores, top_n)
+        return ids[best], scores[best]
+
+    def save(self, path: str) -> None:
+        """Сохраняет индекс в каталог базы знаний."""
+        arrays = {
+            "format_version": np.array(ANN_FORMAT_VERSION),
+            "fingerprint": np.array(self.fingerprint or ""),
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "list_ids": self.list_ids,
+        }
+        if self.uses_pq:
+            arrays["codebooks"] = self.codebooks
+            arrays["codes"] = self.codes
+        index_path = os.path.join(path, ANN_INDEX_FILE)
+        with open(index_path + ".tmp", "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(index_path + ".tmp", index_path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex | None":
+        """Открывает индекс из каталога базы знаний, None - если индекса нет или формат другой."""
+        index_path = os.path.join(path, ANN_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with np.load(index_path, allow_pickle=False) as data:
+            if int(data["format_version"]) != ANN_FORMAT_VERSION:
+                return None
+            return cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["list_ids"],
+                data["codebooks"] if "codebooks" in data else None,
+                data["codes"] if "codes" in data else None,
+                str(data["fingerprint"]) or None,
+            )
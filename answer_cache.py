@@ -0,0 +1,215 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+DEFAULT_TTL = 24 * 60 * 60  # время жизни записи, с
+DEFAULT_MAX_ENTRIES = 10_000  # записей на каждом уровне кэша
+
+
+def normalize_query(query: str) -> str:
+    """Нормализует текст вопроса: регистр, ё, пробелы и концевая пунктуация не влияют на ключ."""
+    query = query.lower().replace("ё", "е")
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip("?!. ")
+
+
+def _digest(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryCache:
+    """LRU-кэш в памяти с ограничением времени жизни записей."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float | None = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Значение по ключу или None (просроченная запись удаляется)."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl is not None and time.time() - item[0] > self.ttl:
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SQLiteCache:
+    """Кэш в таблице SQLite: переживает перезапуск бота. Вытеснение по времени последнего обращения."""
+
+    EVICT_EVERY = 100  # проверять переполнение раз в столько записей
+
+    def __init__(
+        self,
+        path: str, # файл базы SQLite
+        table: str, # имя таблицы (свой уровень кэша - своя таблица)
+        encode=lambda value: value, # преобразование значения в тип, поддерживаемый SQLite
+        decode=lambda value: value, # обратное преобразование
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float | None = DEFAULT_TTL,
+    ):
+        if not table.isidentifier():
+            raise ValueError(f"Недопустимое имя таблицы: {table}")
+        self.table = table
+        self.encode = encode
+        self.decode = decode
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+        )
+        self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return self.decode(row[0])
+
+    def set(self, key: str, value) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, self.encode(value), now, now),
+            )
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """Удаляет просроченные записи и самые давно использованные сверх max_entries."""
+        if self.ttl is not None:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,))
+        self._connection.execute(
+            f"DELETE FROM {self.table} WHERE key IN "
+            f"(SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class QueryCache:
+    """Двухуровневый кэш вопросов.
+
+    Первый уровень: нормализованный вопрос + модель эмбедингов -> эмбединг вопроса.
+    Второй уровень: вопрос + номера найденных частей + модель -> готовый ответ.
+    Ключи второго уровня включают отпечаток базы знаний, поэтому после пересборки
+    базы старые ответы не используются (и сбрасываются при первом обращении с новым
+    отпечатком). Эмбединг вопроса от базы не зависит и переживает пересборку.
+    """
+
+    def __init__(
+        self,
+        path: str | None = None, # файл SQLite; None - кэш только в памяти
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float | None = DEFAULT_TTL,
+    ):
+        if path is None:
+            self.embeddings = MemoryCache(max_entries, ttl)
+            self.answers = MemoryCache(max_entries, ttl)
+        else:
+            self.embeddings = SQLiteCache(
+                path, "query_embeddings",
+                encode=lambda vector: np.asarray(vector, dtype=np.float32).tobytes(),
+                decode=lambda blob: np.frombuffer(blob, dtype=np.float32),
+                max_entries=max_entries, ttl=ttl,
+            )
+            self.answers = SQLiteCache(path, "answers", max_entries=max_entries, ttl=ttl)
+            self._fingerprints = SQLiteCache(path, "kb_fingerprint", max_entries=1, ttl=None)
+        self.path = path
+        self._fingerprint = None
+
+    @staticmethod
+    def embedding_key(query: str, model: str) -> str:
+        return _digest(model, normalize_query(query))
+
+    @staticmethod
+    def answer_key(query: str, chunk_ids, model: str, token_budget: int, fingerprint: str, packing: str = "stop") -> str:
+        # В ответ попадают разные части при разной стратегии упаковки, поэтому она входит в ключ
+        ids = np.asarray(chunk_ids, dtype=np.int64).tobytes()
+        return _digest(fingerprint, model, token_budget, packing, normalize_query(query), ids)
+
+    def get_embedding(self, query: str, model: str) -> np.ndarray | None:
+        return self.embeddings.get(self.embedding_key(query, model))
+
+    def set_embedding(self, query: str, model: str, embedding) -> None:
+        self.embeddings.set(self.embedding_key(query, model), np.asarray(embedding, dtype=np.float32))
+
+    def check_fingerprint(self, fingerprint: str) -> None:
+        """Сбрасывает ответы, если база знаний пересобрана с момента их сохранения."""
+        if fingerprint == self._fingerprint:
+            return
+        stored = self._fingerprints.get("current") if self.path is not None else self._fingerprint
+        if stored is not None and stored != fingerprint:
+            self.answers.clear()
+        if self.path is not None:
+            self._fingerprints.set("current", fingerprint)
+        self._fingerprint = fingerprint
+
+    def get_answer(self, key: str) -> str | None:
+        return self.answers.get(key)
+
+    def set_answer(self, key: str, answer: str) -> None:
+        self.answers.set(key, answer)
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики попаданий и промахов по уровням."""
+        return {
+            "embedding_hits": self.embeddings.hits,
+            "embedding_misses": self.embeddings.misses,
+            "answer_hits": self.answers.hits,
+            "answer_misses": self.answers.misses,
+        }
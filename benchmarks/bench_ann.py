@@ -0,0 +1,81 @@
+"""Отчет recall@k и задержки IVF-индекса (с PQ и без) против точного поиска.
+
+python benchmarks/bench_ann.py [--n 200000] [--dim 256] [--k 10]
+Данные синтетические: смесь гауссовых кластеров, похожая по структуре на эмбединги документации.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import RetrievalEngine  # noqa: E402
+from ann_index import IVFIndex  # noqa: E402
+
+
+def clustered_unit_matrix(n: int, dim: int, n_topics: int, seed: int) -> np.ndarray:
+    """Нормированные векторы: темы -> подтемы -> части, у каждой части есть близкие соседи."""
+    centers_rng = np.random.default_rng(0)  # темы общие для базы и запросов
+    rng = np.random.default_rng(seed)
+    topics = centers_rng.standard_normal((n_topics, dim), dtype=np.float32)
+    subtopics = topics.repeat(20, axis=0) + 0.5 * centers_rng.standard_normal((n_topics * 20, dim), dtype=np.float32)
+    # Разброс внутри подтемы в основном вдоль небольшого подпространства: у реальных эмбедингов
+    # внутренняя размерность низкая, поэтому у каждой части есть заметно более близкие соседи
+    basis = centers_rng.standard_normal((16, dim), dtype=np.float32) / 4
+    matrix = subtopics[rng.integers(0, len(subtopics), size=n)]
+    matrix += rng.standard_normal((n, 16), dtype=np.float32) @ basis
+    matrix += 0.05 * rng.standard_normal((n, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix
+
+
+def recall_and_latency(search, queries: np.ndarray, truth: list[set], k: int) -> tuple[float, float]:
+    """Средний recall@k и задержка одного запроса в мс."""
+    hits = 0
+    start = time.perf_counter()
+    for query, expected in zip(queries, truth):
+        ids, _ = search(query)
+        hits += len(expected.intersection(ids[:k].tolist()))
+    elapsed = (time.perf_counter() - start) / len(queries) * 1000
+    return hits / (k * len(queries)), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--pq-m", type=int, default=32, help="число подвекторов PQ (0 - не строить вариант с PQ)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    n_topics = max(16, args.n // 2000)
+    matrix = clustered_unit_matrix(args.n, args.dim, n_topics, seed=1)
+    queries = clustered_unit_matrix(args.queries, args.dim, n_topics, seed=2)
+    engine = RetrievalEngine(matrix)
+
+    truth = [set(engine.search(q, top_n=args.k)[0].tolist()) for q in queries]
+    _, exact_ms = recall_and_latency(lambda q: engine.search(q, top_n=args.k), queries, truth, args.k)
+    print(f"exact: recall@{args.k}=1.000  {exact_ms:.3f} ms/query")
+
+    variants = [("ivf", None)] + ([("ivf+pq", args.pq_m)] if args.pq_m else [])
+    for name, pq_m in variants:
+        start = time.perf_counter()
+        index = IVFIndex.build(matrix, pq_m=pq_m)
+        build_s = time.perf_counter() - start
+        memory_mb = (matrix.nbytes if pq_m is None else index.codes.nbytes) / 2**20
+        print(f"{name}: n_lists={index.n_lists}, построение {build_s:.1f} s, векторы в памяти {memory_mb:.1f} МБ")
+        for nprobe in args.nprobe:
+            for rerank in ([0, 4] if pq_m else [0]):
+                recall, ms = recall_and_latency(
+                    lambda q: index.search(q, top_n=args.k, nprobe=nprobe, embeddings=matrix, rerank=rerank),
+                    queries, truth, args.k,
+                )
+                suffix = f" rerank={rerank}" if pq_m else ""
+                print(f"  nprobe={nprobe:<3}{suffix}: recall@{args.k}={recall:.3f}  {ms:.3f} ms/query  ({exact_ms / ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Замер пакетирования вопросов: одновременные вопросы по одному запросу эмбедингов против общих пакетов.
+
+python benchmarks/bench_batching.py [--queries 64] [--latency 0.05] [--batch 1 8 32] [--window-ms 5]
+Все вопросы приходят одновременно (как при пике в нескольких чатах), считаем запросы
+к API эмбедингов, общее время поиска и статистику пакетов.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_bot_throughput import prepare_environment  # noqa: E402
+
+
+async def run_queries(search_ask, queries: list[str]) -> tuple[float, dict | None]:
+    kb = search_ask.get_knowledge_base()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(search_ask.retrieve_async(query, kb) for query in queries))
+    elapsed = time.perf_counter() - start
+    assert all(len(indices) for indices, _ in results)
+    return elapsed, search_ask.query_batch_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=64, help="одновременных вопросов")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка эмбедингов заглушки, с")
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 8, 32], help="OZON_BATCH_MAX_QUERIES")
+    parser.add_argument("--window-ms", type=float, default=5.0, help="OZON_BATCH_WINDOW_MS")
+    args = parser.parse_args()
+
+    # Кэш эмбедингов отключаем, чтобы каждый прогон обращался к заглушке
+    os.environ["OZON_CACHE_MAX_ENTRIES"] = "0"
+    server, state = prepare_environment(args.chunks, args.dim, latency=args.latency)
+    import search_ask
+    search_ask.BATCH_WINDOW = args.window_ms / 1000
+
+    print(f"{'batch':>6} {'time, s':>8} {'requests':>9} {'mean size':>10} {'fill':>6} {'queue, ms':>10} {'max, ms':>8}")
+    for batch in args.batch:
+        search_ask.BATCH_MAX_QUERIES = batch
+        queries = [f"Вопрос {i} при пакете {batch}: как получить статистику кампании?" for i in range(args.queries)]
+        state.requests = 0
+        elapsed, stats = asyncio.run(run_queries(search_ask, queries))
+        if stats is None:
+            print(f"{batch:>6} {elapsed:>8.3f} {state.requests:>9}")
+        else:
+            print(f"{batch:>6} {elapsed:>8.3f} {state.requests:>9} {stats['mean_batch_size']:>10.1f} "
+                  f"{stats['mean_fill']:>6.2f} {stats['mean_queue_delay_ms']:>10.2f} {stats['max_queue_delay_ms']:>8.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Нагрузочный тест обработчика сообщений бота против заглушки LLM.
+
+python benchmarks/bench_bot_throughput.py [--chats 1 2 4 8 16 32] [--chat-latency 0.5]
+Каждый «чат» шлет вопросы в telegram_bot.handle_text подряд; считаем ответы в секунду.
+При неблокирующем обработчике пропускная способность растет линейно с числом чатов
+(до предела OZON_MAX_CONCURRENT_QUESTIONS).
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from openai_stub import start_stub  # noqa: E402
+
+
+class FakeMessage:
+    """Минимальная замена aiogram Message: текст, answer() и edit_text().
+
+    Все отправленные и отредактированные сообщения чата попадают в общий список answers,
+    время первого показа текста ответа - в first_text_at.
+    """
+
+    def __init__(self, text: str, answers: list | None = None):
+        self.text = text
+        self.answers = [] if answers is None else answers
+        self.first_text_at = None
+
+    def _shown(self, text: str) -> None:
+        if self.first_text_at is None and not text.startswith("⏳"):
+            self.first_text_at = time.perf_counter()
+
+    async def answer(self, text: str, **kwargs):
+        self.answers.append(text)
+        self._shown(text)
+        reply = FakeMessage(text, self.answers)
+        reply.first_text_at = self.first_text_at
+        reply._origin = self
+        return reply
+
+    async def edit_text(self, text: str, **kwargs):
+        self.answers.append(text)
+        origin = getattr(self, "_origin", self)
+        origin._shown(text)
+        return self
+
+
+def prepare_environment(chunks: int, dim: int, **stub_settings):
+    """Запускает заглушку, собирает синтетическую базу знаний и настраивает переменные среды."""
+    server, state, base_url = start_stub(dim=dim, **stub_settings)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:stub")
+
+    from knowledge_base import KnowledgeBase
+    kb_path = tempfile.mkdtemp(prefix="kb_")
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((chunks, dim), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    texts = [f"Метод /v1/method/{i}: описание параметров и ответа. " * 10 for i in range(chunks)]
+    KnowledgeBase(texts, embeddings, embedding_model="text-embedding-ada-002").save(kb_path)
+    os.environ["OZON_KB_PATH"] = kb_path
+    return server, state
+
+
+def use_offline_tokenizer_if_needed():
+    """Без сети tiktoken не скачает словарь - тогда считаем токены приближенно (4 символа на токен)."""
+    import search_ask
+    try:
+        search_ask.num_tokens("проверка")
+    except Exception:
+        print("tiktoken недоступен офлайн: число токенов оценивается по длине строки")
+        search_ask.num_tokens = lambda text, model=None: len(text) // 4 + 1
+
+
+async def run_chats(handle_text, chats: int, questions_per_chat: int) -> tuple[float, float, float]:
+    """Запускает chats параллельных чатов.
+
+    Возвращает число ответов в секунду, среднее время до первого показанного текста ответа
+    и среднее время до полного ответа (в секундах).
+    """
+    first_text, complete = [], []
+
+    async def chat(index: int):
+        for i in range(questions_per_chat):
+            message = FakeMessage(f"Вопрос {i} из чата {index}: какой метод получает информацию о товарах?")
+            start = time.perf_counter()
+            await handle_text(message)
+            complete.append(time.perf_counter() - start)
+            first_text.append(message.first_text_at - start)
+            assert message.answers and not message.answers[-1].startswith("Произошла ошибка"), message.answers
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(index) for index in range(chats)))
+    throughput = chats * questions_per_chat / (time.perf_counter() - start)
+    return throughput, sum(first_text) / len(first_text), sum(complete) / len(complete)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--questions", type=int, default=3, help="вопросов на чат")
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка эмбедингов заглушки, с")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="задержка ответа LLM заглушки, с")
+    parser.add_argument("--answer-words", type=int, default=50, help="длина ответа LLM заглушки в словах")
+    parser.add_argument("--stream-delay", type=float, default=0.02, help="пауза между словами потокового ответа, с")
+    parser.add_argument("--no-stream", action="store_true", help="отвечать целиком, без потоковой выдачи")
+    args = parser.parse_args()
+
+    os.environ["OZON_STREAM_ANSWERS"] = "0" if args.no_stream else "1"
+    os.environ["OZON_EDIT_INTERVAL"] = "0.2"
+    # Каждый вопрос уникален, но кэш ответов все равно отключаем размером, чтобы мерить полный путь
+    os.environ["OZON_CACHE_MAX_ENTRIES"] = "0"
+    server, _ = prepare_environment(args.chunks, args.dim, latency=args.latency, chat_latency=args.chat_latency,
+                                    answer_words=args.answer_words, stream_delay=args.stream_delay)
+    use_offline_tokenizer_if_needed()
+    import search_ask
+    search_ask.MAX_CONCURRENT_QUESTIONS = max(args.chats)
+    from telegram_bot import handle_text
+
+    print(f"{'chats':>6} {'answers/s':>10} {'per chat':>9} {'first text, s':>14} {'complete, s':>12}")
+    for chats in args.chats:
+        throughput, first_text, complete = asyncio.run(run_chats(handle_text, chats, args.questions))
+        print(f"{chats:>6} {throughput:>10.2f} {throughput / chats:>9.2f} {first_text:>14.2f} {complete:>12.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
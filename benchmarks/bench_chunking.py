@@ -0,0 +1,126 @@
+"""Замер разбиения секций документации на части: старый рекурсивный путь против split_strings_from_subsection.
+
+python benchmarks/bench_chunking.py [--doc "ozon docs/performance.html"] [--max-tokens 1600] [--overlap 0]
+Без сети tiktoken не скачает словарь - тогда токены считаются регулярным выражением
+(абсолютные времена другие, соотношение путей сохраняется).
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+import tokenizer  # noqa: E402
+import make_embeding_from_docs as docs  # noqa: E402
+
+legacy_encoding_for_model = docs.tiktoken.encoding_for_model
+
+
+class RegexEncoding:
+    """Замена кодировки tiktoken без сети: токен - до 4 букв, знак или пробелы."""
+
+    pattern = re.compile(r"\w{1,4}|[^\w\s]|\s+")
+
+    def encode(self, text: str) -> list[str]:
+        return self.pattern.findall(text)
+
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+    def decode_tokens_bytes(self, tokens: list[str]) -> list[bytes]:
+        return [token.encode("utf-8") for token in tokens]
+
+
+def use_offline_tokenizer_if_needed():
+    """Подменяет кодировку на регулярное выражение, если словарь tiktoken недоступен."""
+    try:
+        docs.num_tokens("проверка")
+    except Exception:
+        print("tiktoken недоступен офлайн: токены считаются регулярным выражением")
+        global legacy_encoding_for_model
+        encoding = RegexEncoding()
+        tokenizer.get_encoding = docs.get_encoding = legacy_encoding_for_model = lambda model=None: encoding
+
+
+def legacy_num_tokens(text: str, model: str) -> int:
+    # Как раньше: кодировка запрашивается на каждый вызов
+    return len(legacy_encoding_for_model(model).encode(text))
+
+
+def legacy_halved(string: str, delimiter: str, model: str) -> list[str]:
+    """Старый halved_by_delimiter: токенизация каждого префикса заново."""
+    chunks = string.split(delimiter)
+    if len(chunks) == 1:
+        return [string, ""]
+    elif len(chunks) == 2:
+        return chunks
+    halfway = legacy_num_tokens(string, model) // 2
+    best_diff = halfway
+    for i, chunk in enumerate(chunks):
+        diff = abs(halfway - legacy_num_tokens(delimiter.join(chunks[: i + 1]), model))
+        if diff >= best_diff:
+            break
+        best_diff = diff
+    return [delimiter.join(chunks[:i]), delimiter.join(chunks[i:])]
+
+
+def legacy_split(subsection, max_tokens: int, model: str, max_recursion: int) -> list[str]:
+    """Старый split_strings_from_subsection: рекурсия с повторной токенизацией каждой половины."""
+    titles, text = subsection
+    string = "\n\n".join(titles + [text])
+    if legacy_num_tokens(string, model) <= max_tokens:
+        return [string]
+    elif max_recursion == 0:
+        return [docs.truncated_string(string, model=model, max_tokens=max_tokens, print_warning=False)]
+    for delimiter in ["\n\n", "\n", ". "]:
+        left, right = legacy_halved(text, delimiter, model)
+        if left == "" or right == "":
+            continue
+        results = []
+        for half in [left, right]:
+            results.extend(legacy_split((titles, half), max_tokens, model, max_recursion - 1))
+        return results
+    return [docs.truncated_string(string, model=model, max_tokens=max_tokens, print_warning=False)]
+
+
+def chunk_stats(strings: list[str]) -> str:
+    tokens = np.array([docs.num_tokens(string) for string in strings])
+    return f"частей {len(strings)}, токенов max {tokens.max()}, среднее {tokens.mean():.0f}, разброс {tokens.std():.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--doc", default=os.path.join(ROOT, "ozon docs", "performance.html"))
+    parser.add_argument("--max-tokens", type=int, default=1600)
+    parser.add_argument("--overlap", type=int, default=0, help="перекрытие частей для нового пути, токенов")
+    parser.add_argument("--repeat", type=int, default=1, help="во сколько раз удлинить текст секций")
+    args = parser.parse_args()
+    use_offline_tokenizer_if_needed()
+
+    with open(args.doc, "r", encoding="utf-8") as file:
+        html = file.read()
+    sections = [docs.clean_section(section) for section in docs.all_section_with_text(html, "Ozon Performance API")]
+    sections = [section for section in sections if docs.keep_section(section)]
+    sections = [(titles, "\n\n".join([text] * args.repeat)) for titles, text in sections]
+    model = docs.GPT_MODEL
+    print(f"секций {len(sections)}, самая длинная {max(len(text) for _, text in sections)} символов")
+
+    start = time.perf_counter()
+    legacy = [string for section in sections for string in legacy_split(section, args.max_tokens, model, 10)]
+    legacy_s = time.perf_counter() - start
+    start = time.perf_counter()
+    strings = [string for section in sections for string in docs.split_strings_from_subsection(
+        section, max_tokens=args.max_tokens, max_recursion=10, overlap_tokens=args.overlap)]
+    new_s = time.perf_counter() - start
+
+    print(f"старый путь: {legacy_s:8.3f} s, {chunk_stats(legacy)}")
+    print(f" новый путь: {new_s:8.3f} s, {chunk_stats(strings)}")
+    print(f"ускорение x{legacy_s / new_s:.1f}, совпадающих частей {len(set(legacy) & set(strings))} из {len(legacy)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Проверка и замер конвейера эмбедингов против локальной заглушки API.
+
+python benchmarks/bench_ingest.py [--chunks 3000] [--latency 0.05] [--fail-rate 0.1]
+Сравнивает старый путь (по одной части за запрос, последовательно) с пакетным
+параллельным и проверяет продолжение прерванного запуска с контрольной точки.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from openai import OpenAI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embedding_pipeline import embed_texts, vectors_by_key, reindex_stats  # noqa: E402
+from knowledge_base import KnowledgeBase  # noqa: E402
+from openai_stub import start_stub  # noqa: E402
+
+MODEL = "text-embedding-ada-002"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа заглушки, с")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="доля ответов 429")
+    parser.add_argument("--legacy-chunks", type=int, default=200, help="сколько частей прогнать старым путем")
+    args = parser.parse_args()
+
+    server, state, base_url = start_stub(dim=256, latency=args.latency, fail_rate=args.fail_rate, retry_after=0.05)
+    client = OpenAI(api_key="stub", base_url=base_url)
+    texts = [f"Часть документации номер {i}. " * 20 for i in range(args.chunks)]
+
+    # Старый путь: одна часть на запрос, последовательно (get_embedding + progress_apply).
+    # Без отказов: в старом пути любая ошибка теряет весь прогон
+    state.fail_rate = 0
+    start = time.perf_counter()
+    for text in texts[:args.legacy_chunks]:
+        client.embeddings.create(input=[text], model=MODEL)
+    legacy_s = (time.perf_counter() - start) / args.legacy_chunks * args.chunks
+    print(f"по одной части: ~{legacy_s:.1f} s на {args.chunks} частей (оценка по {args.legacy_chunks})")
+
+    state.fail_rate = args.fail_rate
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoint = os.path.join(folder, "checkpoint")
+        state.requests = state.failures = 0
+        start = time.perf_counter()
+        vectors = embed_texts(texts, client, MODEL, checkpoint_path=checkpoint, max_batch_items=64, progress=False)
+        elapsed = time.perf_counter() - start
+        print(f"пакетами: {elapsed:.2f} s, запросов {state.requests}, из них 429: {state.failures}, форма {vectors.shape}")
+
+        # Повторный запуск с той же контрольной точкой не должен обращаться к API
+        state.requests = 0
+        again = embed_texts(texts, client, MODEL, checkpoint_path=checkpoint, progress=False)
+        print(f"повторный запуск: запросов {state.requests}, совпадает: {np.array_equal(vectors, again)}")
+
+        # Обрыв: оставляем в контрольной точке половину ключей и проверяем продолжение
+        with open(checkpoint + ".keys", "r", encoding="utf-8") as file:
+            lines = file.readlines()
+        with open(checkpoint + ".keys", "w", encoding="utf-8") as file:
+            file.writelines(lines[:1 + args.chunks // 2])
+        state.requests = state.inputs = 0
+        resumed = embed_texts(texts, client, MODEL, checkpoint_path=checkpoint, max_batch_items=64, progress=False)
+        print(f"продолжение после обрыва: досчитано частей {state.inputs}, совпадает: {np.array_equal(vectors, resumed)}")
+
+        # Инкрементальная пересборка: 1% частей изменен, 1% удален, 1% добавлен
+        kb_path = os.path.join(folder, "kb")
+        KnowledgeBase(texts, vectors, embedding_model=MODEL).save(kb_path)
+        step = 100
+        revised = [text + " (изменено)" if i % step == 0 else text for i, text in enumerate(texts) if i % step != 1]
+        revised += [f"Новый метод {i}" for i in range(args.chunks // step)]
+        known = vectors_by_key(KnowledgeBase.load(kb_path), MODEL)
+        state.requests = state.inputs = 0
+        start = time.perf_counter()
+        embed_texts(revised, client, MODEL, known=known, progress=False)
+        elapsed = time.perf_counter() - start
+        print(f"инкрементальная пересборка: {reindex_stats(known, revised, MODEL)}, "
+              f"отправлено частей {state.inputs}, запросов {state.requests}, {elapsed:.2f} s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
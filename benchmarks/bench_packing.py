@@ -0,0 +1,78 @@
+"""Замер сборки сообщения для GPT: старый квадратичный цикл query_message против build_message.
+
+python benchmarks/bench_packing.py [--budget 3596] [--chunks 100]
+Без сети tiktoken не скачает словарь - тогда токены считаются регулярным выражением
+(абсолютные времена другие, соотношение путей сохраняется).
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+import search_ask  # noqa: E402
+from search_ask import build_message, INSTRUCTION, ARTICLE_PREFIX, ARTICLE_SUFFIX  # noqa: E402
+
+
+def use_offline_tokenizer_if_needed():
+    """Подменяет num_tokens на подсчет регулярным выражением, если словарь tiktoken недоступен."""
+    try:
+        search_ask.num_tokens("проверка")
+    except Exception:
+        print("tiktoken недоступен офлайн: токены считаются регулярным выражением")
+        pattern = re.compile(r"\w{1,4}|[^\w\s]|\s+")
+        search_ask.num_tokens = lambda text, model=None: len(pattern.findall(text))
+
+
+def legacy_message(query: str, strings: list[str], model: str, token_budget: int) -> str:
+    """Старый цикл: пересчет токенов всего растущего сообщения для каждой части."""
+    message = INSTRUCTION
+    question = f"\n\nQuestion: {query}"
+    for string in strings:
+        next_article = ARTICLE_PREFIX + string + ARTICLE_SUFFIX
+        if search_ask.num_tokens(message + next_article + question, model=model) > token_budget:
+            break
+        message += next_article
+    return message + question
+
+
+def timed(fn, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=int, default=4096 - 500)
+    parser.add_argument("--chunks", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    use_offline_tokenizer_if_needed()
+
+    rng = np.random.default_rng(0)
+    # Части разной длины, как после разбиения документации: от пары абзацев до ~1600 токенов
+    sizes = np.where(rng.random(args.chunks) < 0.2, rng.integers(150, 250, args.chunks), rng.integers(5, 40, args.chunks))
+    strings = [" ".join(f"поле{j} описание параметра /v1/product/info" for j in range(size)) for size in sizes]
+    token_counts = [search_ask.num_tokens(string) for string in strings]
+    query = "Какой метод получает информацию о товарах?"
+    model = search_ask.GPT_MODEL
+
+    cases = [
+        ("старый цикл", lambda: legacy_message(query, strings, model, args.budget)),
+        ("build_message", lambda: build_message(query, strings, model, args.budget, packing="stop")),
+        ("build_message + счетчики из базы", lambda: build_message(query, strings, model, args.budget, token_counts=token_counts, packing="stop")),
+        ("build_message skip + счетчики", lambda: build_message(query, strings, model, args.budget, token_counts=token_counts, packing="skip")),
+    ]
+    for name, fn in cases:
+        message = fn()
+        print(f"{name:>34}: {timed(fn, args.repeats):8.3f} ms, частей в сообщении {message.count(ARTICLE_PREFIX)}, "
+              f"токенов {search_ask.num_tokens(message)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Замер задержки поиска на синтетической базе знаний: 10k, 100k и 1M частей.
+
+python benchmarks/bench_retrieval.py [--dim 1536] [--sizes 10000 100000 1000000]
+Для 1M частей с dim=1536 нужно ~6 ГБ памяти; на слабой машине уменьшите --dim.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import spatial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import RetrievalEngine  # noqa: E402
+
+
+def random_unit_matrix(n: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    """Случайная матрица (n, dim) float32 с единичными строками, как у эмбедингов OpenAI."""
+    matrix = np.empty((n, dim), dtype=np.float32)
+    block = 65536
+    for start in range(0, n, block):
+        rows = rng.standard_normal((min(block, n - start), dim), dtype=np.float32)
+        rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+        matrix[start:start + len(rows)] = rows
+    return matrix
+
+
+def legacy_search(query: np.ndarray, matrix: np.ndarray, top_n: int):
+    """Старый путь: схожесть построчно через scipy и полная сортировка списка."""
+    pairs = [(i, 1 - spatial.distance.cosine(query, row)) for i, row in enumerate(matrix)]
+    pairs.sort(key=lambda x: x[1], reverse=True)
+    return pairs[:top_n]
+
+
+def timed(fn, repeats: int) -> float:
+    """Среднее время одного вызова fn в миллисекундах."""
+    fn()  # прогрев
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--top-n", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=32, help="размер пачки запросов для search_batch")
+    parser.add_argument("--legacy-limit", type=int, default=10_000, help="старый путь замеряется только до этого размера")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>10} {'legacy, ms':>12} {'search, ms':>12} {'batch/query, ms':>16}")
+    for n in args.sizes:
+        matrix = random_unit_matrix(n, args.dim, rng)
+        engine = RetrievalEngine(matrix)
+        queries = random_unit_matrix(args.batch, args.dim, rng)
+        repeats = max(3, 200_000 // n)
+
+        search_ms = timed(lambda: engine.search(queries[0], top_n=args.top_n), repeats)
+        batch_ms = timed(lambda: engine.search_batch(queries, top_n=args.top_n), max(1, repeats // 4)) / args.batch
+        legacy_ms = timed(lambda: legacy_search(queries[0], matrix, args.top_n), 1) if n <= args.legacy_limit else float("nan")
+        print(f"{n:>10} {legacy_ms:>12.2f} {search_ms:>12.3f} {batch_ms:>16.3f}")
+        del matrix, engine
+
+
+if __name__ == "__main__":
+    main()
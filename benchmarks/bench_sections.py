@@ -0,0 +1,75 @@
+"""Замер выделения секций из HTML: BeautifulSoup + process_element против потокового SectionParser.
+
+python benchmarks/bench_sections.py [--doc "ozon docs/performance.html"] [--copies 4]
+Проверяет совпадение секций, сравнивает время и пик памяти (tracemalloc) на одном файле
+и время разбора нескольких копий файла последовательно и в пуле процессов.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+import make_embeding_from_docs as docs  # noqa: E402
+from html_sections import sections_from_file, extract_sections  # noqa: E402
+
+PREHEADER = "Ozon Performance API"
+
+
+def legacy_sections(path: str, preheader: str) -> list[list]:
+    """Старый путь: файл целиком в память, дерево BeautifulSoup, рекурсивный обход."""
+    with open(path, "r", encoding="utf-8") as file:
+        html = file.read()
+    return docs.all_section_with_text(html, preheader)
+
+
+def measure(fn, *args) -> tuple[list, float, float]:
+    """Результат, время (с) и пик выделенной памяти (МБ)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--doc", default=os.path.join(ROOT, "ozon docs", "performance.html"))
+    parser.add_argument("--copies", type=int, default=4, help="сколько копий файла разбирать в пуле процессов")
+    args = parser.parse_args()
+
+    legacy, legacy_s, legacy_mb = measure(legacy_sections, args.doc, PREHEADER)
+    streamed, streamed_s, streamed_mb = measure(sections_from_file, args.doc, PREHEADER)
+    print(f"файл {os.path.getsize(args.doc) / 2 ** 10:.0f} KB, секций {len(legacy)}, совпадают: {legacy == streamed}")
+    print(f"BeautifulSoup: {legacy_s:6.3f} s, пик памяти {legacy_mb:6.1f} MB")
+    print(f"   потоковый: {streamed_s:6.3f} s, пик памяти {streamed_mb:6.1f} MB")
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i in range(args.copies):
+            paths.append(os.path.join(folder, f"doc{i}.html"))
+            shutil.copy(args.doc, paths[-1])
+        doc_list = [(path, PREHEADER) for path in paths]
+        start = time.perf_counter()
+        for path in paths:
+            legacy_sections(path, PREHEADER)
+        legacy_s = time.perf_counter() - start
+        start = time.perf_counter()
+        sequential = extract_sections(doc_list, max_workers=1)
+        sequential_s = time.perf_counter() - start
+        start = time.perf_counter()
+        pooled = extract_sections(doc_list)
+        pooled_s = time.perf_counter() - start
+        print(f"{args.copies} файла: BeautifulSoup {legacy_s:.3f} s, потоковый {sequential_s:.3f} s, "
+              f"в пуле процессов {pooled_s:.3f} s (ядер {os.cpu_count()}), совпадают: {sequential == pooled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Локальная заглушка OpenAI-совместимого API для замеров и проверки без сети.
+
+python benchmarks/openai_stub.py [--port 8765] [--latency 0.05] [--input-latency 0.001] [--fail-rate 0.1] [--seed 0]
+Затем: OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python ...
+"""
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_embedding(text: str, dim: int) -> list[float]:
+    """Детерминированный нормированный вектор по хэшу текста."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class StubState:
+    """Настройки заглушки и счетчики запросов."""
+
+    def __init__(self, dim: int = 1536, latency: float = 0.0, fail_rate: float = 0.0, retry_after: float = 0.1,
+                 chat_latency: float | None = None, answer_words: int = 8, stream_delay: float = 0.0,
+                 input_latency: float = 0.0, seed: int | None = None):
+        self.dim = dim
+        self.latency = latency  # задержка ответа в секундах
+        self.input_latency = input_latency  # добавка к задержке embeddings за каждый текст пакета, с
+        self.chat_latency = latency if chat_latency is None else chat_latency  # задержка ответа chat/completions
+        self.answer_words = answer_words  # длина ответа chat/completions в словах
+        self.stream_delay = stream_delay  # пауза между частями потокового ответа, с
+        self.fail_rate = fail_rate  # доля запросов, на которые отвечаем 429
+        self.retry_after = retry_after  # значение заголовка Retry-After для 429
+        self.requests = 0
+        self.inputs = 0
+        self.failures = 0
+        self.random = random.Random(seed)  # с заданным seed отказы 429 приходятся на одни и те же запросы
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState
+
+    def log_message(self, format, *args):
+        pass  # без вывода каждого запроса в консоль
+
+    def _send_json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            fail = state.random.random() < state.fail_rate
+            if fail:
+                state.failures += 1
+        inputs = request.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if self.path.endswith("/chat/completions"):
+            latency = state.chat_latency
+        else:
+            latency = state.latency + state.input_latency * len(inputs)
+        if latency:
+            time.sleep(latency)
+        if fail:
+            self._send_json(429, {"error": {"message": "Rate limit (stub)", "type": "rate_limit_exceeded"}},
+                            {"Retry-After": str(state.retry_after)})
+            return
+
+        if self.path.endswith("/embeddings"):
+            with state.lock:
+                state.inputs += len(inputs)
+            data = [{"object": "embedding", "index": i, "embedding": fake_embedding(text, state.dim)}
+                    for i, text in enumerate(inputs)]
+            tokens = sum(len(text) // 4 + 1 for text in inputs)
+            self._send_json(200, {"object": "list", "data": data, "model": request.get("model"),
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+        elif self.path.endswith("/chat/completions"):
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            answer = f"Ответ заглушки на запрос длиной {len(prompt)} символов:" + " слово" * state.answer_words
+            if request.get("stream"):
+                self._send_stream(request, answer)
+                return
+            # Без потока ответ приходит целиком, когда сгенерированы все слова
+            time.sleep(state.stream_delay * len(answer.split(" ")))
+            self._send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                          "total_tokens": (len(prompt) + len(answer)) // 4},
+            })
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+    def _send_stream(self, request: dict, answer: str) -> None:
+        """Потоковый ответ chat/completions (server-sent events) по одному слову."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            delta = {"content": word if i == 0 else " " + word}
+            if i == 0:
+                delta["role"] = "assistant"
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if self.state.stream_delay:
+                time.sleep(self.state.stream_delay)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            # Как у OpenAI: отдельная последняя часть без choices, с числом токенов всего ответа
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model"), "choices": [],
+                     "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                               "total_tokens": (len(prompt) + len(answer)) // 4}}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_stub(port: int = 0, **settings) -> tuple[ThreadingHTTPServer, StubState, str]:
+    """Запускает заглушку в фоновом потоке, возвращает сервер, его состояние и base_url для клиента."""
+    state = StubState(**settings)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--chat-latency", type=float, default=None)
+    parser.add_argument("--input-latency", type=float, default=0.0, help="добавка к задержке embeddings за текст, с")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None, help="зерно для воспроизводимых отказов 429")
+    args = parser.parse_args()
+    server, _, base_url = start_stub(args.port, dim=args.dim, latency=args.latency, fail_rate=args.fail_rate,
+                                     chat_latency=args.chat_latency, input_latency=args.input_latency, seed=args.seed)
+    print(f"Заглушка OpenAI API: {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Сквозной офлайн-замер конвейера против локальной заглушки OpenAI API с результатами в JSON.
+
+python benchmarks/run_suite.py [--scenarios ingest retrieval packing bot] [--chunks 20000] [--ann]
+                               [--output results.json] [--baseline baseline.json] [--tolerance 0.25]
+Сценарии: сборка базы make_embeding_from_docs.main по синтетической документации, поиск
+(полный перебор, пакет запросов, гибридный, по пути метода, IVF), сборка сообщения для GPT
+и пропускная способность обработчика бота. Результаты: {"meta": {...}, "results": {сценарий: {метрика: значение}}}.
+С --baseline метрики сравниваются с прошлым прогоном; ухудшение больше tolerance дает код возврата 1.
+Метрики *_s и *_ms - чем меньше, тем лучше; *_per_s и recall_* - чем больше, тем лучше; остальные справочные.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import argparse
+import tempfile
+import functools
+import subprocess
+from datetime import datetime, timezone
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from openai_stub import start_stub  # noqa: E402
+from synthetic_corpus import (  # noqa: E402
+    write_docs, synthetic_knowledge_base, synthetic_query_embeddings, synthetic_questions,
+)
+
+SCENARIOS = ["ingest", "retrieval", "packing", "bot"]
+
+
+def percentiles_ms(samples: list[float], prefix: str) -> dict[str, float]:
+    """p50 и p95 длительностей (с) в миллисекундах."""
+    p50, p95 = np.percentile(samples, [50, 95]) * 1000
+    return {f"{prefix}_p50_ms": float(p50), f"{prefix}_p95_ms": float(p95)}
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def latencies(fn, calls: list[tuple]) -> list[float]:
+    """Длительности вызовов fn(*args), с. Первый вызов - прогрев (ленивая загрузка индексов), не учитывается."""
+    fn(*calls[0])
+    return [timed(fn, *args) for args in calls]
+
+
+def use_offline_tokenizer_if_needed():
+    """Без сети tiktoken не скачает словарь - тогда и база, и запросы считают токены регулярным выражением."""
+    import tokenizer
+    import search_ask
+    import make_embeding_from_docs as docs
+    try:
+        search_ask.num_tokens("проверка")
+    except Exception:
+        from bench_chunking import RegexEncoding
+        print("tiktoken недоступен офлайн: токены считаются регулярным выражением")
+        encoding = RegexEncoding()
+        tokenizer.get_encoding = search_ask.get_encoding = docs.get_encoding = lambda model=None: encoding
+        return True
+    return False
+
+
+def scenario_ingest(args, state) -> dict:
+    """Полная сборка базы по синтетической документации и повторная сборка без изменений."""
+    import make_embeding_from_docs as docs
+    from knowledge_base import KnowledgeBase, DEFAULT_KB_PATH
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        write_docs(os.path.join(folder, "ozon docs"), args.copies)
+        os.chdir(folder)  # main() читает "ozon docs" и пишет базу относительно текущего каталога
+        try:
+            state.requests = state.inputs = 0
+            build_s = timed(docs.main, build_ann_index=False)
+            requests, inputs = state.requests, state.inputs
+            chunks = len(KnowledgeBase.load(DEFAULT_KB_PATH))
+            state.requests = 0
+            rebuild_s = timed(docs.main, build_ann_index=False)
+        finally:
+            os.chdir(cwd)
+    return {
+        "chunks": chunks,
+        "build_s": build_s,
+        "build_chunks_per_s": chunks / build_s,
+        "embedding_requests": requests,
+        "embedded_chunks": inputs,
+        "rebuild_s": rebuild_s,
+        "rebuild_embedding_requests": state.requests,
+    }
+
+
+def scenario_retrieval(args, kb) -> dict:
+    """Задержка поиска по эмбедингу (один запрос и пакет), гибридного, по пути метода и IVF."""
+    import search_ask
+
+    queries = synthetic_query_embeddings(len(kb), args.queries, kb.dim)
+    questions, path_questions = synthetic_questions(kb, args.queries)
+    results = {"chunks": len(kb), "dim": kb.dim}
+
+    exact = latencies(functools.partial(search_ask.ranked_indices, search_mode="exact"), [(query, kb) for query in queries])
+    results.update(percentiles_ms(exact, "exact"))
+    batch = 32
+    batched = latencies(functools.partial(search_ask.ranked_indices_batch, search_mode="exact"),
+                        [(queries[i:i + batch], kb) for i in range(0, len(queries), batch)])
+    results["batch_per_query_ms"] = float(np.sum(batched) / len(queries) * 1000)
+    hybrid = latencies(functools.partial(search_ask.hybrid_ranked_indices, search_mode="exact"),
+                       [(question, query, kb) for question, query in zip(questions, queries)])
+    results.update(percentiles_ms(hybrid, "hybrid"))
+    if path_questions:
+        shortcut = latencies(search_ask.lexical_shortcut, [(question, kb) for question in path_questions])
+        results.update(percentiles_ms(shortcut, "path_shortcut"))
+
+    if kb.ann_index is not None:
+        ivf = latencies(functools.partial(search_ask.ranked_indices, search_mode="ivf"), [(query, kb) for query in queries])
+        results.update(percentiles_ms(ivf, "ivf"))
+        k = 10
+        hits = 0
+        for query in queries:
+            expected, _ = search_ask.ranked_indices(query, kb, top_n=k, search_mode="exact")
+            found, _ = search_ask.ranked_indices(query, kb, top_n=k, search_mode="ivf")
+            hits += len(np.intersect1d(expected, found))
+        results[f"recall_at_{k}"] = hits / (k * len(queries))
+    return results
+
+
+def scenario_packing(args, kb) -> dict:
+    """Сборка сообщения для GPT из top-100 частей: с числом токенов из базы и с подсчетом заново."""
+    import search_ask
+
+    queries = synthetic_query_embeddings(len(kb), args.queries, kb.dim, seed=2)
+    questions, _ = synthetic_questions(kb, args.queries, seed=2)
+    stored, recount, prompt_tokens = [], [], []
+    for question, query in zip(questions, queries):
+        indices, _ = search_ask.ranked_indices(query, kb, search_mode="exact")
+        strings = [kb.texts[i] for i in indices]
+        counts = search_ask.chunk_token_counts(kb, indices)
+        stored.append(timed(search_ask.build_message, question, strings, search_ask.GPT_MODEL, args.token_budget, token_counts=counts))
+        recount.append(timed(search_ask.build_message, question, strings, search_ask.GPT_MODEL, args.token_budget))
+        message = search_ask.build_message(question, strings, search_ask.GPT_MODEL, args.token_budget, token_counts=counts)
+        prompt_tokens.append(search_ask.num_tokens(message))
+    results = {"token_budget": args.token_budget, "prompt_tokens_mean": float(np.mean(prompt_tokens))}
+    results.update(percentiles_ms(stored, "stored_counts"))
+    results.update(percentiles_ms(recount, "recount"))
+    return results
+
+
+def scenario_bot(args, kb) -> dict:
+    """Параллельные чаты через telegram_bot.handle_text: ответы в секунду и задержки стадий."""
+    import search_ask
+    from metrics import metrics
+    from telegram_bot import handle_text
+    from bench_bot_throughput import run_chats
+
+    search_ask.MAX_CONCURRENT_QUESTIONS = args.chats
+    metrics.reset()
+    throughput, first_text, complete = asyncio.run(run_chats(handle_text, args.chats, args.questions))
+    results = {
+        "chats": args.chats,
+        "answers_per_s": throughput,
+        "first_text_s": first_text,
+        "complete_s": complete,
+    }
+    for labels, histogram in sorted(metrics.histograms.get("ozon_stage_seconds", {}).items()):
+        quantiles = histogram.quantiles()
+        results[f"stage_{dict(labels)['stage']}_p50_ms"] = quantiles[0.5] * 1000
+    return results
+
+
+def metric_direction(name: str) -> int:
+    """+1 - чем больше, тем лучше; -1 - чем меньше, тем лучше; 0 - справочная метрика."""
+    if name.endswith("_per_s") or name.startswith("recall_"):
+        return 1
+    if name.endswith("_s") or name.endswith("_ms"):
+        return -1
+    return 0
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Печатает изменения метрик относительно базового прогона и возвращает ухудшившиеся."""
+    regressions = []
+    print(f"\n{'метрика':<40} {'было':>12} {'стало':>12} {'изменение':>10}")
+    for scenario, values in results.items():
+        for name, value in values.items():
+            old = baseline.get(scenario, {}).get(name)
+            direction = metric_direction(name)
+            if old is None or not direction or not old:
+                continue
+            change = (value - old) / abs(old)
+            worse = -change * direction > tolerance
+            key = f"{scenario}.{name}"
+            if worse:
+                regressions.append(key)
+            print(f"{key:<40} {old:>12.4g} {value:>12.4g} {change:>+9.1%}{' !' if worse else ''}")
+    return regressions
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--chunks", type=int, default=20000, help="частей синтетической базы (до 1M)")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--ann", action="store_true", help="построить IVF-индекс и замерить его")
+    parser.add_argument("--copies", type=int, default=4, help="копий документации для сценария ingest")
+    parser.add_argument("--queries", type=int, default=200, help="запросов в сценариях retrieval и packing")
+    parser.add_argument("--token-budget", type=int, default=4096 - 500)
+    parser.add_argument("--chats", type=int, default=16, help="параллельных чатов в сценарии bot")
+    parser.add_argument("--questions", type=int, default=3, help="вопросов на чат")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка эмбедингов заглушки, с")
+    parser.add_argument("--input-latency", type=float, default=0.0005, help="добавка к задержке за текст пакета, с")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="задержка ответа LLM заглушки, с")
+    parser.add_argument("--output", help="файл для результатов в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение метрики, доля")
+    args = parser.parse_args()
+
+    server, state, base_url = start_stub(dim=args.dim, latency=args.latency, input_latency=args.input_latency,
+                                         chat_latency=args.chat_latency, answer_words=20, stream_delay=0.01, seed=0)
+    kb_folder = tempfile.TemporaryDirectory(prefix="kb_")
+    # Настройки читаются при импорте модулей проекта, поэтому задаются до него
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:stub")
+    os.environ["OZON_KB_PATH"] = kb_folder.name
+    os.environ["OZON_EDIT_INTERVAL"] = "0.2"
+    os.environ["OZON_CACHE_MAX_ENTRIES"] = "0"  # каждый прогон должен проходить полный путь
+    offline_tokenizer = use_offline_tokenizer_if_needed()
+
+    results = {}
+    if "ingest" in args.scenarios:
+        results["ingest"] = scenario_ingest(args, state)
+        print(f"ingest: {results['ingest']}")
+    if set(args.scenarios) - {"ingest"}:
+        import search_ask
+        import tiktoken
+        start = time.perf_counter()
+        kb = synthetic_knowledge_base(
+            kb_folder.name, args.chunks, args.dim, count_tokens=search_ask.num_tokens,
+            token_encoding=tiktoken.encoding_name_for_model(search_ask.GPT_MODEL), ann=args.ann,
+        )
+        print(f"синтетическая база: {len(kb)} частей за {time.perf_counter() - start:.1f} s")
+        for name, scenario in [("retrieval", scenario_retrieval), ("packing", scenario_packing), ("bot", scenario_bot)]:
+            if name in args.scenarios:
+                results[name] = scenario(args, kb)
+                print(f"{name}: {results[name]}")
+    server.shutdown()
+
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "offline_tokenizer": offline_tokenizer,
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"результаты: {args.output}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+        if regressions:
+            print(f"ухудшились: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Синтетический корпус по документации Ozon: HTML для сборки базы и готовые базы знаний до 1M частей.
+
+python benchmarks/synthetic_corpus.py html OUT_DIR [--copies 8]
+python benchmarks/synthetic_corpus.py kb OUT_DIR [--chunks 1000000] [--dim 256] [--ann]
+Копии секций настоящей документации отличаются путями методов и заголовками, поэтому
+лексический индекс и кэши видят разные части, а не повторы. Эмбединги базы - смесь
+кластеров (как в bench_ann): 1M частей при dim=256 занимают ~1 ГБ, тексты - еще ~1 ГБ.
+"""
+import os
+import re
+import sys
+import html
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from html_sections import sections_from_file  # noqa: E402
+from bench_ann import clustered_unit_matrix  # noqa: E402
+
+DOC_FOLDER = os.path.join(ROOT, "ozon docs")
+SOURCE_DOCS = [("performance.html", "Ozon Performance API")]  # документация, которая есть в репозитории
+# Файлы, которые читает make_embeding_from_docs.main
+TARGET_DOCS = [("seller.html", "Ozon Seller API"), ("performance.html", "Ozon Performance API")]
+
+# Первый сегмент пути метода: /v2/product/info -> /v2_7/product/info в копии 7
+_PATH_HEAD_RE = re.compile(r"(?<![\w/])(/[A-Za-z][A-Za-z0-9]*)(?=/[A-Za-z0-9_{}])")
+
+
+def doc_sections(doc_folder: str = DOC_FOLDER) -> list[list]:
+    """Секции настоящей документации без предзаголовка и пустых: [[заголовки], текст]."""
+    sections = []
+    for name, preheader in SOURCE_DOCS:
+        for titles, text in sections_from_file(os.path.join(doc_folder, name), preheader):
+            if text.strip():
+                sections.append([titles[1:], text.strip()])
+    return sections
+
+
+def variant(text: str, copy: int) -> str:
+    """Текст копии copy: пути методов получают номер копии (копия 0 - без изменений)."""
+    return _PATH_HEAD_RE.sub(lambda match: f"{match.group(1)}_{copy}", text) if copy else text
+
+
+def synthetic_html(sections: list[list], copies: int) -> str:
+    """HTML из copies копий секций: заголовки h1..h6 по иерархии, строки текста - абзацами."""
+    parts = ["<html><body>"]
+    for copy in range(copies):
+        for titles, text in sections:
+            titles = titles or ["Введение"]
+            for level, title in enumerate(titles[:6], start=1):
+                title = f"{title} (копия {copy})" if level == 1 and copy else title
+                parts.append(f"<h{level}>{html.escape(title)}</h{level}>")
+            parts.extend(f"<p>{html.escape(variant(line, copy))}</p>" for line in text.split("\n") if line.strip())
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def write_docs(folder: str, copies: int, sections: list[list] | None = None) -> list[tuple[str, str]]:
+    """Пишет в folder файлы TARGET_DOCS по copies копий секций; возвращает пары (путь, предзаголовок)."""
+    sections = doc_sections() if sections is None else sections
+    os.makedirs(folder, exist_ok=True)
+    # Содержимое файлов одинаковое, части различаются предзаголовком, который входит в их текст
+    content = synthetic_html(sections, copies)
+    docs = []
+    for name, preheader in TARGET_DOCS:
+        path = os.path.join(folder, name)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content)
+        docs.append((path, preheader))
+    return docs
+
+
+def synthetic_chunks(n_chunks: int, sections: list[list] | None = None) -> list[str]:
+    """n_chunks частей в формате split_strings_from_subsection: секции по кругу, каждый круг - новая копия."""
+    sections = doc_sections() if sections is None else sections
+    chunks = []
+    for i in range(n_chunks):
+        copy, position = divmod(i, len(sections))
+        titles, text = sections[position]
+        chunks.append("\n\n".join(titles + [variant(text, copy)]))
+    return chunks
+
+
+def n_topics(n_chunks: int) -> int:
+    """Число тем эмбедингов базы из n_chunks частей (запросы берутся из тех же тем)."""
+    return max(n_chunks // 2000, 8)
+
+
+def synthetic_query_embeddings(n_chunks: int, n_queries: int, dim: int = 256, seed: int = 1) -> np.ndarray:
+    """Эмбединги запросов к синтетической базе: из тех же тем, но не совпадающие с частями."""
+    return clustered_unit_matrix(n_queries, dim, n_topics=n_topics(n_chunks), seed=seed)
+
+
+def synthetic_questions(kb, n_questions: int, seed: int = 1) -> tuple[list[str], list[str]]:
+    """Вопросы по случайным частям базы: по заголовку и по пути метода (для лексического поиска)."""
+    from lexical_index import api_paths
+
+    rng = np.random.default_rng(seed)
+    by_title, by_path = [], []
+    for i in rng.permutation(len(kb)):
+        text = kb.texts[i]
+        if len(by_title) < n_questions:
+            title = text.split("\n", 1)[0]
+            by_title.append(f"Как работает раздел «{title}»?")
+        paths = api_paths(text)
+        if paths and len(by_path) < n_questions:
+            by_path.append(f"Что возвращает метод {paths[0]}?")
+        if len(by_title) >= n_questions and len(by_path) >= n_questions:
+            break
+    return by_title, by_path
+
+
+def synthetic_knowledge_base(
+    path: str, # каталог, в который сохраняется база
+    n_chunks: int, # число частей
+    dim: int = 256, # размерность эмбедингов
+    count_tokens=None, # функция числа токенов текста; None - без сохраненного числа токенов
+    token_encoding: str | None = None, # кодировка, которой посчитаны токены
+    ann: bool = False, # строить ли IVF-индекс
+    seed: int = 0,
+):
+    """Собирает и сохраняет синтетическую базу знаний с лексическим (и по желанию IVF) индексом."""
+    from knowledge_base import KnowledgeBase
+    from lexical_index import LexicalIndex
+    from ann_index import IVFIndex
+
+    texts = synthetic_chunks(n_chunks)
+    embeddings = clustered_unit_matrix(n_chunks, dim, n_topics=n_topics(n_chunks), seed=seed)
+    token_counts = [count_tokens(text) for text in texts] if count_tokens is not None else None
+    kb = KnowledgeBase(
+        texts, embeddings, embedding_model="text-embedding-ada-002",
+        token_counts=token_counts, token_encoding=token_encoding if token_counts is not None else None,
+    )
+    kb.save(path)
+    LexicalIndex.build(kb.texts, fingerprint=kb.fingerprint).save(path)
+    if ann:
+        IVFIndex.build(kb.embeddings, fingerprint=kb.fingerprint).save(path)
+    return KnowledgeBase.load(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("kind", choices=["html", "kb"])
+    parser.add_argument("out")
+    parser.add_argument("--copies", type=int, default=8, help="копий документации в каждом HTML-файле")
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--ann", action="store_true", help="построить IVF-индекс")
+    args = parser.parse_args()
+
+    if args.kind == "html":
+        for path, _ in write_docs(args.out, args.copies):
+            print(f"{path}: {os.path.getsize(path) / 2 ** 20:.1f} MB")
+    else:
+        kb = synthetic_knowledge_base(args.out, args.chunks, args.dim, ann=args.ann)
+        print(f"{args.out}: частей {len(kb)}, dim {kb.dim}, {kb.embeddings.nbytes / 2 ** 20:.0f} MB эмбедингов")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Бот в нескольких процессах: один процесс получает обновления Telegram, N рабочих отвечают.
+
+OZON_BOT_WORKERS=4 python telegram_bot.py
+Рабочие процессы открывают одну и ту же базу знаний через отображение файлов в память:
+матрица эмбедингов и тексты лежат в страничном кэше ОС один раз на все процессы. Новую
+версию базы, опубликованную make_embeding_from_docs, каждый рабочий подхватывает сам
+(search_ask.get_knowledge_base), вопросы в обработке дорабатывают со старой версией.
+"""
+import signal
+import functools
+import asyncio
+import threading
+import multiprocessing
+from aiogram import Dispatcher
+from aiogram.types import Update
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+POLL_TIMEOUT = 30  # длинный опрос getUpdates, с
+RETRY_DELAY = 5.0  # пауза после ошибки getUpdates, с
+STOP_TIMEOUT = 60.0  # сколько ждать, пока рабочие доотвечают на вопросы при остановке, с
+CHECK_INTERVAL = 1.0  # как часто проверять, живы ли рабочие, с
+MAX_DELIVERIES = 3  # сколько раз передавать обновление рабочим, которые падают на нем
+
+
+def worker_for(update: Update, workers: int) -> int:
+    """Номер рабочего для обновления: все сообщения одного чата попадают к одному рабочему,
+    поэтому порядок ответов в чате сохраняется."""
+    message = update.message or update.edited_message or getattr(update.callback_query, "message", None)
+    key = message.chat.id if message is not None else update.update_id
+    return key % workers
+
+
+def run_worker(index: int, token: str, connection) -> None:
+    """Точка входа рабочего процесса."""
+    # Ctrl+C получает вся группа процессов; останавливает рабочих процесс-получатель
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve(index, token, connection))
+
+
+async def _serve(index: int, token: str, connection) -> None:
+    from telegram_bot import router, create_bot, METRICS_PORT, METRICS_HOST
+    from search_ask import get_knowledge_base
+    from metrics import start_http_server
+
+    # Открываем базу знаний заранее, чтобы первый запрос не ждал загрузки
+    get_knowledge_base()
+    if METRICS_PORT:
+        await start_http_server(METRICS_PORT + index, METRICS_HOST)  # у каждого рабочего свой порт
+
+    bot = create_bot(token)
+    dp = Dispatcher()
+    dp.include_router(router)
+
+    # Канал читается блокирующе, поэтому в отдельном потоке, а не в пуле search_ask
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+
+    def read_updates():
+        while True:
+            try:
+                data = connection.recv()
+            except (EOFError, OSError):
+                data = None  # процесс-получатель завершился
+            loop.call_soon_threadsafe(updates.put_nowait, data)
+            if data is None:
+                return
+
+    threading.Thread(target=read_updates, name=f"bot-worker-{index}-updates", daemon=True).start()
+
+    def acknowledge(task, update_id: int) -> None:
+        # Обработанное (в том числе с ошибкой) обновление не нужно передавать заново после перезапуска
+        tasks.discard(task)
+        try:
+            connection.send(update_id)
+        except OSError:
+            pass
+
+    tasks = set()
+    try:
+        while (data := await updates.get()) is not None:
+            update = Update.model_validate(data, context={"bot": bot})
+            task = asyncio.create_task(dp.feed_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(functools.partial(acknowledge, update_id=update.update_id))
+        # Новых обновлений не будет - доотвечаем на начатые вопросы
+        if tasks:
+            await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+    finally:
+        await bot.session.close()
+
+
+class WorkerPool:
+    """Рабочие процессы, у каждого свой канал (Pipe) с процессом-получателем.
+
+    Рабочий подтверждает каждое обработанное обновление. Неподтвержденные обновления пул
+    хранит и передает заново перезапущенному рабочему, поэтому вопрос, на котором рабочий
+    упал, не теряется (но может получить ответ дважды). Канал у каждого запуска новый:
+    процесс, убитый посреди чтения или записи, не оставляет следующему испорченный канал.
+    """
+
+    def __init__(self, token: str, workers: int):
+        self.token = token
+        # spawn: рабочие не наследуют цикл событий и сетевые соединения процесса-получателя
+        self.context = multiprocessing.get_context("spawn")
+        self.connections = [None] * workers
+        self.processes = [None] * workers
+        self.pending: list[dict[int, list]] = [{} for _ in range(workers)]  # update_id -> [данные, число передач]
+        for i in range(workers):
+            self._start(i)
+
+    def _start(self, index: int) -> None:
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, args=(index, self.token, child_connection), name=f"bot-worker-{index}",
+        )
+        process.start()
+        child_connection.close()
+        self.connections[index], self.processes[index] = connection, process
+
+    def _send(self, index: int, data) -> None:
+        try:
+            self.connections[index].send(data)
+        except OSError:
+            pass  # рабочий завершился - check() перезапустит его и передаст обновление заново
+
+    def submit(self, update: Update) -> None:
+        """Передает обновление рабочему его чата."""
+        index = worker_for(update, len(self.processes))
+        data = update.model_dump(mode="json", exclude_none=True)
+        self.pending[index][update.update_id] = [data, 1]
+        self._send(index, data)
+
+    def _read_acknowledgements(self, index: int) -> None:
+        connection = self.connections[index]
+        try:
+            while connection.poll():
+                self.pending[index].pop(connection.recv(), None)
+        except (EOFError, OSError):
+            pass  # рабочий завершился, все, что он успел подтвердить, прочитано
+
+    def check(self) -> None:
+        """Забирает подтверждения и перезапускает завершившихся рабочих, передавая им неподтвержденные обновления."""
+        for i, process in enumerate(self.processes):
+            self._read_acknowledgements(i)
+            if process.is_alive():
+                continue
+            print(f"Рабочий процесс {i} завершился с кодом {process.exitcode}, перезапускаем")
+            self.connections[i].close()
+            self._start(i)
+            for update_id, item in sorted(self.pending[i].items()):
+                if item[1] >= MAX_DELIVERIES:
+                    # Обновление, на котором рабочий падает каждый раз, не должно ронять его бесконечно
+                    print(f"Обновление {update_id} не обработано за {MAX_DELIVERIES} попытки, пропускаем")
+                    del self.pending[i][update_id]
+                    continue
+                item[1] += 1
+                self._send(i, item[0])
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Останавливает рабочих, дав им доответить на полученные вопросы."""
+        for i in range(len(self.processes)):
+            self._send(i, None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+
+
+async def _supervise(pool: WorkerPool) -> None:
+    """Проверяет рабочих по таймеру, а не между длинными опросами getUpdates."""
+    while True:
+        pool.check()
+        await asyncio.sleep(CHECK_INTERVAL)
+
+
+async def run_front(
+    token: str, # токен бота
+    workers: int, # число рабочих процессов
+    stop: asyncio.Event | None = None, # событие остановки; None - остановка по SIGINT/SIGTERM
+) -> None:
+    """Процесс-получатель: длинным опросом забирает обновления и раздает их рабочим."""
+    from telegram_bot import create_bot
+
+    pool = WorkerPool(token, workers)
+    bot = create_bot(token)
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    supervisor = asyncio.create_task(_supervise(pool))
+
+    offset = None
+    # Таймаут запроса должен быть больше таймаута длинного опроса
+    request_timeout = int(bot.session.timeout + POLL_TIMEOUT)
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, request_timeout=request_timeout))
+            await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                # Прерванный опрос не подтверждает обновления: Telegram вернет их при следующем запуске
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramAPIError, OSError, asyncio.TimeoutError) as e:
+                print(f"Не удалось получить обновления: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            for update in updates:
+                pool.submit(update)
+                offset = update.update_id + 1
+    finally:
+        stopping.cancel()
+        supervisor.cancel()
+        # Подтверждаем уже розданные обновления, чтобы после перезапуска они не пришли повторно
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0)
+            except (TelegramAPIError, OSError, asyncio.TimeoutError):
+                pass
+        await bot.session.close()
+        await asyncio.to_thread(pool.stop)
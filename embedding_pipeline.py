@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+import numpy as np
+import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+MAX_BATCH_ITEMS = 512  # частей в одном запросе embeddings.create (лимит API - 2048)
+MAX_BATCH_TOKENS = 100_000  # токенов в одном запросе (лимит API - 300k)
+MAX_CONCURRENCY = 4  # одновременно выполняемых запросов
+MAX_RETRIES = 6  # попыток на один пакет
+
+# Ошибки, после которых имеет смысл повторить запрос
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def chunk_key(text: str, model: str) -> str:
+    """Ключ части: хэш модели и текста, одинаковый для одинакового содержимого."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCheckpoint:
+    """Файл контрольных точек: уже полученные эмбединги, дописываемые по мере готовности пакетов.
+
+    Хранится как пара файлов: <path>.bin - подряд записанные векторы float32,
+    <path>.keys - заголовок (модель и размерность) и по одному ключу части на строку.
+    Ключ пишется после вектора, поэтому после обрыва записи ключей никогда не больше,
+    чем полностью записанных векторов; лишний хвост .bin отрезается при открытии.
+    """
+
+    def __init__(self, path: str, model: str):
+        self.path = path
+        self.model = model
+        self.dim = None
+        self.rows: dict[str, tuple[int, int]] = {}  # ключ -> (номер блока, строка в блоке)
+        self._blocks: list[np.ndarray] = []
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def keys_path(self) -> str:
+        return self.path + ".keys"
+
+    @property
+    def bin_path(self) -> str:
+        return self.path + ".bin"
+
+    def _load(self) -> None:
+        """Читает ранее сохраненные эмбединги, если они для той же модели."""
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, "r", encoding="utf-8") as file:
+            lines = file.read().splitlines()
+        if not lines:
+            return
+        header = json.loads(lines[0])
+        if header.get("model") != self.model or not header.get("dim") or not os.path.exists(self.bin_path):
+            return  # контрольная точка пуста или от другой модели эмбедингов - начинаем заново
+        self.dim = header["dim"]
+        keys = lines[1:]
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        complete = min(len(keys), os.path.getsize(self.bin_path) // row_bytes)
+        keys = keys[:complete]
+        with open(self.bin_path, "r+b") as file:
+            file.truncate(complete * row_bytes)
+        self._blocks = [np.fromfile(self.bin_path, dtype=np.float32, count=complete * self.dim).reshape(complete, self.dim)]
+        self.rows = {key: (0, i) for i, key in enumerate(keys)}
+        # Переписываем файл ключей без оборванного хвоста
+        self._write_keys_file(keys)
+
+    def _write_keys_file(self, keys: list[str]) -> None:
+        with open(self.keys_path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(json.dumps({"model": self.model, "dim": self.dim}) + "\n")
+            file.writelines(key + "\n" for key in keys)
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, key: str) -> np.ndarray:
+        block, row = self.rows[key]
+        return self._blocks[block][row]
+
+    def append(self, keys: list[str], vectors: np.ndarray) -> None:
+        """Дописывает пакет эмбедингов на диск (потокобезопасно)."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                for path in (self.bin_path, self.keys_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._write_keys_file([])
+            with open(self.bin_path, "ab") as file:
+                file.write(vectors.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            with open(self.keys_path, "a", encoding="utf-8") as file:
+                file.writelines(key + "\n" for key in keys)
+            self._blocks.append(vectors)
+            for i, key in enumerate(keys):
+                self.rows.setdefault(key, (len(self._blocks) - 1, i))
+
+
+
+def remove_checkpoint(path: str) -> None:
+    """Удаляет файлы контрольной точки."""
+    for suffix in (".bin", ".keys"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def pack_batches(
+    token_counts: list[int], # число токенов каждой части
+    max_items: int = MAX_BATCH_ITEMS, # не больше частей в пакете
+    max_tokens: int = MAX_BATCH_TOKENS, # не больше токенов в пакете
+) -> list[list[int]]:
+    """Жадно раскладывает части (по номерам) в пакеты с ограничением по числу частей и токенов."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class _Backoff:
+    """Общая для всех потоков пауза: при 429 от сервера ждут все запросы, а не только упавший."""
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def failed(self, attempt: int, error: Exception) -> None:
+        """Назначает паузу: Retry-After из ответа сервера или экспонента с разбросом."""
+        delay = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                delay = float(retry_after) if retry_after is not None else None
+            except ValueError:
+                delay = None
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+
+def _embed_batch(client, model: str, texts: list[str], backoff: _Backoff, max_retries: int) -> list[list[float]]:
+    """Один запрос embeddings.create с повторами при временных ошибках."""
+    for attempt in range(max_retries + 1):
+        backoff.wait()
+        try:
+            response = client.embeddings.create(input=texts, model=model)
+            # Сервер не обязан сохранять порядок, сортируем по index
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as error:
+            if attempt == max_retries:
+                raise
+            backoff.failed(attempt, error)
+
+
+def embed_texts(
+    texts: list[str], # тексты частей
+    client, # клиент OpenAI (или совместимый)
+    model: str, # модель эмбедингов
+    count_tokens=None, # функция подсчета токенов, по умолчанию грубая оценка по длине
+    checkpoint_path: str | None = None, # путь контрольной точки: прерванный запуск продолжится с нее
+    known: dict[str, np.ndarray] | None = None, # уже посчитанные эмбединги по chunk_key (например, из прошлой базы)
+    max_batch_items: int = MAX_BATCH_ITEMS,
+    max_batch_tokens: int = MAX_BATCH_TOKENS,
+    max_concurrency: int = MAX_CONCURRENCY,
+    max_retries: int = MAX_RETRIES,
+    progress: bool = True, # показывать прогресс-бар
+) -> np.ndarray:
+    """Вычисляет эмбединги пакетами в несколько потоков, возвращает матрицу (len(texts), dim) float32.
+
+    В API отправляются только части, которых нет ни в known, ни в контрольной точке.
+    """
+    if known is None:
+        known = {}
+    if count_tokens is None:
+        count_tokens = lambda text: len(text) // 2 + 1
+    checkpoint = EmbeddingCheckpoint(checkpoint_path, model) if checkpoint_path else None
+    keys = [chunk_key(text, model) for text in texts]
+
+    # Одинаковые тексты, уже известные и сохраненные в контрольной точке не отправляем
+    pending, seen = [], set()
+    for i, key in enumerate(keys):
+        if key in seen or key in known or (checkpoint is not None and key in checkpoint):
+            continue
+        seen.add(key)
+        pending.append(i)
+
+    results: dict[str, np.ndarray] = {}
+    batches = [[pending[j] for j in batch] for batch in pack_batches(
+        [count_tokens(texts[i]) for i in pending], max_items=max_batch_items, max_tokens=max_batch_tokens
+    )]
+    # Свои повторы вместо встроенных в клиент, чтобы пауза при 429 была общей
+    client = client.with_options(max_retries=0)
+    backoff = _Backoff()
+    saved = set()
+
+    def save(future) -> None:
+        batch = futures[future]
+        vectors = np.asarray(future.result(), dtype=np.float32)
+        batch_keys = [keys[i] for i in batch]
+        if checkpoint is not None:
+            checkpoint.append(batch_keys, vectors)
+        else:
+            results.update(zip(batch_keys, vectors))
+        saved.add(future)
+        bar.update(len(batch))
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool, \
+            tqdm(total=len(pending), disable=not progress) as bar:
+        futures = {
+            pool.submit(_embed_batch, client, model, [texts[i] for i in batch], backoff, max_retries): batch
+            for batch in batches
+        }
+        try:
+            for future in as_completed(futures):
+                save(future)
+        except BaseException:
+            # Пакеты из очереди больше не отправляем, а уже отправленные дожидаемся и сохраняем
+            # в контрольную точку: за них уже заплачено, перезапуск их не повторит
+            pool.shutdown(wait=True, cancel_futures=True)
+            for future in futures:
+                if future not in saved and not future.cancelled() and future.exception() is None:
+                    save(future)
+            raise
+
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    computed = checkpoint.get if checkpoint is not None else results.__getitem__
+    return np.stack([known[key] if key in known else computed(key) for key in keys]).astype(np.float32)
+
+
+def vectors_by_key(kb, model: str) -> dict[str, np.ndarray]:
+    """Эмбединги базы знаний по chunk_key - кэш для повторной сборки (строки memmap без копирования)."""
+    if kb is None or kb.embedding_model != model:
+        return {}
+    return {chunk_key(text, model): kb.embeddings[i] for i, text in enumerate(kb.texts)}
+
+
+def reindex_stats(known: dict[str, np.ndarray], texts: list[str], model: str) -> dict[str, int]:
+    """Сколько частей добавлено, удалено и переиспользовано относительно known."""
+    keys = {chunk_key(text, model) for text in texts}
+    reused = len(keys & known.keys())
+    return {"added": len(keys) - reused, "removed": len(known.keys() - keys), "reused": reused}
@@ -0,0 +1,234 @@
+import os
+from collections import Counter
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+
+READ_BLOCK = 1 << 16  # размер блока чтения HTML-файла, символов
+
+# Теги без закрывающей пары (тот же список, что у BeautifulSoup с html.parser)
+VOID_TAGS = frozenset({
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed", "frame", "hr", "image", "img",
+    "input", "isindex", "keygen", "link", "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+})
+# Текст внутри этих тегов в секции не попадает. get_text пропускает его только внутри других
+# элементов, а у самого <script> или <style> без заголовков возвращает код, и process_element
+# добавлял его в секцию; здесь код отбрасывается всегда - в базе знаний он только мешает поиску
+HIDDEN_TEXT_TAGS = frozenset({"script", "style", "template", "rt", "rp"})
+
+# Роли открытых элементов
+CONTAINER = "container"  # содержит заголовки: дочерние элементы разбираются по отдельности
+PENDING = "pending"  # заголовков пока не встретилось: текст копится, пока элемент не закроется
+HEADING = "heading"  # заголовок h1..h6
+IN_HEADING = "in_heading"  # элемент внутри заголовка
+
+
+def is_header_name(name: str) -> bool:
+    """Проверяет, является ли тег заголовком."""
+    return name.startswith("h") and name[1:].isdigit()
+
+
+class _Node:
+    __slots__ = ("name", "role", "units", "start", "seen_tag")
+
+    def __init__(self, name: str | None, role: str, start: int = 0):
+        self.name = name
+        self.role = role
+        self.units = []  # PENDING: дочерние строки ("text", s) и закрытые теги ("leaf", начало, конец); HEADING: строки
+        self.start = start  # PENDING: с какой строки в общем списке начинается текст элемента
+        self.seen_tag = False  # CONTAINER: встречался ли уже дочерний тег (текст до первого тега пропускается)
+
+
+class SectionParser(HTMLParser):
+    """Потоковое разбиение HTML на секции (заголовки, текст) за один проход.
+
+    Дает те же секции, что process_element по дереву BeautifulSoup: элемент без вложенных
+    заголовков добавляет свой текст целиком, элемент с заголовками разбирается по дочерним.
+    Есть ли внутри элемента заголовок, заранее неизвестно, поэтому текст открытого элемента
+    копится до его закрытия; если внутри встретился заголовок, накопленное разбирается
+    по дочерним элементам. Памяти нужно порядка одного элемента без заголовков, а не всего документа.
+
+    Намеренное отличие от process_element: текст тегов HIDDEN_TEXT_TAGS (скрипты, стили)
+    не попадает в секции, даже если такой тег стоит отдельным элементом.
+    """
+
+    def __init__(self, preheader: str):
+        super().__init__(convert_charrefs=True)
+        self.hierarchy = {0: preheader}
+        self.sections: dict[tuple, list[str]] = {}
+        self._stack = [_Node(None, CONTAINER)]  # корень документа
+        self._open = Counter()  # число открытых тегов по имени
+        self._closed_voids = []  # пустые теги, явное закрытие которых нужно пропустить
+        self._hidden = 0  # открытых тегов из HIDDEN_TEXT_TAGS
+        self._heading = None  # заголовок, текст которого сейчас собирается
+        self._strings = []  # непустые строки текста незакрытых PENDING-элементов
+        self._data = []
+
+    def _emit(self, text: str) -> None:
+        """Добавляет текст к секции текущей иерархии заголовков (как sections[key] += ...)."""
+        parts = self.sections.setdefault(tuple(self.hierarchy.values()), [])
+        if parts:
+            parts.append("\n" + text)
+        elif text:
+            parts.append(text)
+
+    def _string(self, text: str, visible: bool) -> None:
+        """Очередная строка документа; visible - учитывается ли она в get_text."""
+        node = self._stack[-1]
+        if self._heading is not None:
+            if visible and not self._hidden and text.strip():
+                self._heading.units.append(text.strip())
+        elif node.role == CONTAINER:
+            if node.seen_tag and text.strip():
+                self._emit(text.strip())
+        else:
+            node.units.append(("text", text))
+            if visible and not self._hidden and text.strip():
+                self._strings.append(text.strip())
+
+    def _flush(self) -> None:
+        if self._data:
+            text = "".join(self._data)
+            self._data = []
+            self._string(text, visible=True)
+
+    def _open_containers(self) -> None:
+        """Внутри незакрытых элементов встретился заголовок: разбираем их по дочерним элементам."""
+        for node in self._stack:
+            if node.role != PENDING:
+                continue
+            seen_tag = False
+            for unit in node.units:
+                if unit[0] == "leaf":
+                    seen_tag = True
+                    self._emit("\n".join(self._strings[unit[1]:unit[2]]))
+                elif seen_tag and unit[1].strip():
+                    self._emit(unit[1].strip())
+            node.role, node.units, node.seen_tag = CONTAINER, [], True
+        self._strings = []
+
+    def _push(self, name: str) -> None:
+        parent = self._stack[-1]
+        if self._heading is not None:
+            node = _Node(name, IN_HEADING)
+        else:
+            if is_header_name(name) and parent.role == PENDING:
+                self._open_containers()
+            if parent.role == CONTAINER:
+                parent.seen_tag = True
+            if is_header_name(name):
+                node = self._heading = _Node(name, HEADING)
+            else:
+                node = _Node(name, PENDING, len(self._strings))
+        self._stack.append(node)
+        self._open[name] += 1
+        if name in HIDDEN_TEXT_TAGS:
+            self._hidden += 1
+
+    def _pop(self) -> None:
+        node = self._stack.pop()
+        self._open[node.name] -= 1
+        if node.name in HIDDEN_TEXT_TAGS:
+            self._hidden -= 1
+        if node.role == HEADING:
+            self._heading = None
+            level = int(node.name[-1])
+            for key in list(self.hierarchy):
+                if key >= level:
+                    del self.hierarchy[key]
+            self.hierarchy[level] = "".join(node.units)
+        elif node.role == PENDING:
+            parent = self._stack[-1]
+            if parent.role == CONTAINER:
+                # Элемент без заголовков: весь его текст - одна добавка к секции
+                self._emit("\n".join(self._strings[node.start:]))
+                del self._strings[node.start:]
+            else:
+                parent.units.append(("leaf", node.start, len(self._strings)))
+
+    def handle_starttag(self, tag, attrs, handle_empty_element=True):
+        self._flush()
+        self._push(tag)
+        if handle_empty_element and tag in VOID_TAGS:
+            self.handle_endtag(tag, check_already_closed=False)
+            self._closed_voids.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, handle_empty_element=False)
+        self.handle_endtag(tag, check_already_closed=False)
+
+    def handle_endtag(self, tag, check_already_closed=True):
+        if check_already_closed and tag in self._closed_voids:
+            self._closed_voids.remove(tag)
+            return
+        self._flush()
+        # Как BeautifulSoup: закрываем все теги до последнего открытого с этим именем, лишние закрытия пропускаем
+        while self._open[tag] and len(self._stack) > 1:
+            closing = self._stack[-1].name
+            self._pop()
+            if closing == tag:
+                break
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def _special(self, text: str, visible: bool = False) -> None:
+        self._flush()
+        self._string(text, visible)
+
+    def handle_comment(self, data):
+        self._special(data)
+
+    def handle_decl(self, decl):
+        self._special(decl[len("DOCTYPE "):])
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self._special(data[len("CDATA["):], visible=True)
+        else:
+            self._special(data)
+
+    def handle_pi(self, data):
+        self._special(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+        while len(self._stack) > 1:
+            self._pop()
+
+    def result(self) -> list[list]:
+        """Секции в формате all_section_with_text: [[заголовки], текст]."""
+        return [[list(titles), "".join(parts)] for titles, parts in self.sections.items()]
+
+
+def sections_from_html(html: str, preheader: str) -> list[list]:
+    """Секции HTML-строки."""
+    parser = SectionParser(preheader)
+    parser.feed(html)
+    parser.close()
+    return parser.result()
+
+
+def sections_from_file(path: str, preheader: str, block_size: int = READ_BLOCK) -> list[list]:
+    """Секции HTML-файла; файл читается блоками и целиком в память не загружается."""
+    parser = SectionParser(preheader)
+    with open(path, "r", encoding="utf-8") as file:
+        while block := file.read(block_size):
+            parser.feed(block)
+    parser.close()
+    return parser.result()
+
+
+def extract_sections(
+    docs: list[tuple[str, str]], # пары (путь к HTML-файлу, предзаголовок)
+    max_workers: int | None = None, # число процессов, по умолчанию по числу файлов и ядер
+) -> list[list]:
+    """Секции всех файлов документации в порядке файлов; файлы разбираются в пуле процессов."""
+    if max_workers is None:
+        max_workers = min(len(docs), os.cpu_count() or 1)
+    if max_workers <= 1 or len(docs) <= 1:
+        results = [sections_from_file(path, preheader) for path, preheader in docs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(sections_from_file, *zip(*docs)))
+    return [section for sections in results for section in sections]
@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from collections.abc import Sequence
+import numpy as np
+
+KB_FORMAT_VERSION = 2  # версия формата хранилища, меняется при несовместимых изменениях
+READABLE_FORMAT_VERSIONS = (1, 2)  # в версии 1 тексты частей лежали в chunks.json
+DEFAULT_KB_PATH = "knowledge_base"  # каталог базы знаний по умолчанию
+EMBEDDINGS_FILE = "embeddings.npy"  # матрица эмбедингов float32 (n, dim)
+CHUNKS_FILE = "chunks.json"  # заголовок с метаданными и число токенов частей
+TEXTS_FILE = "texts.npy"  # тексты частей подряд в UTF-8 (uint8)
+TEXT_OFFSETS_FILE = "text_offsets.npy"  # границы текстов в TEXTS_FILE (n + 1, int64)
+EMBEDDING_DTYPE = np.float32
+VERSIONS_SUFFIX = ".versions"  # каталог версий рядом с базой: knowledge_base.versions/<версия>
+KEEP_VERSIONS = 3  # сколько прошлых версий оставлять при публикации новой
+
+
+class KnowledgeBaseError(ValueError):
+    """Хранилище базы знаний отсутствует, повреждено или несовместимо."""
+
+
+def _load_array(path: str, mmap: bool = True) -> np.ndarray:
+    """np.load файла базы знаний; отсутствующий, обрезанный или поврежденный файл - KnowledgeBaseError."""
+    try:
+        return np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+    except FileNotFoundError as error:
+        raise KnowledgeBaseError(f"Нет файла базы знаний: {path}") from error
+    except (ValueError, OSError, EOFError) as error:
+        # np.load сообщает об обрезанном файле ValueError (mmap, reshape) или EOFError, о битом заголовке - ValueError/OSError
+        raise KnowledgeBaseError(f"Поврежден файл {path}: {error}") from error
+
+
+def _sha256_of_array(array: np.ndarray) -> str:
+    """Хэш содержимого матрицы, считается блоками, чтобы не копировать memmap целиком."""
+    digest = hashlib.sha256()
+    row_bytes = array.itemsize * array.shape[1]
+    rows_per_block = max(1, (16 << 20) // max(1, row_bytes))  # блоки примерно по 16 МБ
+    for start in range(0, len(array), rows_per_block):
+        digest.update(np.ascontiguousarray(array[start:start + rows_per_block]).tobytes())
+    return digest.hexdigest()
+
+
+def _sha256_of_texts(texts: "list[str] | MappedTexts") -> str:
+    """Хэш списка текстов (с разделителем, чтобы границы частей тоже учитывались)."""
+    digest = hashlib.sha256()
+    if isinstance(texts, MappedTexts):
+        # Те же байты без декодирования строк
+        data = memoryview(texts.data)
+        for start, end in zip(texts.offsets[:-1].tolist(), texts.offsets[1:].tolist()):
+            digest.update((end - start).to_bytes(8, "little"))
+            digest.update(data[start:end])
+        return digest.hexdigest()
+    for text in texts:
+        encoded = text.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class MappedTexts(Sequence):
+    """Тексты частей, отображенные в память: байты UTF-8 подряд и границы текстов.
+
+    Строка создается только при обращении к части, а страницы файла общие для всех
+    процессов, открывших базу, - как у матрицы эмбедингов.
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data  # uint8
+        self.offsets = offsets  # int64, len(texts) + 1
+
+    @classmethod
+    def from_texts(cls, texts: list[str]) -> "MappedTexts":
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("номер части вне базы знаний")
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+
+class KnowledgeBase:
+    """База знаний: тексты частей документации и их эмбединги в виде непрерывной матрицы float32.
+
+    Хранится в каталоге: embeddings.npy и texts.npy с text_offsets.npy открываются через
+    memory-map, поэтому страницы матрицы и текстов разделяются между всеми процессами,
+    читающими базу; chunks.json - заголовок с версией формата и хэшами.
+    Необязательно в chunks.json хранится число токенов каждой части для кодировки
+    token_encoding - тогда при сборке запроса к GPT части не нужно токенизировать заново.
+    """
+
+    def __init__(
+        self,
+        texts: "list[str] | MappedTexts",
+        embeddings: np.ndarray,
+        embedding_model: str | None = None,
+        token_counts: list[int] | None = None, # число токенов каждой части
+        token_encoding: str | None = None, # кодировка tiktoken, в которой посчитаны token_counts
+    ):
+        embeddings = np.asarray(embeddings)
+        if embeddings.ndim != 2:
+            raise KnowledgeBaseError(f"Ожидается матрица эмбедингов (n, dim), получено измерений: {embeddings.ndim}")
+        if len(texts) != len(embeddings):
+            raise KnowledgeBaseError(f"Число текстов ({len(texts)}) не совпадает с числом эмбедингов ({len(embeddings)})")
+        if embeddings.dtype != EMBEDDING_DTYPE:
+            embeddings = embeddings.astype(EMBEDDING_DTYPE)
+        self.texts = texts if isinstance(texts, MappedTexts) else list(texts)
+        self.embeddings = embeddings
+        self.embedding_model = embedding_model
+        if token_counts is not None and len(token_counts) != len(texts):
+            raise KnowledgeBaseError(f"Число текстов ({len(texts)}) не совпадает с числом счетчиков токенов ({len(token_counts)})")
+        self.token_counts = None if token_counts is None else np.asarray(token_counts, dtype=np.int32)
+        self.token_encoding = token_encoding if token_counts is not None else None
+        self.path = None  # каталог, из которого открыта база (None - база в памяти)
+        self._engine = None
+        self._ann_index = None
+        self._ann_index_checked = False
+        self._lexical_index = None
+        self._lexical_index_checked = False
+        self._header = None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def dim(self) -> int:
+        """Размерность эмбедингов."""
+        return self.embeddings.shape[1]
+
+    @property
+    def engine(self):
+        """Поисковый движок по эмбедингам базы, создается при первом обращении."""
+        if self._engine is None:
+            from retrieval import RetrievalEngine
+            self._engine = RetrievalEngine(self.embeddings)
+        return self._engine
+
+    @property
+    def ann_index(self):
+        """Приближенный индекс (IVF) из каталога базы, None - если он не построен или устарел."""
+        if not self._ann_index_checked and self.path is not None:
+            from ann_index import IVFIndex
+            self._ann_index_checked = True
+            index = IVFIndex.load(self.path)
+            if index is not None and index.fingerprint == self.fingerprint:
+                self._ann_index = index
+        return self._ann_index
+
+    @property
+    def lexical_index(self):
+        """Лексический индекс (BM25) из каталога базы, None - если он не построен или устарел."""
+        if not self._lexical_index_checked and self.path is not None:
+            from lexical_index import LexicalIndex
+            self._lexical_index_checked = True
+            index = LexicalIndex.load(self.path)
+            if index is not None and index.fingerprint == self.fingerprint:
+                self._lexical_index = index
+        return self._lexical_index
+
+    @property
+    def fingerprint(self) -> str:
+        """Отпечаток содержимого базы: меняется при любой пересборке с другими текстами или векторами."""
+        header = self.header()
+        return hashlib.sha256((header["embeddings_sha256"] + header["texts_sha256"]).encode()).hexdigest()[:32]
+
+    def header(self) -> dict:
+        """Заголовок хранилища: версия формата, размеры и хэши содержимого."""
+        if self._header is None:
+            self._header = self._make_header()
+        return self._header
+
+    def _make_header(self) -> dict:
+        return {
+            "format_version": KB_FORMAT_VERSION,
+            "embedding_model": self.embedding_model,
+            "count": len(self),
+            "dim": self.dim,
+            "dtype": np.dtype(EMBEDDING_DTYPE).name,
+            "embeddings_sha256": _sha256_of_array(self.embeddings),
+            "texts_sha256": _sha256_of_texts(self.texts),
+        }
+
+    def save(self, path: str = DEFAULT_KB_PATH) -> None:
+        """Сохраняет базу знаний в каталог path. Файлы пишутся во временные и затем подменяются."""
+        os.makedirs(path, exist_ok=True)
+        embeddings_path = os.path.join(path, EMBEDDINGS_FILE)
+        texts_path = os.path.join(path, TEXTS_FILE)
+        offsets_path = os.path.join(path, TEXT_OFFSETS_FILE)
+        chunks_path = os.path.join(path, CHUNKS_FILE)
+
+        texts = self.texts if isinstance(self.texts, MappedTexts) else MappedTexts.from_texts(self.texts)
+        with open(embeddings_path + ".tmp", "wb") as file:
+            np.save(file, np.ascontiguousarray(self.embeddings, dtype=EMBEDDING_DTYPE))
+        with open(texts_path + ".tmp", "wb") as file:
+            np.save(file, texts.data)
+        with open(offsets_path + ".tmp", "wb") as file:
+            np.save(file, texts.offsets)
+        with open(chunks_path + ".tmp", "w", encoding="utf-8") as file:
+            data = {"header": {**self.header(), "format_version": KB_FORMAT_VERSION}}
+            if self.token_counts is not None:
+                data["token_encoding"] = self.token_encoding
+                data["token_counts"] = self.token_counts.tolist()
+            json.dump(data, file, ensure_ascii=False)
+
+        # Заголовок подменяется последним: читатель, попавший между заменами, увидит несовпадение хэша.
+        # Чтобы работающие процессы не видели промежуточного состояния, собирайте новую версию
+        # в отдельном каталоге и публикуйте ее publish_version
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+        os.replace(texts_path + ".tmp", texts_path)
+        os.replace(offsets_path + ".tmp", offsets_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_KB_PATH, mmap: bool = True, verify: bool = True) -> "KnowledgeBase":
+        """Открывает базу знаний из каталога path.
+
+        При mmap=True матрица эмбедингов и тексты отображаются в память только для чтения,
+        при verify=True содержимое сверяется с хэшами из заголовка. Если path - ссылка
+        на версию (publish_version), база открывается из версии, на которую она указывает сейчас.
+        """
+        path = os.path.realpath(path)
+        chunks_path = os.path.join(path, CHUNKS_FILE)
+        embeddings_path = os.path.join(path, EMBEDDINGS_FILE)
+        if not os.path.exists(chunks_path) or not os.path.exists(embeddings_path):
+            raise KnowledgeBaseError(f"База знаний не найдена в каталоге {path!r}. Соберите ее: python make_embeding_from_docs.py")
+
+        try:
+            with open(chunks_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (json.JSONDecodeError, UnicodeDecodeError) as error:
+            raise KnowledgeBaseError(f"Поврежден файл {chunks_path}: {error}") from error
+        header = data.get("header", {})
+
+        if header.get("format_version") not in READABLE_FORMAT_VERSIONS:
+            raise KnowledgeBaseError(
+                f"Неподдерживаемая версия формата базы знаний: {header.get('format_version')} (ожидается {KB_FORMAT_VERSION})"
+            )
+        if header["format_version"] == 1:
+            texts = data.get("texts", [])
+        else:
+            texts = MappedTexts(
+                _load_array(os.path.join(path, TEXTS_FILE), mmap),
+                _load_array(os.path.join(path, TEXT_OFFSETS_FILE), mmap=False),
+            )
+
+        embeddings = _load_array(embeddings_path, mmap)
+        expected_shape = (header.get("count"), header.get("dim"))
+        if embeddings.shape != expected_shape or embeddings.dtype != np.dtype(header.get("dtype")):
+            raise KnowledgeBaseError(
+                f"Матрица эмбедингов {embeddings.shape} {embeddings.dtype} не соответствует заголовку {expected_shape} {header.get('dtype')}"
+            )
+        if len(texts) != header["count"]:
+            raise KnowledgeBaseError(f"Число текстов ({len(texts)}) не соответствует заголовку ({header['count']})")
+        if verify:
+            if _sha256_of_array(embeddings) != header.get("embeddings_sha256"):
+                raise KnowledgeBaseError("Хэш матрицы эмбедингов не совпадает с заголовком")
+            if _sha256_of_texts(texts) != header.get("texts_sha256"):
+                raise KnowledgeBaseError("Хэш текстов не совпадает с заголовком")
+
+        token_counts = data.get("token_counts")
+        if token_counts is not None and len(token_counts) != len(texts):
+            token_counts = None  # счетчики не от этих текстов - посчитаем при запросе
+        kb = cls(
+            texts, embeddings, embedding_model=header.get("embedding_model"),
+            token_counts=token_counts, token_encoding=data.get("token_encoding"),
+        )
+        kb.path = path
+        kb._header = header
+        return kb
+
+    @classmethod
+    def from_csv(cls, csv_path: str = "embeddings.csv", embedding_model: str | None = None) -> "KnowledgeBase":
+        """Строит базу знаний из старого формата: CSV со столбцами text и embedding (список в виде строки)."""
+        import pandas as pd
+
+        df = pd.read_csv(csv_path)
+        # json.loads заметно быстрее ast.literal_eval и понимает тот же формат списка чисел
+        embeddings = np.array([json.loads(embedding) for embedding in df["embedding"]], dtype=EMBEDDING_DTYPE)
+        return cls(df["text"].tolist(), embeddings, embedding_model=embedding_model)
+
+    def to_dataframe(self):
+        """DataFrame со столбцами text и embedding, как в старом формате (строки матрицы без копирования)."""
+        import pandas as pd
+
+        return pd.DataFrame({"text": list(self.texts), "embedding": list(self.embeddings)})
+
+
+def versions_dir(path: str = DEFAULT_KB_PATH) -> str:
+    """Каталог версий базы знаний path."""
+    return os.path.abspath(path).rstrip(os.sep) + VERSIONS_SUFFIX
+
+
+def new_version_path(path: str = DEFAULT_KB_PATH) -> str:
+    """Новый пустой каталог для следующей версии базы: в нем база собирается целиком, затем публикуется."""
+    os.makedirs(versions_dir(path), exist_ok=True)
+    return tempfile.mkdtemp(prefix=time.strftime("%Y%m%d-%H%M%S-"), dir=versions_dir(path))
+
+
+def publish_version(path: str, version_path: str, keep: int = KEEP_VERSIONS) -> None:
+    """Атомарно переключает path (символическую ссылку) на собранную версию и удаляет старые версии.
+
+    Перед публикацией версия один раз сверяется с хэшами заголовка (KnowledgeBaseError - ссылка
+    не переключается), поэтому процессы бота открывают опубликованные версии без этой проверки.
+    Процессы, открывшие базу раньше, продолжают читать свою версию; get_knowledge_base
+    замечает новую по изменившейся ссылке (см. version_of). Оставляются keep прошлых версий:
+    их файлы могут быть еще отображены в память у вопросов, которые сейчас в обработке.
+    """
+    KnowledgeBase.load(version_path, verify=True)
+    path = os.path.abspath(path).rstrip(os.sep)
+    os.makedirs(versions_dir(path), exist_ok=True)
+    if os.path.isdir(path) and not os.path.islink(path):
+        # Первая публикация: прежний каталог базы становится одной из версий
+        os.rename(path, os.path.join(versions_dir(path), time.strftime("%Y%m%d-%H%M%S-previous")))
+    link = path + ".link.tmp"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.relpath(version_path, os.path.dirname(path)), link)
+    os.replace(link, path)
+
+    current = os.path.realpath(path)
+    versions = [entry.path for entry in os.scandir(versions_dir(path)) if entry.is_dir(follow_symlinks=False)]
+    versions = sorted((version for version in versions if os.path.realpath(version) != current), key=os.path.getmtime)
+    for version in versions[:max(len(versions) - keep, 0)]:
+        shutil.rmtree(version, ignore_errors=True)
+
+
+def version_of(path: str = DEFAULT_KB_PATH) -> tuple[str, int] | None:
+    """Версия базы в path: каталог, на который указывает path, и время изменения заголовка.
+    Меняется при публикации новой версии и при сохранении на место; None - базы сейчас нет."""
+    directory = os.path.realpath(path)
+    try:
+        return directory, os.stat(os.path.join(directory, CHUNKS_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def convert_csv(csv_path: str = "embeddings.csv", kb_path: str = DEFAULT_KB_PATH, embedding_model: str | None = None) -> KnowledgeBase:
+    """Однократная конвертация embeddings.csv в хранилище базы знаний."""
+    kb = KnowledgeBase.from_csv(csv_path, embedding_model=embedding_model)
+    kb.save(kb_path)
+    return kb
+
+
+if __name__ == "__main__":
+    # python knowledge_base.py [embeddings.csv] [knowledge_base]
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else "embeddings.csv"
+    kb_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_KB_PATH
+    kb = convert_csv(csv_path, kb_path, embedding_model="text-embedding-ada-002")
+    print(f"Сконвертировано {len(kb)} записей размерности {kb.dim} в {kb_path}")
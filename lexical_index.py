@@ -0,0 +1,182 @@
+import os
+import re
+import numpy as np
+from retrieval import top_k_indices
+
+LEXICAL_INDEX_FILE = "bm25_index.npz"  # файл индекса в каталоге базы знаний
+LEXICAL_FORMAT_VERSION = 1
+
+# Путь метода API: /v2/product/info, /api/client/campaign/{campaignId}/objects
+_PATH_RE = re.compile(r"(?<![\w/])(?:/[A-Za-z0-9_{}.\-]+){2,}")
+_WORD_RE = re.compile(r"\w+")
+# Части составных имен полей: offer_id -> offer, id; productId -> product, id
+_NAME_PART_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+_CYRILLIC_RE = re.compile(r"[а-я]")
+
+# Служебные слова вопросов и документации, которые ничего не говорят о теме
+STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от меня еще
+нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж вам ведь там потом
+себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под
+будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда
+зачем всех никогда можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая много
+разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между
+это как какие каких каким the a an of to in for and or is are be by on with
+""".split())
+
+# Окончания русских слов, от длинных к коротким (облегченный стеммер: без словаря и правил чередования)
+_ENDINGS = sorted("""
+иями ями ами ыми ими его ого ему ому ией ать ять ить еть уть ться тся ешь ете ишь ите ует уют ают яют ает яет
+ия ие ий ый ой ая яя ое ее ые ую юю ов ев ей ам ям ах ях ом ем ию ью ть ет ит ут ют ат ят ал ил ел ли ло ла
+а я о е и ы у ю ь й
+""".split(), key=len, reverse=True)
+MIN_STEM = 3  # не укорачивать основу короче стольких букв
+
+
+def stem(word: str) -> str:
+    """Отбрасывает окончание русского слова, чтобы разные формы давали один термин."""
+    if len(word) <= MIN_STEM + 1 or not _CYRILLIC_RE.search(word):
+        return word
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def api_paths(text: str) -> list[str]:
+    """Пути методов API в тексте (в нижнем регистре, без концевой пунктуации)."""
+    return [path.rstrip("/.,-").lower() for path in _PATH_RE.findall(text)]
+
+
+def tokenize(text: str) -> list[str]:
+    """Термины текста: пути методов целиком, слова (с отброшенными окончаниями) и части составных имен."""
+    terms = api_paths(text)
+    for word in _WORD_RE.findall(text):
+        lower = word.lower().replace("ё", "е")
+        if lower in STOP_WORDS:
+            continue
+        terms.append(stem(lower))
+        parts = _NAME_PART_RE.findall(word)
+        if len(parts) > 1:
+            terms.extend(stem(part.lower()) for part in parts)
+    return terms
+
+
+class LexicalIndex:
+    """Инвертированный индекс BM25 по частям базы знаний.
+
+    Словарь терминов хранится массивом строк, списки вхождений - подряд в массивах
+    номеров частей и частот (CSR): offsets[t]:offsets[t + 1] - вхождения термина t.
+    Пути методов API - отдельные термины, поэтому запрос с точным путем находит
+    описывающие его части, даже если эмбединги ранжируют их плохо.
+    """
+
+    def __init__(
+        self,
+        terms: np.ndarray, # словарь терминов
+        offsets: np.ndarray, # границы списков вхождений (len(terms) + 1)
+        doc_ids: np.ndarray, # номера частей, упорядоченные по терминам
+        term_freqs: np.ndarray, # сколько раз термин встречается в части
+        doc_lengths: np.ndarray, # число терминов в каждой части
+        fingerprint: str | None = None, # отпечаток базы знаний, по которой построен индекс
+    ):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.fingerprint = fingerprint
+        self._term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        self._avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts: list[str], fingerprint: str | None = None) -> "LexicalIndex":
+        """Строит индекс по текстам частей."""
+        term_ids: dict[str, int] = {}
+        doc_terms = [[term_ids.setdefault(term, len(term_ids)) for term in tokenize(text)] for text in texts]
+        doc_lengths = np.array([len(terms) for terms in doc_terms], dtype=np.int32)
+        stride = max(len(texts), 1)
+        # Пары (термин, часть) одним числом: после np.unique они упорядочены по термину, затем по части
+        pairs = np.fromiter((term for terms in doc_terms for term in terms), dtype=np.int64, count=int(doc_lengths.sum()))
+        pairs = pairs * stride + np.repeat(np.arange(len(texts), dtype=np.int64), doc_lengths)
+        pairs, counts = np.unique(pairs, return_counts=True)
+        offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // stride, minlength=len(term_ids)), out=offsets[1:])
+        return cls(
+            np.array(list(term_ids), dtype=str),
+            offsets,
+            (pairs % stride).astype(np.int32),
+            np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16),
+            doc_lengths,
+            fingerprint,
+        )
+
+    def known_paths(self, query: str) -> list[str]:
+        """Пути методов API из запроса, которые встречаются в базе знаний."""
+        return [path for path in api_paths(query) if path in self._term_ids]
+
+    def scores(self, query: str, k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+        """BM25 запроса для каждой части. Части с путем метода из запроса всегда выше остальных."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        n_docs = len(self)
+        for term in set(tokenize(query)):
+            term_id = self._term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.term_freqs[start:end].astype(np.float32)
+            idf = np.log(1 + (n_docs - (end - start) + 0.5) / (end - start + 0.5))
+            norm = k1 * (1 - b + b * self.doc_lengths[docs] / self._avg_length)
+            scores[docs] += idf * tf * (k1 + 1) / (tf + norm)
+        paths = self.known_paths(query)
+        if paths:
+            boost = scores.max() + 1
+            for path in paths:
+                term_id = self._term_ids[path]
+                scores[self.doc_ids[self.offsets[term_id]:self.offsets[term_id + 1]]] += boost
+        return scores
+
+    def search(self, query: str, top_n: int = 100, k1: float = 1.5, b: float = 0.75) -> tuple[np.ndarray, np.ndarray]:
+        """Номера и оценки BM25 top_n частей, в которых есть хотя бы один термин запроса."""
+        scores = self.scores(query, k1=k1, b=b)
+        matched = np.flatnonzero(scores > 0)
+        best = matched[top_k_indices(scores[matched], top_n)]
+        return best, scores[best]
+
+    def save(self, path: str) -> None:
+        """Сохраняет индекс в каталог базы знаний."""
+        index_path = os.path.join(path, LEXICAL_INDEX_FILE)
+        with open(index_path + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                format_version=np.array(LEXICAL_FORMAT_VERSION),
+                fingerprint=np.array(self.fingerprint or ""),
+                terms=self.terms,
+                offsets=self.offsets,
+                doc_ids=self.doc_ids,
+                term_freqs=self.term_freqs,
+                doc_lengths=self.doc_lengths,
+            )
+        os.replace(index_path + ".tmp", index_path)
+
+    @classmethod
+    def load(cls, path: str) -> "LexicalIndex | None":
+        """Открывает индекс из каталога базы знаний, None - если индекса нет или формат другой."""
+        index_path = os.path.join(path, LEXICAL_INDEX_FILE)
+        if not os.path.exists(index_path):
+            return None
+        with np.load(index_path, allow_pickle=False) as data:
+            if int(data["format_version"]) != LEXICAL_FORMAT_VERSION:
+                return None
+            return cls(
+                data["terms"],
+                data["offsets"],
+                data["doc_ids"],
+                data["term_freqs"],
+                data["doc_lengths"],
+                str(data["fingerprint"]) or None,
+            )
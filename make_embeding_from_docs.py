@@ -4,14 +4,18 @@ from itertools import chain
 import pandas as pd
 from openai import OpenAI
 import re 
+import numpy as np
 import tiktoken  # для подсчета токенов
 from collections import defaultdict
-from tqdm import tqdm
+from knowledge_base import KnowledgeBase, KnowledgeBaseError, DEFAULT_KB_PATH, versions_dir, new_version_path, publish_version
+from ann_index import IVFIndex
+from lexical_index import LexicalIndex
+from html_sections import extract_sections
+from embedding_pipeline import embed_texts, remove_checkpoint, vectors_by_key, reindex_stats
+from tokenizer import get_encoding, num_tokens  # кодировка tiktoken, одна на процесс
 
 client = OpenAI(api_key = os.environ.get("OPENAI_API_KEY"))
 
-tqdm.pandas()
-
 
 GPT_MODEL = "gpt-3.5-turbo"  # only matters insofar as it selects which tokenizer to use
 EMBEDDING_MODEL = "text-embedding-ada-002"  # Модель токенизации от OpenAI
@@ -96,41 +100,63 @@ def keep_section(section: tuple[list[str], str], len_trashold = 16) -> bool:
     else:
         return True
     
-# Функция подсчета токенов
-def num_tokens(text: str, model: str = GPT_MODEL) -> int:
-    """Возвращает число токенов в строке."""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+# Разделители частей от большего к меньшему (разрыв, абзац, точка)
+DELIMITERS = ["\n\n", "\n", ". "]
+_DELIMITER_PATTERNS = {delimiter: re.compile(re.escape(delimiter.encode("utf-8"))) for delimiter in DELIMITERS}
+_SPACE_PATTERN = re.compile(rb"\s")
+
+class _TokenizedText:
+    """Текст, токенизированный один раз: байты текста и байтовые позиции концов токенов.
+
+    Число токенов любого отрезка текста - два бинарных поиска по концам токенов,
+    поэтому при поиске точек разреза текст не нужно склеивать и токенизировать заново.
+    Токен на границе отрезка относится к тому отрезку, где он заканчивается.
+    """
+
+    def __init__(self, text: str, model: str = GPT_MODEL):
+        encoding = get_encoding(model)
+        token_ids = encoding.encode(text)
+        self.data = text.encode("utf-8")
+        self.ends = np.cumsum([len(token) for token in encoding.decode_tokens_bytes(token_ids)], dtype=np.int64)
+
+    def count(self, start, end):
+        """Число токенов в отрезке [start, end) (start и end могут быть массивами)."""
+        return np.searchsorted(self.ends, end, "right") - np.searchsorted(self.ends, start, "right")
+
+    def position(self, start: int, n_tokens: int) -> int:
+        """Байтовая позиция конца n_tokens-го токена после start."""
+        first = int(np.searchsorted(self.ends, start, "right"))
+        return int(self.ends[min(first + n_tokens, len(self.ends)) - 1]) if n_tokens > 0 else start
+
+    def text(self, start: int, end: int) -> str:
+        # Разрез по токенам может прийтись на середину символа - неполный символ отбрасываем
+        return self.data[start:end].decode("utf-8", errors="ignore")
+
+def _best_cut(tokens: _TokenizedText, start: int, end: int, delimiter: str) -> int | None:
+    """Позиция разделителя, после разреза по которой токенов слева ближе всего к половине отрезка.
+
+    Токены левой части для всех разделителей сразу считаются по префиксным суммам.
+    None - если разделителя нет или любой разрез оставляет пустую половину.
+    """
+    cuts = np.array([match.start() for match in _DELIMITER_PATTERNS[delimiter].finditer(tokens.data, start, end)],
+                    dtype=np.int64)
+    cuts = cuts[(cuts > start) & (cuts + len(delimiter) < end)]
+    if len(cuts) == 0:
+        return None
+    halfway = tokens.count(start, end) // 2
+    return int(cuts[np.argmin(np.abs(tokens.count(start, cuts) - halfway))])
 
 # Функция разделения строк
-def halved_by_delimiter(string: str, delimiter: str = "\n") -> list[str, str]:
+def halved_by_delimiter(string: str, delimiter: str = "\n", model: str = GPT_MODEL) -> list[str, str]:
     """Разделяет строку надвое с помощью разделителя (delimiter), пытаясь сбалансировать токены с каждой стороны."""
-
-    # Делим строку на части по разделителю, по умолчанию \n - перенос строки
-    chunks = string.split(delimiter)
-    if len(chunks) == 1:
+    if delimiter not in _DELIMITER_PATTERNS:
+        _DELIMITER_PATTERNS[delimiter] = re.compile(re.escape(delimiter.encode("utf-8")))
+    tokens = _TokenizedText(string, model)
+    cut = _best_cut(tokens, 0, len(tokens.data), delimiter)
+    if cut is None:
         return [string, ""]  # разделитель не найден
-    elif len(chunks) == 2:
-        return chunks  # нет необходимости искать промежуточную точку
-    else:
-        # Считаем токены
-        total_tokens = num_tokens(string)
-        halfway = total_tokens // 2
-        # Предварительное разделение по середине числа токенов
-        best_diff = halfway
-        # В цикле ищем какой из разделителей, будет ближе всего к best_diff
-        for i, chunk in enumerate(chunks):
-            left = delimiter.join(chunks[: i + 1])
-            left_tokens = num_tokens(left)
-            diff = abs(halfway - left_tokens)
-            if diff >= best_diff:
-                break
-            else:
-                best_diff = diff
-        left = delimiter.join(chunks[:i])
-        right = delimiter.join(chunks[i:])
-        # Возвращаем левую и правую часть оптимально разделенной строки
-        return [left, right]
+    # Возвращаем левую и правую часть оптимально разделенной строки
+    return [tokens.text(0, cut), tokens.text(cut + len(delimiter.encode("utf-8")), len(tokens.data))]
 
 # Функция обрезает строку до максимально разрешенного числа токенов
 def truncated_string(
@@ -140,7 +166,7 @@ def truncated_string(
     print_warning: bool = True, # флаг вывода предупреждения
 ) -> str:
     """Обрезка строки до максимально разрешенного числа токенов."""
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     encoded_string = encoding.encode(string)
     # Обрезаем строку и декодируем обратно
     truncated_string = encoding.decode(encoded_string[:max_tokens])
@@ -149,57 +175,119 @@ def truncated_string(
     # Усеченная строка
     return truncated_string
 
+def _split_range(
+    tokens: _TokenizedText, # токенизированный текст секции
+    start: int, # начало отрезка, байт
+    end: int, # конец отрезка, байт
+    level: int, # первый из DELIMITERS, которым пробуем резать
+    max_tokens: int, # максимальное число токенов в части
+    max_recursion: int, # максимальное число рекурсий
+    parts: list[tuple[int, int]], # сюда дописываются отрезки частей
+) -> None:
+    """Делит отрезок текста пополам по токенам, пока части не уложатся в max_tokens."""
+    n_tokens = int(tokens.count(start, end))
+    if n_tokens <= max_tokens:
+        parts.append((start, end))
+        return
+    # если разделить не удалось, то просто усечем отрезок по числу токенов (должно быть очень редко)
+    if max_recursion > 0:
+        for level in range(level, len(DELIMITERS)):
+            cut = _best_cut(tokens, start, end, DELIMITERS[level])
+            if cut is not None:
+                # В половинах нет разделителей крупнее текущего - начинаем с него же
+                _split_range(tokens, start, cut, level, max_tokens, max_recursion - 1, parts)
+                _split_range(tokens, cut + len(DELIMITERS[level]), end, level, max_tokens, max_recursion - 1, parts)
+                return
+    print(f"Предупреждение: Строка обрезана с {n_tokens} токенов до {max_tokens} токенов.")
+    parts.append((start, tokens.position(start, max_tokens)))
+
+def _overlap_start(tokens: _TokenizedText, start: int, end: int, overlap_tokens: int) -> int:
+    """Начало последних overlap_tokens токенов отрезка, сдвинутое к границе слова."""
+    tail_tokens = int(tokens.count(start, end))
+    if tail_tokens <= overlap_tokens:
+        return start
+    position = tokens.position(start, tail_tokens - overlap_tokens)
+    # Первое слово может быть обрезано посередине - начинаем со следующего
+    space = _SPACE_PATTERN.search(tokens.data, position, end)
+    return space.end() if space else position
+
+def _split_overflow(tokens: _TokenizedText, start: int, end: int, excess: int) -> list[tuple[int, int]] | None:
+    """Делит отрезок, который после токенизации вместе с заголовками превысил лимит на excess токенов:
+    по самому крупному разделителю, а без них - по токенам. None - отрезок уже не разделить."""
+    for delimiter in DELIMITERS:
+        cut = _best_cut(tokens, start, end, delimiter)
+        if cut is not None:
+            return [(start, cut), (cut + len(delimiter), end)]
+    budget = int(tokens.count(start, end)) - excess
+    cut = tokens.position(start, budget) if budget > 0 else start
+    return [(start, cut), (cut, end)] if start < cut < end else None
+
 # Функция делит секции статьи на части по максимальному числу токенов
 def split_strings_from_subsection(
     subsection: tuple[list[str], str], # секции
     max_tokens: int = 1000, # максимальное число токенов
     model: str = GPT_MODEL, # модель
     max_recursion: int = 5, # максимальное число рекурсий
+    overlap_tokens: int = 0, # сколько токенов конца предыдущей части повторять в начале следующей
 ) -> list[str]:
     """
     Разделяет секции на список из частей секций, в каждой части не более max_tokens.
     Каждая часть представляет собой кортеж родительских заголовков [H1, H2, ...] и текста (str).
+
+    Текст секции токенизируется один раз; точки разреза выбираются по префиксным суммам
+    токенов между разделителями, поэтому время разбиения линейно по длине секции.
     """
     titles, text = subsection
-    string = "\n\n".join(titles + [text])
-    num_tokens_in_string = num_tokens(string)
-    # Если длина соответствует допустимой, то вернет строку
-    if num_tokens_in_string <= max_tokens:
-        return [string]
-    # если в результате рекурсия не удалось разделить строку, то просто усечем ее по числу токенов
-    elif max_recursion == 0:
-        return [truncated_string(string, model=model, max_tokens=max_tokens)]
-    # иначе разделим пополам и выполним рекурсию
-    else:
-        titles, text = subsection
-        for delimiter in ["\n\n", "\n", ". "]: # Пробуем использовать разделители от большего к меньшему (разрыв, абзац, точка)
-            left, right = halved_by_delimiter(text, delimiter=delimiter)
-            if left == "" or right == "":
-                # если какая-либо половина пуста, повторяем попытку с более простым разделителем
+    title_prefix = "\n\n".join(titles + [""])
+    # Большинство секций помещается целиком: одна токенизация готовой строки, позиции токенов не нужны
+    if num_tokens(title_prefix + text, model) <= max_tokens:
+        return [title_prefix + text]
+    # Заголовки повторяются в каждой части, на текст остается то, что после них
+    text_budget = max_tokens - num_tokens(title_prefix, model)
+    if overlap_tokens:
+        text_budget -= overlap_tokens + num_tokens("\n", model)
+    if text_budget <= 0:
+        # заголовки сами не помещаются в части - просто усечем строку по числу токенов
+        return [truncated_string(title_prefix + text, model=model, max_tokens=max_tokens)]
+
+    tokens = _TokenizedText(text, model)
+    parts = []
+    _split_range(tokens, 0, len(tokens.data), 0, text_budget, max_recursion, parts)
+    strings = []
+    i = 0
+    while i < len(parts):
+        start, end = parts[i]
+        overlap = ""
+        if overlap_tokens and i:
+            previous_start, previous_end = parts[i - 1]
+            overlap = tokens.text(_overlap_start(tokens, previous_start, previous_end, overlap_tokens), previous_end) + "\n"
+        string = title_prefix + overlap + tokens.text(start, end)
+        # Размер отрезка - сумма токенов исходной токенизации: токен, оборванный на границе отрезка,
+        # и склейки с заголовками и перекрытием дают при новой токенизации больше. Готовую часть
+        # пересчитываем (каждая токенизируется один раз - в сумме линейно) и перебираем лишнее
+        excess = num_tokens(string, model) - max_tokens
+        if excess > 0:
+            halves = _split_overflow(tokens, start, end, excess)
+            if halves is not None:
+                parts[i:i + 1] = halves
                 continue
-            else:
-                # применим рекурсию на каждой половине
-                results = []
-                for half in [left, right]:
-                    half_subsection = (titles, half)
-                    half_strings = split_strings_from_subsection(
-                        half_subsection,
-                        max_tokens=max_tokens,
-                        model=model,
-                        max_recursion=max_recursion - 1, # уменьшаем максимальное число рекурсий
-                    )
-                    results.extend(half_strings)
-                return results
-    # иначе никакого разделения найдено не было, поэтому просто обрезаем строку (должно быть очень редко)
-    return [truncated_string(string, model=model, max_tokens=max_tokens)]
+            string = truncated_string(string, model=model, max_tokens=max_tokens, print_warning=False)
+        strings.append(string)
+        i += 1
+    return strings
 
 # Функция отправки chatGPT строки для ее токенизации (вычисления эмбедингов)
 def get_embedding(text, model="text-embedding-ada-002"):
    return client.embeddings.create(input = [text], model=model).data[0].embedding
 
-def main():
+def main(build_ann_index: bool | None = None, pq_m: int | None = None):
+    """Собирает базу знаний. build_ann_index: строить ли IVF-индекс (None - только для больших баз),
+    pq_m: число подвекторов для сжатия индекса PQ (None - без сжатия)."""
     MAX_TOKENS = 1600
-    SAVE_PATH = "./embeddings.csv"
+    OVERLAP_TOKENS = 0  # перекрытие соседних частей одной секции, токенов
+    ANN_MIN_CHUNKS = 50_000  # начиная с такого размера базы полный перебор становится заметным
+    SAVE_PATH = DEFAULT_KB_PATH  # база знаний: ссылка на текущую версию в каталоге knowledge_base.versions
+    CHECKPOINT_PATH = os.path.join(versions_dir(SAVE_PATH), "embedding_checkpoint")  # прогресс вычисления эмбедингов
 
     doc_folder = 'ozon docs'
     doc_names_and_preheaders = [
@@ -207,31 +295,67 @@ def main():
         ,['performance.html','Ozon Performance API']
     ]
 
-    preheaders_and_html = []
-    for name, preheader in doc_names_and_preheaders:
-        path = os.path.join(doc_folder,name)
-        with open(path, "r", encoding="utf-8") as file:
-            html = file.read()
-        preheaders_and_html.append([preheader,html])
-
-    sections = []
-    for preheader, html in preheaders_and_html:
-        sections += all_section_with_text(html,preheader)
+    # Файлы разбираются потоково (без дерева BeautifulSoup), каждый в своем процессе
+    sections = extract_sections([
+        (os.path.join(doc_folder, name), preheader) for name, preheader in doc_names_and_preheaders
+    ])
     
     sections = [clean_section(ws) for ws in sections]
     sections = [ws for ws in sections if keep_section(ws)]
 
     strings = []
     for section in sections:
-        strings.extend(split_strings_from_subsection(section, max_tokens=MAX_TOKENS, max_recursion=10))
+        strings.extend(split_strings_from_subsection(
+            section, max_tokens=MAX_TOKENS, max_recursion=10, overlap_tokens=OVERLAP_TOKENS
+        ))
     sections = strings
 
     # df = pd.DataFrame({"text": sections[:10]})
     df = pd.DataFrame({"text": sections})
 
-    df['embedding'] = df['text'].progress_apply(lambda x: get_embedding(x, model='text-embedding-ada-002'))
+    # Эмбединги неизменившихся частей берем из прошлой сборки базы знаний
+    try:
+        previous_kb = KnowledgeBase.load(SAVE_PATH)
+    except KnowledgeBaseError:
+        previous_kb = None
+    known = vectors_by_key(previous_kb, EMBEDDING_MODEL)
+    stats = reindex_stats(known, df['text'].tolist(), EMBEDDING_MODEL)
+    print(f"Частей: новых {stats['added']}, удалено {stats['removed']}, переиспользовано {stats['reused']}")
+
+    # Число токенов частей считаем один раз: оно нужно для пакетов эмбедингов и сохраняется в базе,
+    # чтобы при сборке запроса к GPT не токенизировать части заново
+    token_counts = [num_tokens(text) for text in df['text']]
+    tokens_by_text = dict(zip(df['text'], token_counts))
+
+    # Остальные - пакетами в несколько потоков; прерванный запуск продолжится с контрольной точки
+    os.makedirs(versions_dir(SAVE_PATH), exist_ok=True)
+    embeddings = embed_texts(
+        df['text'].tolist(), client, model=EMBEDDING_MODEL, count_tokens=tokens_by_text.__getitem__,
+        checkpoint_path=CHECKPOINT_PATH, known=known,
+    )
+
+    # Новая версия собирается целиком (база и индексы) в отдельном каталоге и публикуется одной
+    # заменой ссылки: работающий бот переключится на нее без перезапуска, а вопросы в обработке
+    # доработают со старой версией
+    version_path = new_version_path(SAVE_PATH)
+
+    # Сохраняем эмбединги непрерывной матрицей float32, тексты - в отдельный файл
+    kb = KnowledgeBase(
+        df['text'].tolist(), embeddings, embedding_model=EMBEDDING_MODEL,
+        token_counts=token_counts, token_encoding=tiktoken.encoding_name_for_model(GPT_MODEL),
+    )
+    kb.save(version_path)
+
+    # Лексический индекс BM25 для гибридного поиска: дешев в сборке, строим всегда
+    LexicalIndex.build(kb.texts, fingerprint=kb.fingerprint).save(version_path)
+
+    # Приближенный индекс кладем рядом с матрицей эмбедингов
+    if build_ann_index or (build_ann_index is None and len(kb) >= ANN_MIN_CHUNKS):
+        IVFIndex.build(kb.embeddings, pq_m=pq_m, fingerprint=kb.fingerprint).save(version_path)
 
-    df.to_csv(SAVE_PATH, index=False)
+    publish_version(SAVE_PATH, version_path)
+    # База опубликована - контрольная точка больше не нужна
+    remove_checkpoint(CHECKPOINT_PATH)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
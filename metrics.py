@@ -0,0 +1,278 @@
+import io
+import time
+import asyncio
+import cProfile
+import pstats
+import threading
+import contextvars
+import numpy as np
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+# Границы корзин гистограмм (как в клиентах Prometheus)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # с
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RECENT_SAMPLES = 2048  # по скольким последним значениям считаются квантили
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Гистограмма с корзинами для экспорта и последними значениями для квантилей (потокобезопасна)."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.bucket_counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.recent.append(value)
+
+    def quantiles(self) -> dict[float, float]:
+        """Квантили QUANTILES по последним RECENT_SAMPLES значениям ({} - значений еще не было)."""
+        with self._lock:
+            samples = np.fromiter(self.recent, dtype=np.float64, count=len(self.recent))
+        if not len(samples):
+            return {}
+        return dict(zip(QUANTILES, np.quantile(samples, QUANTILES).tolist()))
+
+
+def _labels_text(labels: tuple[tuple[str, str], ...], **extra) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+class Metrics:
+    """Реестр метрик процесса: гистограммы, счетчики и функции, дающие метрики в момент экспорта."""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.collectors = []  # функции () -> [(имя, тип, {метки}, значение)]
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self.histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self.histograms[name][key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def add_collector(self, collector) -> None:
+        self.collectors.append(collector)
+
+    def reset(self) -> None:
+        """Обнуляет гистограммы и счетчики (собранные метрики считаются их владельцами)."""
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        with self._lock:
+            histograms = {name: dict(series) for name, series in self.histograms.items()}
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels_text(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels_text(labels)} {histogram.count}")
+            # Квантили по последним значениям - отдельным семейством, в гистограмме их быть не может
+            lines.append(f"# TYPE {name}_recent summary")
+            for labels, histogram in sorted(series.items()):
+                for quantile, value in histogram.quantiles().items():
+                    lines.append(f"{name}_recent{_labels_text(labels, quantile=quantile)} {value}")
+        for name, series in sorted(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_labels_text(labels)} {value}")
+        collected: dict[str, list] = {}
+        for collector in self.collectors:
+            for name, kind, labels, value in collector():
+                collected.setdefault(name, [kind, []])[1].append((tuple(sorted(labels.items())), value))
+        for name, (kind, series) in sorted(collected.items()):
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                lines.append(f"{name}{_labels_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Краткая сводка для человека: квантили стадий, счетчики и собранные метрики."""
+        lines = []
+        with self._lock:
+            stages = dict(self.histograms.get("ozon_stage_seconds", {}))
+            others = {name: dict(series) for name, series in self.histograms.items() if name != "ozon_stage_seconds"}
+            counters = {name: dict(series) for name, series in self.counters.items()}
+        if stages:
+            lines.append("Стадия: число, p50 / p95 / p99, мс")
+        for labels, histogram in sorted(stages.items()):
+            quantiles = histogram.quantiles()
+            percentiles = " / ".join(f"{quantiles[q] * 1000:.0f}" for q in QUANTILES) if quantiles else "-"
+            lines.append(f"  {dict(labels).get('stage', '?')}: {histogram.count}, {percentiles}")
+        for name, series in sorted(others.items()):
+            for labels, histogram in sorted(series.items()):
+                quantiles = histogram.quantiles()
+                percentiles = " / ".join(f"{quantiles[q]:.0f}" for q in QUANTILES) if quantiles else "-"
+                lines.append(f"{name}{_labels_text(labels)}: {histogram.count}, p50 / p95 / p99 {percentiles}")
+        for name, series in sorted(counters.items()):
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_labels_text(labels)}: {value:g}")
+        for collector in self.collectors:
+            for name, _, labels, value in collector():
+                lines.append(f"{name}{_labels_text(tuple(labels.items()))}: {value:g}")
+        return "\n".join(lines) if lines else "Метрик пока нет"
+
+
+metrics = Metrics()  # реестр процесса
+
+
+class RequestTrace:
+    """Стадии одного запроса; при profile=True - еще и профиль cProfile их вычислительной части."""
+
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.spans: list[tuple[str, float]] = []
+        self._stats: pstats.Stats | None = None
+        self._lock = threading.Lock()
+
+    def add_profile(self, profiler: cProfile.Profile) -> None:
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def report(self, limit: int = 20) -> str:
+        """Длительности стадий и самые затратные функции по профилю."""
+        lines = [f"{stage}: {elapsed * 1000:.1f} мс" for stage, elapsed in self.spans]
+        if self._stats is not None:
+            output = io.StringIO()
+            self._stats.stream = output
+            self._stats.sort_stats("cumulative").print_stats(limit)
+            lines.append(output.getvalue().strip())
+        return "\n".join(lines)
+
+
+_current_trace: contextvars.ContextVar[RequestTrace | None] = contextvars.ContextVar("ozon_request_trace", default=None)
+# cProfile в процессе один: с Python 3.12 второй Profile.enable() в любом потоке выбрасывает ValueError.
+# Стадия профилируется, только если профилировщик свободен; вложенные и параллельные - нет
+_profiler_lock = threading.Lock()
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def observe_stage(stage: str, elapsed: float) -> None:
+    """Учитывает длительность стадии в гистограмме ozon_stage_seconds и в трассе текущего запроса."""
+    metrics.observe("ozon_stage_seconds", elapsed, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((stage, elapsed))
+
+
+class StageTimer:
+    """Стадия из нескольких ожиданий, между которыми работает чужой код.
+
+    Потоковый ответ отдается через yield: span вокруг всего цикла засчитал бы стадии и время
+    получателя частей (например, редактирование сообщения в Telegram). Здесь суммируются
+    только замеры measure(), observe() учитывает сумму как одну стадию.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.elapsed = 0.0
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def observe(self) -> None:
+        observe_stage(self.stage, self.elapsed)
+
+
+@contextmanager
+def span(stage: str):
+    """Замеряет стадию: время попадает в гистограмму ozon_stage_seconds и в трассу текущего запроса.
+
+    Если для запроса включен профиль, стадия профилируется cProfile - только вне цикла событий
+    (в пуле потоков или в синхронном пути), иначе в профиль попали бы чужие корутины.
+    """
+    trace = _current_trace.get()
+    profiler = None
+    if trace is not None and trace.profile and not _in_event_loop() and _profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Профилирует другой инструмент (отладчик, sys.monitoring) - стадию только замеряем
+            profiler = None
+            _profiler_lock.release()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+            trace.add_profile(profiler)
+        observe_stage(stage, elapsed)
+
+
+@contextmanager
+def trace_request(profile: bool = False):
+    """Включает трассу (и при profile=True профиль) для кода внутри блока, в том числе в пуле потоков."""
+    trace = RequestTrace(profile)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+async def start_http_server(port: int, host: str = "127.0.0.1"):
+    """Отдает метрики по http://host:port/metrics в формате Prometheus (aiohttp ставится вместе с aiogram).
+
+    По умолчанию только локально; для сбора с другой машины host="0.0.0.0".
+    """
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
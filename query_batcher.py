@@ -0,0 +1,96 @@
+import asyncio
+import contextvars
+from collections import Counter
+
+
+class MicroBatcher:
+    """Собирает одиночные запросы из разных корутин в пакеты.
+
+    Первый запрос запускает таймер на window секунд; все запросы, пришедшие за это время
+    (но не больше max_batch), обрабатываются одним вызовом process_batch, и каждый
+    ожидающий получает свой результат. Если пакет заполнился раньше, он уходит сразу.
+    Работает внутри одного цикла событий.
+    """
+
+    def __init__(
+        self,
+        process_batch, # корутина f(list[item]) -> list[result] того же размера и порядка
+        window: float = 0.005, # сколько ждать попутных запросов, с
+        max_batch: int = 32, # не больше запросов в пакете
+    ):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = Counter()  # число пакетов по размеру
+        self.queue_delay_total = 0.0  # суммарное ожидание запросов до отправки пакета, с
+        self.queue_delay_max = 0.0
+        self._pending: list[tuple[object, asyncio.Future, float]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item):
+        """Добавляет запрос в ближайший пакет и ждет его результата."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, loop.time()))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        return await future
+
+    def _dispatch(self) -> None:
+        """Отправляет накопленные запросы пакетами по max_batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            # Запросы, которые уже никто не ждет (отмена по таймауту), не отправляем
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+            now = loop.time()
+            delays = [now - submitted for _, _, submitted in batch]
+            self.batches += 1
+            self.items += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            self.queue_delay_total += sum(delays)
+            self.queue_delay_max = max(self.queue_delay_max, max(delays))
+            # Пакет общий для нескольких запросов: контекст (трасса) ни одного из них ему не передаем
+            task = loop.create_task(self._run(batch), context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[object, asyncio.Future, float]]) -> None:
+        try:
+            results = await self.process_batch([item for item, _, _ in batch])
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as error:
+            # Ошибка пакета достается каждому, кто его ждал
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self) -> dict[str, float]:
+        """Заполнение пакетов и добавленная пакетированием задержка."""
+        batches = max(self.batches, 1)
+        items = max(self.items, 1)
+        return {
+            "batches": self.batches,
+            "queries": self.items,
+            "mean_batch_size": self.items / batches,
+            "mean_fill": self.items / batches / self.max_batch,
+            "mean_queue_delay_ms": self.queue_delay_total / items * 1000,
+            "max_queue_delay_ms": self.queue_delay_max * 1000,
+        }
@@ -0,0 +1,109 @@
+import numpy as np
+from typing import Callable
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k наибольших значений по последней оси, отсортированные по убыванию.
+
+    Вместо полной сортировки сначала выбираем k лучших через argpartition (O(n)),
+    и сортируем только их (O(k log k)).
+    """
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.intp)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n), scores.shape).copy()
+    candidate_scores = np.take_along_axis(scores, candidates, axis=-1)
+    order = np.argsort(-candidate_scores, axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray], top_n: int, k: int = 60) -> tuple[np.ndarray, np.ndarray]:
+    """Объединяет несколько ранжирований (массивы номеров, от лучшего к худшему) по сумме 1 / (k + место).
+
+    Оценки разных поисков (косинус, BM25) несравнимы между собой, а места сравнимы;
+    k сглаживает разницу между первыми местами.
+    """
+    ids = np.concatenate([np.asarray(ranking, dtype=np.int64) for ranking in rankings])
+    weights = np.concatenate([1 / (k + np.arange(1, len(ranking) + 1)) for ranking in rankings])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights)
+    best = top_k_indices(scores, top_n)
+    return unique_ids[best], scores[best]
+
+
+def row_norms(matrix: np.ndarray, block_bytes: int = 16 << 20) -> np.ndarray:
+    """Нормы строк матрицы, блоками примерно по block_bytes.
+
+    np.linalg.norm(matrix, axis=1) создает временный массив размером со всю матрицу;
+    для memmap это означало бы прочитать базу в память целиком в каждом процессе.
+    """
+    norms = np.empty(len(matrix), dtype=np.float32)
+    rows_per_block = max(1, block_bytes // max(1, matrix.itemsize * matrix.shape[1]))
+    for start in range(0, len(matrix), rows_per_block):
+        block = matrix[start:start + rows_per_block]
+        norms[start:start + rows_per_block] = np.sqrt(np.einsum("ij,ij->i", block, block))
+    return norms
+
+
+class RetrievalEngine:
+    """Точный поиск ближайших частей базы знаний по косинусной схожести.
+
+    Матрица эмбедингов нормируется один раз при создании, после чего схожесть
+    запроса со всеми частями считается одним умножением матрицы на вектор,
+    а пачка запросов - одним умножением матрицы на матрицу.
+    """
+
+    def __init__(self, embeddings: np.ndarray, normalized_tolerance: float = 1e-3):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = row_norms(embeddings)
+        if len(norms) and np.all(np.abs(norms - 1) <= normalized_tolerance):
+            # Эмбединги OpenAI уже нормированы: используем матрицу как есть, без копии (важно для memmap)
+            self.matrix = embeddings
+        else:
+            norms[norms == 0] = 1
+            self.matrix = embeddings / norms[:, None]
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    @staticmethod
+    def _normalize(queries: np.ndarray) -> np.ndarray:
+        """Нормирует запросы по последней оси."""
+        norms = np.linalg.norm(queries, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return queries / norms
+
+    def scores(self, query_embedding) -> np.ndarray:
+        """Косинусная схожесть запроса со всеми частями базы знаний."""
+        query = self._normalize(np.asarray(query_embedding, dtype=np.float32))
+        return self.matrix @ query
+
+    def search(self, query_embedding, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+        """Возвращает индексы и схожести top_n лучших частей для одного запроса."""
+        scores = self.scores(query_embedding)
+        indices = top_k_indices(scores, top_n)
+        return indices, scores[indices]
+
+    def search_batch(self, query_embeddings, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+        """Поиск для пачки запросов (m, dim): индексы и схожести формы (m, top_n)."""
+        queries = self._normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        scores = queries @ self.matrix.T
+        indices = top_k_indices(scores, top_n)
+        return indices, np.take_along_axis(scores, indices, axis=-1)
+
+    def search_with(
+        self,
+        query_embedding,
+        relatedness_fn: Callable, # произвольная функция схожести f(query, embedding) -> float
+        embeddings: np.ndarray | None = None, # исходные (ненормированные) эмбединги для функции
+        top_n: int = 100,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Поиск с пользовательской функцией схожести (построчно, медленнее матричного пути)."""
+        rows = self.matrix if embeddings is None else embeddings
+        scores = np.fromiter((relatedness_fn(query_embedding, row) for row in rows), dtype=np.float64, count=len(rows))
+        indices = top_k_indices(scores, top_n)
+        return indices, scores[indices]
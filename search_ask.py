@@ -1,103 +1,416 @@
 import os
+import time
+import asyncio
+import threading
+import functools
+import contextvars
+import weakref
+import numpy as np
 import pandas as pd
-import ast
 import openai
-from openai import OpenAI 
-from scipy import spatial  # вычисляет сходство векторов
+from openai import OpenAI, AsyncOpenAI
 import tiktoken  # для подсчета токенов
+from knowledge_base import KnowledgeBase, KnowledgeBaseError, DEFAULT_KB_PATH, version_of
+from retrieval import reciprocal_rank_fusion
+from answer_cache import QueryCache, DEFAULT_TTL, DEFAULT_MAX_ENTRIES
+from query_batcher import MicroBatcher
+from metrics import metrics, span, StageTimer, TOKEN_BUCKETS
+from tokenizer import get_encoding, num_tokens
 
 client = OpenAI(api_key = os.environ.get("OPENAI_API_KEY"))
+async_client = AsyncOpenAI(api_key = os.environ.get("OPENAI_API_KEY"))  # клиент для асинхронного пути (бот)
 
 GPT_MODEL = "gpt-3.5-turbo"  # only matters insofar as it selects which tokenizer to use
 EMBEDDING_MODEL = "text-embedding-ada-002"  # Модель токенизации от OpenAI
+KB_PATH = os.environ.get("OZON_KB_PATH", DEFAULT_KB_PATH)  # каталог базы знаний
+MAX_CONCURRENT_QUESTIONS = int(os.environ.get("OZON_MAX_CONCURRENT_QUESTIONS", 16))  # вопросов, обрабатываемых одновременно
+REQUEST_TIMEOUT = float(os.environ.get("OZON_REQUEST_TIMEOUT", 60))  # ограничение времени на один вопрос, с
+SYSTEM_PROMPT = "You're answering questions about the Ozon API. Отвечай по русски."
+PACKING_STRATEGY = os.environ.get("OZON_PACKING_STRATEGY", "stop")  # "stop" - до первой не поместившейся части, "skip" - пропускать крупные
+CACHE_PATH = os.environ.get("OZON_CACHE_PATH")  # файл SQLite для кэша вопросов; не задан - кэш в памяти
+CACHE_TTL = float(os.environ.get("OZON_CACHE_TTL", DEFAULT_TTL))  # время жизни записи кэша, с
+CACHE_MAX_ENTRIES = int(os.environ.get("OZON_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))  # записей на уровне кэша
+HYBRID_SEARCH = os.environ.get("OZON_HYBRID_SEARCH", "1") != "0"  # объединять поиск по эмбедингам с BM25, если индекс построен
+RRF_K = 60  # сглаживание в reciprocal rank fusion
+BATCH_WINDOW = float(os.environ.get("OZON_BATCH_WINDOW_MS", 5)) / 1000  # сколько ждать попутных вопросов для общего запроса эмбедингов, с
+BATCH_MAX_QUERIES = int(os.environ.get("OZON_BATCH_MAX_QUERIES", 32))  # вопросов в одном пакете; 1 - без пакетов
+KB_RELOAD_INTERVAL = float(os.environ.get("OZON_KB_RELOAD_INTERVAL", 5))  # как часто проверять, не опубликована ли новая версия базы, с; 0 - не проверять
+KB_VERIFY = os.environ.get("OZON_KB_VERIFY", "0") != "0"  # сверять хэши базы при каждом открытии; опубликованную версию уже проверил publish_version
 
+_knowledge_base: KnowledgeBase | None = None
+_knowledge_base_version = None  # версия открытой базы (knowledge_base.version_of)
+_knowledge_base_checked = 0.0  # когда последний раз проверяли, не появилась ли новая версия
+_knowledge_base_lock = threading.Lock()  # первые вопросы приходят одновременно из пула потоков
 
+def get_knowledge_base() -> KnowledgeBase:
+    """Возвращает базу знаний, открывая ее один раз на процесс.
+
+    Не чаще KB_RELOAD_INTERVAL проверяет, не опубликована ли новая версия базы, и подменяет ее
+    без перезапуска. Вопросы в обработке держат ссылку на свою базу и дорабатывают со старой.
+    """
+    global _knowledge_base, _knowledge_base_version, _knowledge_base_checked
+    if _knowledge_base is None:
+        with _knowledge_base_lock:
+            if _knowledge_base is None:
+                with span("kb_load"):
+                    _knowledge_base_version = version_of(KB_PATH)
+                    # Открываем каталог той версии, которую запомнили, даже если ссылку уже переставили
+                    path = _knowledge_base_version[0] if _knowledge_base_version else KB_PATH
+                    _knowledge_base = KnowledgeBase.load(path, verify=KB_VERIFY)
+                _knowledge_base_checked = time.monotonic()
+    elif KB_RELOAD_INTERVAL and time.monotonic() - _knowledge_base_checked >= KB_RELOAD_INTERVAL:
+        # Новую версию загружает один поток, остальные пока отвечают по текущей
+        if _knowledge_base_lock.acquire(blocking=False):
+            try:
+                _knowledge_base_checked = time.monotonic()
+                version = version_of(KB_PATH)
+                if version is not None and version != _knowledge_base_version:
+                    with span("kb_reload"):
+                        kb = KnowledgeBase.load(version[0], verify=KB_VERIFY)
+                    _knowledge_base, _knowledge_base_version = kb, version
+                    metrics.inc("ozon_kb_reloads_total")
+            except KnowledgeBaseError as error:
+                # Версия еще дописывается или повреждена - остаемся на текущей, проверим позже
+                print(f"Не удалось открыть новую версию базы знаний: {error}")
+            finally:
+                _knowledge_base_lock.release()
+    return _knowledge_base
+
+_query_cache: QueryCache | None = None
+
+def get_query_cache() -> QueryCache:
+    """Возвращает кэш эмбедингов вопросов и готовых ответов (один на процесс)"""
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryCache(CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+    return _query_cache
+
+
+# DataFrame, уже приведенные к KnowledgeBase: id(df) -> (слабая ссылка на df, столбцы, база).
+# DataFrame не хэшируется, поэтому WeakKeyDictionary не подходит - запись удаляется вместе с df
+_converted_frames: dict[int, tuple[weakref.ref, tuple, KnowledgeBase]] = {}
+_converted_frames_lock = threading.Lock()
+
+def as_knowledge_base(df: pd.DataFrame | KnowledgeBase) -> KnowledgeBase:
+    """Приводит DataFrame со столбцами text и embedding к KnowledgeBase.
+
+    Результат запоминается для этого DataFrame: матрица собирается и нормируется один раз,
+    а не при каждом запросе. Замена столбцов или строк DataFrame сбрасывает запомненную базу.
+    """
+    if isinstance(df, KnowledgeBase):
+        return df
+    key = id(df)
+    # Объекты столбцов меняются при присваивании df["embedding"] = ... и при изменении числа строк
+    columns = tuple(df[column].to_numpy().__array_interface__["data"][0] for column in ("text", "embedding")) + (len(df),)
+    with _converted_frames_lock:
+        entry = _converted_frames.get(key)
+        if entry is not None and entry[0]() is df and entry[1] == columns:
+            return entry[2]
+    kb = KnowledgeBase(df["text"].tolist(), np.vstack(df["embedding"].to_numpy()))
+    with _converted_frames_lock:
+        _converted_frames[key] = (weakref.ref(df, lambda _, key=key: _converted_frames.pop(key, None)), columns, kb)
+    return kb
 
 # Функция поиска
 def strings_ranked_by_relatedness(
     query: str, # пользовательский запрос
-    df: pd.DataFrame, # DataFrame со столбцами text и embedding (база знаний)
-    relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y), # функция схожести, косинусное расстояние
-    top_n: int = 100 # выбор лучших n-результатов
+    df: pd.DataFrame | KnowledgeBase, # база знаний: KnowledgeBase или DataFrame со столбцами text и embedding
+    relatedness_fn=None, # функция схожести, по умолчанию косинусная (считается матрично)
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # "exact" - полный перебор, "ivf" - приближенный индекс, "auto" - индекс, если он построен
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
 ) -> tuple[list[str], list[float]]: # Функция возвращает кортеж двух списков, первый содержит строки, второй - числа с плавающей запятой
     """Возвращает строки и схожести, отсортированные от большего к меньшему"""
+    kb = as_knowledge_base(df)
+    check_search_mode(kb, search_mode, relatedness_fn)
 
-    # Отправляем в OpenAI API пользовательский запрос для токенизации
-    query_embedding_response = openai.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=query,
-    )
+    # Токенизированный пользовательский запрос (из кэша или от OpenAI API)
+    query_embedding = embed_query(query)
 
-    # Получен токенизированный пользовательский запрос
-    query_embedding = query_embedding_response.data[0].embedding
+    return rank_by_embedding(query_embedding, kb, relatedness_fn=relatedness_fn, top_n=top_n, search_mode=search_mode, nprobe=nprobe)
 
-    # Сравниваем пользовательский запрос с каждой токенизированной строкой DataFrame
-    strings_and_relatednesses = [
-        (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-        for i, row in df.iterrows()
-    ]
+def rank_by_embedding(
+    query_embedding, # эмбединг пользовательского запроса
+    kb: KnowledgeBase, # база знаний
+    relatedness_fn=None, # функция схожести, по умолчанию косинусная (считается матрично)
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # "exact" - полный перебор, "ivf" - приближенный индекс, "auto" - индекс, если он построен
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> tuple[list[str], list[float]]:
+    """Ранжирует базу знаний по уже полученному эмбедингу запроса"""
+    indices, relatednesses = ranked_indices(query_embedding, kb, relatedness_fn=relatedness_fn, top_n=top_n, search_mode=search_mode, nprobe=nprobe)
+    return [kb.texts[i] for i in indices], relatednesses.tolist()
 
-    # Сортируем по убыванию схожести полученный список
-    strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
+def check_search_mode(
+    kb: KnowledgeBase, # база знаний
+    search_mode: str, # режим поиска, см. strings_ranked_by_relatedness
+    relatedness_fn=None, # функция схожести; None - косинусная
+) -> None:
+    """Проверяет режим поиска до обращения к API эмбедингов, чтобы не платить за запрос, который не выполнить"""
+    if search_mode not in ("auto", "exact", "ivf"):
+        raise ValueError(f"Неизвестный режим поиска: {search_mode}")
+    if search_mode == "ivf" and relatedness_fn is not None:
+        raise ValueError("Приближенный индекс ищет только по косинусной схожести, relatedness_fn с ним не сочетается")
+    if search_mode == "ivf" and kb.ann_index is None:
+        raise ValueError("Приближенный индекс не построен для этой базы знаний")
 
-    # Преобразовываем наш список в кортеж из списков
-    strings, relatednesses = zip(*strings_and_relatednesses)
+def ranked_indices(
+    query_embedding, # эмбединг пользовательского запроса
+    kb: KnowledgeBase, # база знаний
+    relatedness_fn=None, # функция схожести, по умолчанию косинусная (считается матрично)
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # режим поиска, см. strings_ranked_by_relatedness
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> tuple[np.ndarray, np.ndarray]:
+    """Номера частей базы знаний и схожести, отсортированные от большего к меньшему"""
+    check_search_mode(kb, search_mode, relatedness_fn)
 
-    # Возвращаем n лучших результатов
-    return strings[:top_n], relatednesses[:top_n]
+    with span("search"):
+        if relatedness_fn is None and search_mode != "exact" and kb.ann_index is not None:
+            # Приближенный поиск только по nprobe ближайшим кластерам
+            indices, relatednesses = kb.ann_index.search(query_embedding, top_n=top_n, nprobe=nprobe, embeddings=kb.engine.matrix)
+        elif relatedness_fn is None:
+            # Косинусная схожесть со всей базой одним умножением матрицы на вектор и выбор top_n через argpartition
+            indices, relatednesses = kb.engine.search(query_embedding, top_n=top_n)
+        else:
+            indices, relatednesses = kb.engine.search_with(query_embedding, relatedness_fn, embeddings=kb.embeddings, top_n=top_n)
 
-def num_tokens(text: str, model: str = GPT_MODEL) -> int:
-    """Возвращает число токенов в строке для заданной модели"""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return indices, relatednesses
+
+def lexical_shortcut(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+) -> tuple[np.ndarray, np.ndarray] | None:
+    """Результаты одного лексического поиска, если запрос называет путь метода API, который есть в базе.
+
+    Эмбединг запроса для такого вопроса не нужен: части с этим путем и так будут первыми.
+    None - если пути в запросе нет или лексический индекс не построен.
+    """
+    lexical = kb.lexical_index if HYBRID_SEARCH else None
+    if lexical is None or not lexical.known_paths(query):
+        return None
+    metrics.inc("ozon_lexical_shortcuts_total")
+    with span("lexical"):
+        return lexical.search(query, top_n=top_n)
+
+def hybrid_ranked_indices(
+    query: str, # пользовательский запрос
+    query_embedding, # эмбединг пользовательского запроса
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # режим поиска, см. strings_ranked_by_relatedness
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> tuple[np.ndarray, np.ndarray]:
+    """Номера частей по эмбедингу и BM25, объединенные reciprocal rank fusion (оценки - RRF, не косинус).
+    Без лексического индекса - то же, что ranked_indices."""
+    indices, relatednesses = ranked_indices(query_embedding, kb, top_n=top_n, search_mode=search_mode, nprobe=nprobe)
+    return fuse_lexical(query, kb, indices, relatednesses, top_n=top_n)
+
+def fuse_lexical(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    indices: np.ndarray, # номера частей по эмбедингу
+    relatednesses: np.ndarray, # их схожести
+    top_n: int = 100, # выбор лучших n-результатов
+) -> tuple[np.ndarray, np.ndarray]:
+    """Объединяет результаты поиска по эмбедингу с BM25 (без лексического индекса возвращает их как есть)"""
+    lexical = kb.lexical_index if HYBRID_SEARCH else None
+    if lexical is None:
+        return indices, relatednesses
+    with span("lexical"):
+        lexical_indices, _ = lexical.search(query, top_n=top_n)
+    return reciprocal_rank_fusion([indices, lexical_indices], top_n=top_n, k=RRF_K)
+
+def retrieve(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # режим поиска, см. strings_ranked_by_relatedness
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> tuple[np.ndarray, np.ndarray]:
+    """Номера частей для ответа: по точному пути метода без обращения к API эмбедингов, иначе гибридный поиск"""
+    check_search_mode(kb, search_mode)
+    shortcut = lexical_shortcut(query, kb, top_n=top_n)
+    if shortcut is not None:
+        return shortcut
+    return hybrid_ranked_indices(query, embed_query(query), kb, top_n=top_n, search_mode=search_mode, nprobe=nprobe)
+
+def ranked_indices_batch(
+    query_embeddings: np.ndarray, # эмбединги запросов (m, dim)
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # режим поиска, см. strings_ranked_by_relatedness
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Как ranked_indices для пачки запросов: при полном переборе - одно умножение матрицы базы на матрицу запросов"""
+    check_search_mode(kb, search_mode)
+    if search_mode != "exact" and kb.ann_index is not None:
+        return [ranked_indices(query_embedding, kb, top_n=top_n, search_mode=search_mode, nprobe=nprobe) for query_embedding in query_embeddings]
+    with span("search"):
+        indices, relatednesses = kb.engine.search_batch(query_embeddings, top_n=top_n)
+    return list(zip(indices, relatednesses))
+
+def embed_query(query: str) -> np.ndarray:
+    """Эмбединг пользовательского запроса: из кэша или запросом к OpenAI API"""
+    cache = get_query_cache()
+    query_embedding = cache.get_embedding(query, EMBEDDING_MODEL)
+    if query_embedding is None:
+        # Отправляем в OpenAI API пользовательский запрос для токенизации
+        with span("embedding"):
+            query_embedding_response = openai.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=query,
+            )
+        query_embedding = np.asarray(query_embedding_response.data[0].embedding, dtype=np.float32)
+        cache.set_embedding(query, EMBEDDING_MODEL, query_embedding)
+    return query_embedding
+
+def answer_cache_key(query: str, kb: KnowledgeBase, indices, model: str, token_budget: int, packing: str | None = None) -> str:
+    """Ключ готового ответа: вопрос, найденные части, модель, параметры упаковки и версия базы знаний"""
+    cache = get_query_cache()
+    cache.check_fingerprint(kb.fingerprint)
+    return cache.answer_key(query, indices, model, token_budget, kb.fingerprint, PACKING_STRATEGY if packing is None else packing)
+
+def chunk_token_counts(kb: KnowledgeBase, indices, model: str = GPT_MODEL) -> list[int] | None:
+    """Число токенов найденных частей, посчитанное при сборке базы, если оно в кодировке модели"""
+    if kb.token_counts is None:
+        return None
+    try:
+        if tiktoken.encoding_name_for_model(model) != kb.token_encoding:
+            return None
+    except KeyError:
+        return None
+    return kb.token_counts[indices].tolist()
+
+def observe_usage(response) -> None:
+    """Учитывает ответ модели в метриках: число токенов ответа по данным API (если сервер его вернул).
+    Для потокового ответа передается последняя часть потока - usage приходит в ней (stream_options)"""
+    metrics.inc("ozon_answers_total", source="model")
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.observe("ozon_completion_tokens", usage.completion_tokens, buckets=TOKEN_BUCKETS)
 
 # Функция формирования запроса к chatGPT по пользовательскому вопросу и базе знаний
 def query_message(
     query: str, # пользовательский запрос
-    df: pd.DataFrame, # DataFrame со столбцами text и embedding (база знаний)
+    df: pd.DataFrame | KnowledgeBase, # база знаний: KnowledgeBase или DataFrame со столбцами text и embedding
     model: str, # модель
     token_budget: int # ограничение на число отсылаемых токенов в модель
 ) -> str:
     """Возвращает сообщение для GPT с соответствующими исходными текстами, извлеченными из фрейма данных (базы знаний)."""
-    strings, relatednesses = strings_ranked_by_relatedness(query, df) # функция ранжирования базы знаний по пользовательскому запросу
-    # Шаблон инструкции для chatGPT
-    message = 'Use the following parts of the Ozon API documentation to answer the following question. If the answer is not found in the documentation, write "Я не смог найти ответ"'
-    # Шаблон для вопроса
-    question = f"\n\nQuestion: {query}"
-
-    # Добавляем к сообщению для chatGPT релевантные строки из базы знаний, пока не выйдем за допустимое число токенов
-    for string in strings:
-        next_article = f'\n\nParts of the Ozon API:\n"""\n{string}\n"""'
-        if (num_tokens(message + next_article + question, model=model) > token_budget):
-            break
-        else:
-            message += next_article
-    return message + question
+    kb = as_knowledge_base(df)
+    indices, relatednesses = retrieve(query, kb) # функция ранжирования базы знаний по пользовательскому запросу
+    return build_message(query, [kb.texts[i] for i in indices], model=model, token_budget=token_budget)
 
+# Шаблон инструкции для chatGPT
+INSTRUCTION = 'Use the following parts of the Ozon API documentation to answer the following question. If the answer is not found in the documentation, write "Я не смог найти ответ"'
+# Обертка каждой части базы знаний в сообщении
+ARTICLE_PREFIX = '\n\nParts of the Ozon API:\n"""\n'
+ARTICLE_SUFFIX = '\n"""'
 
-def ask(
+def build_message(
+    query: str, # пользовательский запрос
+    strings: list[str], # части базы знаний, от более к менее подходящим
+    model: str, # модель
+    token_budget: int, # ограничение на число отсылаемых токенов в модель
+    token_counts: list[int] | None = None, # число токенов каждой части, если посчитано заранее
+    packing: str | None = None, # "stop" или "skip", None - PACKING_STRATEGY
+) -> str:
+    """Собирает сообщение для GPT из вопроса и частей базы знаний в пределах token_budget.
+
+    Токены считаются по частям и суммируются, а не пересчитываются для всего растущего сообщения.
+    Готовое сообщение пересчитывается один раз: на стыках частей BPE может склеить токены иначе,
+    и если сумма разошлась с действительностью, последние части убираются.
+    При packing="skip" не поместившаяся часть пропускается, и заполнение продолжается следующими.
+    """
+    with span("packing"):
+        packing = PACKING_STRATEGY if packing is None else packing
+        if packing not in ("stop", "skip"):
+            raise ValueError(f"Неизвестная стратегия упаковки: {packing}")
+        # Шаблон для вопроса
+        question = f"\n\nQuestion: {query}"
+
+        used = num_tokens(INSTRUCTION, model=model) + num_tokens(question, model=model)
+        # Обертку считаем по частям: между ними стоит текст части, склеиваться они не будут
+        wrapper = num_tokens(ARTICLE_PREFIX, model=model) + num_tokens(ARTICLE_SUFFIX, model=model)
+        articles = []
+        # Добавляем к сообщению для chatGPT релевантные строки из базы знаний, пока не выйдем за допустимое число токенов
+        for i, string in enumerate(strings):
+            if token_budget - used <= wrapper:
+                break  # не поместится уже ни одна часть
+            tokens = wrapper + (token_counts[i] if token_counts is not None else num_tokens(string, model=model))
+            if used + tokens > token_budget:
+                if packing == "skip":
+                    continue
+                break
+            articles.append(ARTICLE_PREFIX + string + ARTICLE_SUFFIX)
+            used += tokens
+        message = INSTRUCTION + "".join(articles) + question
+        used = num_tokens(message, model=model)
+        while used > token_budget and articles:
+            articles.pop()
+            message = INSTRUCTION + "".join(articles) + question
+            used = num_tokens(message, model=model)
+        metrics.observe("ozon_prompt_tokens", used, buckets=TOKEN_BUCKETS)
+        return message
+
+
+def prepare_chat(
     query: str, # пользовательский запрос
-    df: pd.DataFrame, # DataFrame со столбцами text и embedding (база знаний)
+    df: pd.DataFrame | KnowledgeBase, # база знаний: KnowledgeBase или DataFrame со столбцами text и embedding
     model: str = GPT_MODEL, # модель
     token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
     print_message: bool = False, # нужно ли выводить сообщение перед отправкой
-) -> str:
-    """Отвечает на вопрос, используя GPT и базу знаний."""
+) -> tuple[str | None, str | None, list[dict] | None]:
+    """Ищет части базы знаний и готовит сообщения для GPT.
+
+    Возвращает ключ кэша ответа, готовый ответ из кэша (если есть) и сообщения для chat.completions.
+    """
+    kb = as_knowledge_base(df)
+    indices, relatednesses = retrieve(query, kb)
+
+    # Ответ на тот же вопрос по тем же частям базы уже мог быть получен. Для DataFrame
+    # кэш ответов не используется: у него нет постоянного отпечатка содержимого
+    cache_key = answer_cache_key(query, kb, indices, model, token_budget) if isinstance(df, KnowledgeBase) else None
+    if cache_key is not None:
+        cached_answer = get_query_cache().get_answer(cache_key)
+        if cached_answer is not None:
+            metrics.inc("ozon_answers_total", source="cache")
+            return cache_key, cached_answer, None
+
     # Формируем сообщение к chatGPT (функция выше)
-    message = query_message(query, df, model=model, token_budget=token_budget)
+    message = build_message(query, [kb.texts[i] for i in indices], model=model, token_budget=token_budget, token_counts=chunk_token_counts(kb, indices, model))
     # Если параметр True, то выводим сообщение
     if print_message:
         print(message)
     messages = [
-        {"role": "system", "content": "You're answering questions about the Ozon API. Отвечай по русски."},
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": message},
     ]
-    response = openai.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0 # гиперпараметр степени случайности при генерации текста. Влияет на то, как модель выбирает следующее слово в последовательности.
-    )
+    return cache_key, None, messages
+
+def ask(
+    query: str, # пользовательский запрос
+    df: pd.DataFrame | KnowledgeBase, # база знаний: KnowledgeBase или DataFrame со столбцами text и embedding
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+) -> str:
+    """Отвечает на вопрос, используя GPT и базу знаний."""
+    cache_key, cached_answer, messages = prepare_chat(query, df, model=model, token_budget=token_budget, print_message=print_message)
+    if cached_answer is not None:
+        return cached_answer
+    with span("completion"):
+        response = openai.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0 # гиперпараметр степени случайности при генерации текста. Влияет на то, как модель выбирает следующее слово в последовательности.
+        )
+    observe_usage(response)
     response_message = response.choices[0].message.content
+    if cache_key is not None:
+        get_query_cache().set_answer(cache_key, response_message)
     return response_message
 
 def ask_on_ozon_api(
@@ -107,14 +420,357 @@ def ask_on_ozon_api(
     print_message: bool = False, # нужно ли выводить сообщение перед отправкой
 ) -> str:
     """Запрос по документации к API Ozon"""
-    embeddings_path = "embeddings.csv"
+    # База знаний открывается один раз, дальше используется уже загруженная
+    with span("total"):
+        kb = get_knowledge_base()
+
+        return ask(query=query,df=kb,model=model,token_budget=token_budget,print_message=print_message)
+
+def ask_stream(
+    query: str, # пользовательский запрос
+    df: pd.DataFrame | KnowledgeBase, # база знаний: KnowledgeBase или DataFrame со столбцами text и embedding
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+):
+    """Как ask, но отдает ответ по частям по мере генерации (stream=True)."""
+    cache_key, cached_answer, messages = prepare_chat(query, df, model=model, token_budget=token_budget, print_message=print_message)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    # Стадия completion - только ожидание модели: пока получатель показывает часть, время не идет
+    completion = StageTimer("completion")
+    parts = []
+    last_chunk = None  # последняя часть потока, в ней usage
+    try:
+        with completion.measure():
+            stream = openai.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+        while True:
+            with completion.measure():
+                chunk = next(stream, None)
+            if chunk is None:
+                break
+            last_chunk = chunk
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not parts:
+                    metrics.observe("ozon_stage_seconds", completion.elapsed, stage="first_token")
+                parts.append(delta)
+                yield delta
+    finally:
+        completion.observe()
+    observe_usage(last_chunk)
+    if cache_key is not None:
+        get_query_cache().set_answer(cache_key, "".join(parts))
+
 
-    df = pd.read_csv(embeddings_path)
+# Асинхронный путь для бота: сетевые вызовы через AsyncOpenAI, расчеты на CPU - в пуле потоков,
+# чтобы цикл событий aiogram не блокировался, пока один пользователь ждет ответа
 
-    # Конвертируем наши эмбединги из строк в списки
-    df['embedding'] = df['embedding'].apply(ast.literal_eval)
+_question_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def _question_semaphore() -> asyncio.Semaphore:
+    """Семафор ограничения одновременно обрабатываемых вопросов (свой для каждого цикла событий)"""
+    loop = asyncio.get_running_loop()
+    if loop not in _question_semaphores:
+        _question_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_QUESTIONS)
+    return _question_semaphores[loop]
+
+async def _run_in_executor(fn, *args, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков по умолчанию (с контекстом вызывающей корутины - для трассы запроса)"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args, **kwargs))
+
+async def _cache_call(fn, *args):
+    """Обращение к кэшу вопросов из цикла событий: кэш в памяти - сразу, SQLite - в пуле потоков,
+    чтобы чтение и запись на диск не останавливали остальные чаты"""
+    if get_query_cache().path is None:
+        return fn(*args)
+    return await _run_in_executor(fn, *args)
+
+async def get_knowledge_base_async() -> KnowledgeBase:
+    """Асинхронный вариант get_knowledge_base: загрузка новой версии базы идет
+    в пуле потоков и не останавливает цикл событий"""
+    return await _run_in_executor(get_knowledge_base)
+
+async def strings_ranked_by_relatedness_async(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+    search_mode: str = "auto", # режим поиска, см. strings_ranked_by_relatedness
+    nprobe: int = 8, # число просматриваемых кластеров IVF-индекса
+) -> tuple[list[str], list[float]]:
+    """Асинхронный вариант strings_ranked_by_relatedness"""
+    # Проверка в пуле: режим "ivf" загружает приближенный индекс с диска
+    await _run_in_executor(check_search_mode, kb, search_mode)
+    query_embedding = await embed_query_async(query)
+    return await _run_in_executor(rank_by_embedding, query_embedding, kb, top_n=top_n, search_mode=search_mode, nprobe=nprobe)
+
+async def embed_query_async(query: str) -> np.ndarray:
+    """Асинхронный вариант embed_query"""
+    cache = get_query_cache()
+    query_embedding = await _cache_call(cache.get_embedding, query, EMBEDDING_MODEL)
+    if query_embedding is None:
+        with span("embedding"):
+            query_embedding_response = await async_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=query,
+            )
+        query_embedding = np.asarray(query_embedding_response.data[0].embedding, dtype=np.float32)
+        await _cache_call(cache.set_embedding, query, EMBEDDING_MODEL, query_embedding)
+    return query_embedding
+
+async def retrieve_async(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    top_n: int = 100, # выбор лучших n-результатов
+) -> tuple[np.ndarray, np.ndarray]:
+    """Асинхронный вариант retrieve"""
+    shortcut = await _run_in_executor(lexical_shortcut, query, kb, top_n=top_n)
+    if shortcut is not None:
+        return shortcut
+    if BATCH_MAX_QUERIES > 1:
+        # Эмбединг и поиск по базе - вместе с вопросами, пришедшими из других чатов в то же окно
+        with span("batched_search"):
+            indices, relatednesses = await _query_batcher().submit((query, kb, top_n))
+        return await _run_in_executor(fuse_lexical, query, kb, indices, relatednesses, top_n=top_n)
+    query_embedding = await embed_query_async(query)
+    return await _run_in_executor(hybrid_ranked_indices, query, query_embedding, kb, top_n=top_n)
+
+_query_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, MicroBatcher]" = weakref.WeakKeyDictionary()
+
+def _query_batcher() -> MicroBatcher:
+    """Пакетировщик вопросов (свой для каждого цикла событий)"""
+    loop = asyncio.get_running_loop()
+    if loop not in _query_batchers:
+        _query_batchers[loop] = MicroBatcher(_search_batch_async, window=BATCH_WINDOW, max_batch=BATCH_MAX_QUERIES)
+    return _query_batchers[loop]
+
+def query_batch_stats() -> dict[str, float] | None:
+    """Заполнение пакетов вопросов и добавленная задержка в текущем цикле событий (None - пакетов еще не было)"""
+    batcher = _query_batchers.get(asyncio.get_running_loop())
+    return batcher.stats() if batcher is not None else None
+
+def _collect_metrics() -> list[tuple[str, str, dict, float]]:
+    """Метрики кэша и пакетов вопросов для экспорта (см. metrics.Metrics.add_collector)"""
+    collected = []
+    if _query_cache is not None:
+        stats = _query_cache.stats()
+        for level in ("embedding", "answer"):
+            hits, misses = stats[f"{level}_hits"], stats[f"{level}_misses"]
+            collected.append(("ozon_cache_hits_total", "counter", {"level": level}, hits))
+            collected.append(("ozon_cache_misses_total", "counter", {"level": level}, misses))
+            collected.append(("ozon_cache_hit_ratio", "gauge", {"level": level}, hits / max(hits + misses, 1)))
+    batchers = list(_query_batchers.values())
+    if batchers:
+        # Пакетировщик свой у каждого цикла событий - суммируем по всем, чтобы у каждой метрики была одна серия
+        queries = sum(batcher.items for batcher in batchers)
+        batches = sum(batcher.batches for batcher in batchers)
+        capacity = sum(batcher.batches * batcher.max_batch for batcher in batchers)
+        delay_total = sum(batcher.queue_delay_total for batcher in batchers)
+        collected.append(("ozon_batch_queries_total", "counter", {}, queries))
+        collected.append(("ozon_batches_total", "counter", {}, batches))
+        collected.append(("ozon_batch_mean_size", "gauge", {}, queries / max(batches, 1)))
+        collected.append(("ozon_batch_fill_ratio", "gauge", {}, queries / max(capacity, 1)))
+        collected.append(("ozon_batch_mean_queue_delay_seconds", "gauge", {}, delay_total / max(queries, 1)))
+        collected.append(("ozon_batch_max_queue_delay_seconds", "gauge", {}, max(batcher.queue_delay_max for batcher in batchers)))
+    return collected
+
+metrics.add_collector(_collect_metrics)
+
+async def _search_batch_async(items: list[tuple[str, KnowledgeBase, int]]) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Обрабатывает пакет вопросов: один запрос эмбедингов и одно умножение матриц на каждую базу знаний"""
+    query_embeddings = await embed_queries_async([query for query, _, _ in items])
+    results = [None] * len(items)
+    groups: dict[int, list[int]] = {}
+    for i, (_, kb, _) in enumerate(items):
+        groups.setdefault(id(kb), []).append(i)
+    for positions in groups.values():
+        kb = items[positions[0]][1]
+        top_n = max(items[i][2] for i in positions)
+        ranked = await _run_in_executor(ranked_indices_batch, query_embeddings[positions], kb, top_n=top_n)
+        for i, (indices, relatednesses) in zip(positions, ranked):
+            results[i] = (indices[:items[i][2]], relatednesses[:items[i][2]])
+    return results
+
+async def embed_queries_async(queries: list[str]) -> np.ndarray:
+    """Эмбединги нескольких запросов: из кэша, остальные - одним запросом к OpenAI API"""
+    cache = get_query_cache()
+    embeddings = await _cache_call(lambda: [cache.get_embedding(query, EMBEDDING_MODEL) for query in queries])
+    missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+    if missing:
+        with span("embedding"):
+            response = await async_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=missing,
+            )
+        # Сервер не обязан сохранять порядок, сортируем по index
+        computed = {}
+        for query, item in zip(missing, sorted(response.data, key=lambda item: item.index)):
+            computed[query] = np.asarray(item.embedding, dtype=np.float32)
+        await _cache_call(lambda: [cache.set_embedding(query, EMBEDDING_MODEL, embedding) for query, embedding in computed.items()])
+        embeddings = [computed[query] if embedding is None else embedding for query, embedding in zip(queries, embeddings)]
+    return np.stack(embeddings)
+
+async def prepare_chat_async(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+) -> tuple[str, str | None, list[dict] | None]:
+    """Асинхронный вариант prepare_chat"""
+    indices, relatednesses = await retrieve_async(query, kb)
+
+    cache_key = await _cache_call(answer_cache_key, query, kb, indices, model, token_budget)
+    cached_answer = await _cache_call(get_query_cache().get_answer, cache_key)
+    if cached_answer is not None:
+        metrics.inc("ozon_answers_total", source="cache")
+        return cache_key, cached_answer, None
+
+    # Подсчет токенов tiktoken тоже занимает процессор - выносим из цикла событий
+    message = await _run_in_executor(
+        build_message, query, [kb.texts[i] for i in indices], model=model, token_budget=token_budget,
+        token_counts=chunk_token_counts(kb, indices, model),
+    )
+    if print_message:
+        print(message)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": message},
+    ]
+    return cache_key, None, messages
+
+async def ask_async(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+) -> str:
+    """Асинхронный вариант ask"""
+    cache_key, cached_answer, messages = await prepare_chat_async(query, kb, model=model, token_budget=token_budget, print_message=print_message)
+    if cached_answer is not None:
+        return cached_answer
+    with span("completion"):
+        response = await async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0
+        )
+    observe_usage(response)
+    response_message = response.choices[0].message.content
+    await _cache_call(get_query_cache().set_answer, cache_key, response_message)
+    return response_message
+
+async def ask_stream_async(
+    query: str, # пользовательский запрос
+    kb: KnowledgeBase, # база знаний
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+):
+    """Асинхронный вариант ask_stream: асинхронный итератор по частям ответа"""
+    cache_key, cached_answer, messages = await prepare_chat_async(query, kb, model=model, token_budget=token_budget, print_message=print_message)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+    # Стадия completion - только ожидание модели: пока получатель показывает часть, время не идет
+    completion = StageTimer("completion")
+    parts = []
+    last_chunk = None  # последняя часть потока, в ней usage
+    try:
+        with completion.measure():
+            stream = await async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+        while True:
+            with completion.measure():
+                chunk = await anext(stream, None)
+            if chunk is None:
+                break
+            last_chunk = chunk
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not parts:
+                    metrics.observe("ozon_stage_seconds", completion.elapsed, stage="first_token")
+                parts.append(delta)
+                yield delta
+    finally:
+        completion.observe()
+    observe_usage(last_chunk)
+    await _cache_call(get_query_cache().set_answer, cache_key, "".join(parts))
+
+async def ask_on_ozon_api_async(
+    query: str, # пользовательский запрос
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+    timeout: float | None = None, # ограничение времени, с; None - REQUEST_TIMEOUT
+) -> str:
+    """Асинхронный запрос по документации к API Ozon, не блокирующий цикл событий.
+
+    Не больше MAX_CONCURRENT_QUESTIONS вопросов обрабатываются одновременно, остальные ждут очереди.
+    Ограничение времени включает ожидание в очереди; при превышении выбрасывает asyncio.TimeoutError.
+    """
+    with span("total"):
+        async with asyncio.timeout(REQUEST_TIMEOUT if timeout is None else timeout):
+            async with _question_semaphore():
+                kb = await get_knowledge_base_async()
+                return await ask_async(query, kb, model=model, token_budget=token_budget, print_message=print_message)
+
+async def ask_on_ozon_api_stream(
+    query: str, # пользовательский запрос
+    model: str = GPT_MODEL, # модель
+    token_budget: int = 4096 - 500, # ограничение на число отсылаемых токенов в модель
+    print_message: bool = False, # нужно ли выводить сообщение перед отправкой
+    timeout: float | None = None, # ограничение времени на весь ответ, с; None - REQUEST_TIMEOUT
+):
+    """Потоковый вариант ask_on_ozon_api_async: асинхронный итератор по частям ответа.
 
-    return ask(query=query,df=df,model=model,token_budget=token_budget,print_message=print_message)
+    Ограничение времени действует на весь ответ вместе с ожиданием в очереди;
+    при превышении выбрасывает asyncio.TimeoutError.
+    """
+    # Как и completion, total не включает время получателя частей между yield
+    total = StageTimer("total")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (REQUEST_TIMEOUT if timeout is None else timeout)
+    semaphore = _question_semaphore()
+    try:
+        # asyncio.timeout нельзя держать через yield (отмена попала бы в код получателя частей),
+        # поэтому срок проверяется на каждом ожидании отдельно
+        with total.measure():
+            async with asyncio.timeout_at(deadline):
+                await semaphore.acquire()
+        try:
+            with total.measure():
+                async with asyncio.timeout_at(deadline):
+                    kb = await get_knowledge_base_async()
+            stream = ask_stream_async(query, kb, model=model, token_budget=token_budget, print_message=print_message)
+            try:
+                while True:
+                    try:
+                        with total.measure():
+                            delta = await asyncio.wait_for(anext(stream), timeout=max(0, deadline - loop.time()))
+                    except StopAsyncIteration:
+                        return
+                    yield delta
+            finally:
+                await stream.aclose()
+        finally:
+            semaphore.release()
+    finally:
+        total.observe()
 
 if __name__ == '__main__':
     print(ask_on_ozon_api('Какой метод получает инофрмацию о товарах?'))
\ No newline at end of file
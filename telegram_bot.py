@@ -1,13 +1,110 @@
 import os
 from aiogram import Bot, Dispatcher, types, Router
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 import asyncio
-from search_ask import ask_on_ozon_api
+import time
+from search_ask import ask_on_ozon_api_async, ask_on_ozon_api_stream, get_knowledge_base, get_knowledge_base_async
+from metrics import metrics, span, trace_request, start_http_server
+
+STREAM_ANSWERS = os.environ.get("OZON_STREAM_ANSWERS", "1") != "0"  # показывать ответ по мере генерации
+EDIT_INTERVAL = float(os.environ.get("OZON_EDIT_INTERVAL", 1.5))  # не чаще одного редактирования сообщения за столько секунд
+MESSAGE_LIMIT = 4096  # максимальная длина сообщения Telegram
+PLACEHOLDER = "⏳ Ищу ответ в документации..."
+EMPTY_ANSWER = "Модель вернула пустой ответ, попробуйте переформулировать вопрос."
+TIMEOUT_ANSWER = "Не удалось получить ответ вовремя, попробуйте повторить вопрос позже."
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get("OZON_ADMIN_IDS", "").split(",") if user_id.strip()}  # кому доступны /stats и /profile
+METRICS_PORT = int(os.environ.get("OZON_METRICS_PORT", 0))  # порт для /metrics в формате Prometheus; 0 - не запускать
+METRICS_HOST = os.environ.get("OZON_METRICS_HOST", "127.0.0.1")  # адрес для /metrics; 0.0.0.0 - доступен снаружи
+BOT_WORKERS = int(os.environ.get("OZON_BOT_WORKERS", 1))  # процессов, отвечающих на вопросы; 1 - все в одном процессе
+TELEGRAM_API_URL = os.environ.get("OZON_TELEGRAM_API_URL")  # свой сервер Bot API (telegram-bot-api); не задан - api.telegram.org
 
 # Создаем роутер
 router = Router()
 
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> tuple[str, str]:
+    """Делит текст на часть, помещающуюся в одно сообщение, и остаток (по переносу строки или пробелу)."""
+    if len(text) <= limit:
+        return text, ""
+    cut = max(text.rfind("\n", 0, limit), text.rfind(" ", 0, limit))
+    if cut < limit // 2:
+        cut = limit  # подходящего места разрыва нет - режем по лимиту
+    return text[:cut], text[cut:].lstrip()
+
+
+class MessageStreamer:
+    """Показывает ответ по мере генерации, редактируя сообщение-заглушку.
+
+    Редактирования не чаще EDIT_INTERVAL, чтобы не упираться в ограничения Telegram;
+    текст длиннее MESSAGE_LIMIT продолжается в следующих сообщениях.
+    """
+
+    def __init__(self, message: Message, edit_interval: float = EDIT_INTERVAL, limit: int = MESSAGE_LIMIT):
+        self.message = message  # сообщение, которое редактируем сейчас
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ""  # текст текущего сообщения
+        self._shown = None  # текст, который уже показан в текущем сообщении
+        self._last_edit = 0.0
+
+    async def feed(self, delta: str) -> None:
+        """Добавляет часть ответа; сообщение обновляется, если с прошлого обновления прошло достаточно времени."""
+        self.text += delta
+        if len(self.text) > self.limit or time.monotonic() - self._last_edit >= self.edit_interval:
+            await self.flush(final=False)
+
+    async def flush(self, final: bool = True) -> None:
+        """Показывает накопленный текст, переполнение отправляет следующими сообщениями.
+
+        При final=True (конец ответа) текст показывается обязательно, даже если придется подождать.
+        """
+        while len(self.text) > self.limit:
+            head, tail = split_message(self.text, self.limit)
+            # Заполненное сообщение больше не редактируется, поэтому его текст нужно показать целиком
+            await self._edit(head, wait=True)
+            self.message = await self._answer(tail[:self.limit])
+            self.text, self._shown = tail, tail[:self.limit]
+            self._last_edit = time.monotonic()
+        await self._edit(self.text, wait=final)
+
+    async def fail(self, text: str) -> None:
+        """Заменяет заглушку или недописанный ответ в текущем сообщении текстом ошибки."""
+        self.text = text
+        await self.flush()
+
+    async def _answer(self, text: str) -> Message:
+        """Следующее сообщение ответа; при превышении частоты отправки ждет, сколько попросит Telegram."""
+        while True:
+            try:
+                with span("telegram"):
+                    return await self.message.answer(text)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def _edit(self, text: str, wait: bool = False) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        try:
+            # Отдельная стадия: время Telegram не должно попадать в completion и total
+            with span("telegram"):
+                await self.message.edit_text(text)
+        except TelegramRetryAfter as e:
+            if wait:
+                await asyncio.sleep(e.retry_after)
+                return await self._edit(text, wait=True)
+            # Превысили частоту редактирований: текст покажем при следующем обновлении
+            self._last_edit = time.monotonic() + e.retry_after
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        self._shown = text
+        self._last_edit = time.monotonic()
+
 @router.message(Command("start"))
 async def cmd_start(message: Message) -> None:
     """Обработчик команды /start"""
@@ -16,28 +113,93 @@ async def cmd_start(message: Message) -> None:
 @router.message(Command("help"))
 async def cmd_help(message: Message) -> None:
     """Обработчик команды /help"""
+    kb = await get_knowledge_base_async()
     help_text = (
         "Информация о базе знаний:\n\n"
         "📚 Тематика:\n"
         "Этот бот является консультантом по API Ozon. Он поможет вам разобраться "
         "с методами и возможностями платформы.\n\n"
-        f"📊 Число записей в базе знаний: {len(df)}\n\n"
+        f"📊 Число записей в базе знаний: {len(kb)}\n\n"
         "💡 Примеры запросов:\n"
         "- Какой метод получает информацию о товарах?\n"
         "- Какие возможности есть у Seller API?\n"
         "- Могу ли я управлять рекламой с помощью этого API? Опиши основные способы."
     )
     await message.answer(help_text)
-    
+
+def is_admin(message: Message) -> bool:
+    """Отправитель сообщения - администратор из OZON_ADMIN_IDS"""
+    return message.from_user is not None and message.from_user.id in ADMIN_IDS
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message) -> None:
+    """Обработчик команды /stats: задержки по стадиям, токены и попадания в кэш (только для администраторов)"""
+    if not is_admin(message):
+        await message.answer("Команда доступна только администраторам.")
+        return
+    text = metrics.summary()
+    while text:
+        head, text = split_message(text)
+        await message.answer(head)
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message, command: CommandObject) -> None:
+    """Обработчик команды /profile <вопрос>: отвечает на вопрос и присылает трассу стадий и профиль cProfile"""
+    if not is_admin(message):
+        await message.answer("Команда доступна только администраторам.")
+        return
+    if not command.args:
+        await message.answer("Использование: /profile <вопрос>")
+        return
+    with trace_request(profile=True) as trace:
+        await answer_question(message, command.args)
+    text = trace.report()
+    while text:
+        head, text = split_message(text)
+        await message.answer(head)
+
+async def answer_question(message: Message, question: str) -> None:
+    """Отвечает на вопрос, сообщая пользователю об ошибках"""
+    streamer = None
+    try:
+        if STREAM_ANSWERS:
+            # Сразу отвечаем заглушкой и дописываем в нее ответ по мере генерации
+            with span("telegram"):
+                placeholder = await message.answer(PLACEHOLDER)
+            streamer = MessageStreamer(placeholder)
+            async for delta in ask_on_ozon_api_stream(question):
+                await streamer.feed(delta)
+            if not streamer.text.strip():
+                streamer.text = EMPTY_ANSWER  # иначе заглушка так и осталась бы в чате
+            await streamer.flush()
+        else:
+            # Передаем текст в асинхронную функцию ask: пока ждем ответа, бот обслуживает другие чаты
+            response = await ask_on_ozon_api_async(question)
+            await message.answer(response if response and response.strip() else EMPTY_ANSWER)
+    except asyncio.TimeoutError:
+        metrics.inc("ozon_errors_total", kind="timeout")
+        await report_error(message, streamer, TIMEOUT_ANSWER)
+    except Exception as e:
+        metrics.inc("ozon_errors_total", kind=type(e).__name__)
+        await report_error(message, streamer, f"Произошла ошибка: {str(e)}")
+
+async def report_error(message: Message, streamer: MessageStreamer | None, text: str) -> None:
+    """Показывает ошибку вместо заглушки или недописанного ответа, а без них - отдельным сообщением"""
+    if streamer is None:
+        await message.answer(text)
+    else:
+        await streamer.fail(text)
+
 @router.message()
 async def handle_text(message: Message) -> None:
     """Обработчик текстовых сообщений"""
-    try:
-        # Передаем текст в функцию ask
-        response = ask_on_ozon_api(message.text)
-        await message.answer(response)
-    except Exception as e:
-        await message.answer(f"Произошла ошибка: {str(e)}")
+    await answer_question(message, message.text)
+
+def create_bot(token: str) -> Bot:
+    """Бот с сессией к TELEGRAM_API_URL, если он задан"""
+    if TELEGRAM_API_URL:
+        return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(token=token)
 
 async def main() -> None:
     """Запуск бота"""
@@ -45,9 +207,21 @@ async def main() -> None:
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         raise ValueError("Токен бота не найден в переменных окружения!")
+
+    if BOT_WORKERS > 1:
+        # Этот процесс только получает обновления, отвечают рабочие процессы
+        from bot_workers import run_front
+        await run_front(token, BOT_WORKERS)
+        return
+
+    # Открываем базу знаний заранее, чтобы первый запрос не ждал загрузки
+    get_knowledge_base()
+
+    if METRICS_PORT:
+        await start_http_server(METRICS_PORT, METRICS_HOST)
     
     # Инициализация бота и диспетчера
-    bot = Bot(token=token)
+    bot = create_bot(token)
     dp = Dispatcher()
     dp.include_router(router)
     
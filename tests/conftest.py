@@ -0,0 +1,37 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+# search_ask создает клиентов OpenAI при импорте; в тестах запросы идут в заглушку
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def tiktoken_encoding():
+    """Кодировка tiktoken или None, если словарь не скачать (проверяется один раз: попытка скачивания долгая)."""
+    import search_ask
+    try:
+        result = search_ask.get_encoding()
+        result.encode("проверка")
+        return result
+    except Exception:
+        return None
+
+
+@pytest.fixture
+def encoding(monkeypatch, tiktoken_encoding):
+    """Кодировка для подсчета токенов: tiktoken, а без сети - регулярное выражение."""
+    if tiktoken_encoding is not None:
+        return tiktoken_encoding
+    import tokenizer
+    import search_ask
+    import make_embeding_from_docs
+    from bench_chunking import RegexEncoding
+    result = RegexEncoding()
+    for module in (tokenizer, search_ask, make_embeding_from_docs):
+        monkeypatch.setattr(module, "get_encoding", lambda model=None: result)
+    return result
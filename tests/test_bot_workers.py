@@ -0,0 +1,135 @@
+import os
+import time
+import signal
+import asyncio
+import threading
+import multiprocessing
+
+import numpy as np
+import pytest
+from aiohttp import web
+
+from knowledge_base import KnowledgeBase
+from openai_stub import start_stub
+
+CHAT = 10  # при двух рабочих чат 10 обслуживает рабочий 0
+
+
+class FakeTelegram:
+    """Сервер Bot API в фоновом потоке: getUpdates отдает добавленные обновления, sendMessage записывается.
+
+    Первый sendMessage не получает ответа, пока hold установлен: рабочий в этот момент занят вопросом.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.sent = []  # (chat_id, text) полученных sendMessage
+        self.hold = threading.Event()
+        self.hold.set()
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+        self.ready.wait(10)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        self.ready.set()
+        self.loop.run_forever()
+
+    def add_message(self, update_id: int, chat_id: int, text: str):
+        with self.lock:
+            self.updates.append({
+                "update_id": update_id,
+                "message": {"message_id": update_id, "date": 0, "text": text,
+                            "chat": {"id": chat_id, "type": "private"},
+                            "from": {"id": chat_id, "is_bot": False, "first_name": "user"}},
+            })
+
+    def answers(self, chat_id: int) -> list[str]:
+        with self.lock:
+            return [text for chat, text in self.sent if chat == chat_id]
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        if method == "getUpdates":
+            with self.lock:
+                updates, self.updates = self.updates, []
+            if not updates:
+                await asyncio.sleep(min(float(data.get("timeout", 0)), 0.2))
+            return web.json_response({"ok": True, "result": updates})
+        chat_id = int(data["chat_id"])
+        with self.lock:
+            self.sent.append((chat_id, data.get("text", "")))
+            first = len(self.sent) == 1
+        if first:
+            while self.hold.is_set():
+                await asyncio.sleep(0.05)
+        return web.json_response({"ok": True, "result": {
+            "message_id": 1000 + len(self.sent), "date": 0, "text": data.get("text", ""),
+            "chat": {"id": chat_id, "type": "private"},
+        }})
+
+
+def wait_for(condition, timeout: float = 60) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def worker_process(index: int):
+    return next(process for process in multiprocessing.active_children() if process.name == f"bot-worker-{index}")
+
+
+@pytest.fixture
+def environment(monkeypatch, tmp_path):
+    telegram = FakeTelegram()
+    stub, _, base_url = start_stub(dim=8)
+    kb_path = str(tmp_path / "knowledge_base")
+    KnowledgeBase([f"Метод /v1/method/{i}" for i in range(4)], np.eye(4, 8, dtype=np.float32),
+                  embedding_model="text-embedding-ada-002").save(kb_path)
+    # Рабочие процессы запускаются через spawn и получают настройки из переменных среды
+    for name, value in {"OZON_TELEGRAM_API_URL": telegram.url, "OPENAI_BASE_URL": base_url,
+                        "OZON_KB_PATH": kb_path, "OZON_STREAM_ANSWERS": "0"}.items():
+        monkeypatch.setenv(name, value)
+    import telegram_bot
+    monkeypatch.setattr(telegram_bot, "TELEGRAM_API_URL", telegram.url)
+    yield telegram
+    stub.shutdown()
+    telegram.loop.call_soon_threadsafe(telegram.loop.stop)
+
+
+def test_killed_worker_is_restarted_and_answers(environment):
+    from bot_workers import run_front
+
+    telegram = environment
+
+    async def run():
+        stop = asyncio.Event()
+        front = asyncio.create_task(run_front("1:test", workers=2, stop=stop))
+        try:
+            telegram.add_message(1, CHAT, "Первый вопрос")
+            # Рабочий отправляет ответ, но не дожидается подтверждения - вопрос еще в обработке
+            assert await asyncio.to_thread(wait_for, lambda: telegram.answers(CHAT))
+            os.kill(worker_process(0).pid, signal.SIGKILL)
+            telegram.hold.clear()
+            telegram.add_message(2, CHAT, "Второй вопрос")
+            # Перезапущенный рабочий заново отвечает на неподтвержденный первый вопрос и на второй
+            assert await asyncio.to_thread(wait_for, lambda: len(telegram.answers(CHAT)) >= 3)
+        finally:
+            stop.set()
+            await front
+
+    asyncio.run(run())
+    assert len(telegram.answers(CHAT)) == 3
@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+import make_embeding_from_docs as docs
+
+PIECES = ["метод", "/v2/product/info", "offer_id", "товар", "цена", "1234567", " ", "  ", " \n", "\n", "\n\n", ". ", ",", '"']
+
+
+def random_section(rng: random.Random) -> tuple[list[str], str]:
+    titles = [" ".join(rng.choice(PIECES[:6]) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(0, 3))]
+    text = "".join(rng.choice(PIECES) for _ in range(rng.randint(1, 600))).strip() or "текст"
+    return titles, text
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_chunks_fit_max_tokens_after_reencoding(encoding, seed):
+    rng = random.Random(seed)
+    section = random_section(rng)
+    max_tokens = rng.randint(8, 200)
+    overlap_tokens = rng.choice([0, 0, rng.randint(1, 10)])
+    chunks = docs.split_strings_from_subsection(section, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    assert chunks
+    for chunk in chunks:
+        assert len(encoding.encode(chunk)) <= max_tokens
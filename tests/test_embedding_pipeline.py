@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from openai import OpenAI
+
+from embedding_pipeline import EmbeddingCheckpoint, embed_texts, chunk_key
+from openai_stub import start_stub, fake_embedding
+
+MODEL = "text-embedding-ada-002"
+DIM = 16
+
+
+class FailingClient:
+    """Клиент, у которого запрос номер fail_on падает с ошибкой, после которой повторять нечего."""
+
+    def __init__(self, client, fail_on: int):
+        self.client = client
+        self.fail_on = fail_on
+        self.calls = 0
+
+    def with_options(self, **options):
+        self.client = self.client.with_options(**options)
+        return self
+
+    @property
+    def embeddings(self):
+        return self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.calls == self.fail_on:
+            raise RuntimeError("сбой пакета")
+        return self.client.embeddings.create(**kwargs)
+
+
+@pytest.fixture
+def stub():
+    server, state, base_url = start_stub(dim=DIM)
+    yield state, OpenAI(api_key="stub", base_url=base_url)
+    server.shutdown()
+
+
+def texts(n: int) -> list[str]:
+    return [f"Часть {i}: метод /v1/method/{i}" for i in range(n)]
+
+
+def expected(items: list[str]) -> np.ndarray:
+    return np.asarray([fake_embedding(text, DIM) for text in items], dtype=np.float32)
+
+
+def test_resume_from_checkpoint(stub, tmp_path):
+    state, client = stub
+    checkpoint = str(tmp_path / "checkpoint")
+    items = texts(10)
+    embed_texts(items[:6], client, MODEL, checkpoint_path=checkpoint, max_batch_items=2, progress=False)
+    assert state.inputs == 6
+
+    embeddings = embed_texts(items, client, MODEL, checkpoint_path=checkpoint, max_batch_items=2, progress=False)
+    # Повторный запуск отправляет только части, которых нет в контрольной точке
+    assert state.inputs == 10
+    np.testing.assert_allclose(embeddings, expected(items), atol=1e-6)
+
+
+def test_failed_batch_stops_queue_and_keeps_sent_batches(stub, tmp_path):
+    state, client = stub
+    checkpoint = str(tmp_path / "checkpoint")
+    items = texts(20)
+    failing = FailingClient(client, fail_on=3)
+    with pytest.raises(RuntimeError):
+        embed_texts(items, failing, MODEL, checkpoint_path=checkpoint, max_batch_items=2, max_concurrency=1,
+                    progress=False)
+    # Пакеты из очереди после сбоя не отправляются (один мог успеть уйти до отмены)
+    assert failing.calls <= 4
+    saved = EmbeddingCheckpoint(checkpoint, MODEL)
+    assert len(saved) == state.inputs >= 4
+    assert all(chunk_key(text, MODEL) in saved for text in items[:4])
+
+    sent_before = state.inputs
+    embeddings = embed_texts(items, client, MODEL, checkpoint_path=checkpoint, max_batch_items=2, progress=False)
+    # Оплаченные до сбоя пакеты взяты из контрольной точки, повторно не отправлены
+    assert state.inputs - sent_before == len(items) - len(saved)
+    np.testing.assert_allclose(embeddings, expected(items), atol=1e-6)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import make_embeding_from_docs
+from html_sections import sections_from_html, sections_from_file
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERFORMANCE_DOC = os.path.join(ROOT, "ozon docs", "performance.html")
+
+
+def legacy_sections(html: str, preheader: str = "API") -> list[list]:
+    return make_embeding_from_docs.all_section_with_text(html, preheader)
+
+
+@pytest.mark.skipif(not os.path.exists(PERFORMANCE_DOC), reason="нет ozon docs/performance.html")
+@pytest.mark.parametrize("block_size", [1 << 16, 97])  # маленький блок режет теги и сущности посередине
+def test_performance_doc_matches_beautifulsoup(block_size):
+    with open(PERFORMANCE_DOC, encoding="utf-8") as file:
+        expected = legacy_sections(file.read(), "Ozon Performance API")
+    sections = sections_from_file(PERFORMANCE_DOC, "Ozon Performance API", block_size=block_size)
+    assert len(sections) == len(expected) == 269
+    assert sections == expected
+
+
+@pytest.mark.parametrize("html", [
+    # пустые теги, в том числе записанные как <br/> и с лишним закрытием </br>
+    "<div><h1>Раздел</h1><p>до<br>после<img src='x.png'>конец</p><p>a<br/>b</br>c<hr>d</p></div>",
+    # незакрытые <li> и <td>
+    "<div><h2>Список</h2><ul><li>один<li>два<li>три</ul><table><tr><td>x<td>y<tr><td>z</table></div>",
+    # заголовок внутри вложенных div: внешние элементы разбираются по дочерним
+    "<body><h1>A</h1><p>вступление</p><div>до<section><div><h2>B</h2></div><p>текст B</p></section>после</div><p>хвост</p></body>",
+    # текст между тегами контейнера, комментарии и сущности
+    "<div><h1>A</h1>свободный текст<p>x &amp; y</p><!-- комментарий --><p>z</p></div>",
+])
+def test_edge_cases_match_beautifulsoup(html):
+    assert sections_from_html(html, "API") == legacy_sections(html)
+
+
+def test_nested_heading_starts_new_section():
+    html = "<body><h1>A</h1><div><p>раз</p><div><h2>B</h2><p>два</p></div></div></body>"
+    assert sections_from_html(html, "API") == [[["API", "A"], "раз"], [["API", "A", "B"], "два"]]
+
+
+def test_script_text_is_dropped():
+    # Намеренное отличие: get_text у отдельного <script> возвращает код, и старый разбор добавлял его в секцию
+    html = "<div><h1>A</h1><p>текст</p><script>var x = 1;</script><style>p {}</style></div>"
+    assert legacy_sections(html) == [[["API", "A"], "текст\nvar x = 1;\np {}"]]
+    sections = sections_from_html(html, "API")
+    assert "var x" not in sections[0][1] and "p {}" not in sections[0][1]
+    # Внутри других элементов скрипт пропускают оба разбора
+    html = "<div><h1>A</h1><p>до<script>var x = 1;</script>после</p></div>"
+    assert sections_from_html(html, "API") == legacy_sections(html) == [[["API", "A"], "до\nпосле"]]
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+
+from knowledge_base import KnowledgeBase, KnowledgeBaseError, EMBEDDINGS_FILE, TEXTS_FILE, TEXT_OFFSETS_FILE
+
+
+@pytest.mark.parametrize("name", [EMBEDDINGS_FILE, TEXTS_FILE, TEXT_OFFSETS_FILE])
+@pytest.mark.parametrize("cut", [0, 10, -1])  # пустой файл, обрыв заголовка, обрыв данных
+@pytest.mark.parametrize("mmap", [True, False])
+def test_truncated_file_is_knowledge_base_error(tmp_path, name, cut, mmap):
+    KnowledgeBase(["первая часть" * 10, "вторая часть" * 10], np.ones((2, 64), dtype=np.float32)).save(str(tmp_path))
+    path = os.path.join(tmp_path, name)
+    with open(path, "rb") as file:
+        data = file.read()
+    with open(path, "wb") as file:
+        file.write(data[:cut])
+    # make_embeding_from_docs пересобирает базу только при KnowledgeBaseError
+    with pytest.raises(KnowledgeBaseError):
+        KnowledgeBase.load(str(tmp_path), mmap=mmap)
+
+
+def test_publish_version_verifies_hashes_once(tmp_path):
+    from knowledge_base import new_version_path, publish_version, version_of
+
+    path = str(tmp_path / "kb")
+    first = new_version_path(path)
+    KnowledgeBase(["первая часть"], np.ones((1, 8), dtype=np.float32)).save(first)
+    publish_version(path, first)
+    broken = new_version_path(path)
+    KnowledgeBase(["вторая часть"], np.ones((1, 8), dtype=np.float32)).save(broken)
+    embeddings = np.load(os.path.join(broken, EMBEDDINGS_FILE), mmap_mode="r+")
+    embeddings[0, 0] = 2  # форма и тип те же, содержимое не совпадает с хэшем
+    embeddings.flush()
+    del embeddings
+    with pytest.raises(KnowledgeBaseError):
+        publish_version(path, broken)
+    assert version_of(path)[0] == os.path.realpath(first)
+    # Процессы бота открывают опубликованные версии без сверки хэшей: проверяются только форма и тип
+    assert KnowledgeBase.load(broken, verify=False).embeddings[0, 0] == 2
@@ -0,0 +1,30 @@
+import threading
+
+from metrics import span, trace_request
+
+
+def test_overlapping_profiles_in_threads():
+    # С Python 3.12 второй одновременный cProfile в процессе выбрасывает ValueError
+    inside = threading.Barrier(2)
+    traces, errors = [], []
+
+    def profiled_request():
+        try:
+            with trace_request(profile=True) as trace:
+                with span("search"):
+                    inside.wait(timeout=5)
+                    sum(range(10000))
+                    inside.wait(timeout=5)
+            traces.append(trace)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=profiled_request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    # Обе стадии замерены, профиль - у той, что заняла профилировщик первой
+    assert [len(trace.spans) for trace in traces] == [1, 1]
+    assert sum(trace._stats is not None for trace in traces) == 1
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from query_batcher import MicroBatcher
+
+
+class Recorder:
+    """process_batch, запоминающий пакеты; результат - удвоенный запрос."""
+
+    def __init__(self, error: Exception | None = None, delay: float = 0.0):
+        self.batches = []
+        self.error = error
+        self.delay = delay
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return [item * 2 for item in items]
+
+
+def test_concurrent_submits_share_one_batch():
+    process = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(process, window=0.05, max_batch=32)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+
+    assert asyncio.run(run()) == [i * 2 for i in range(10)]
+    assert process.batches == [list(range(10))]
+
+
+def test_full_batch_is_sent_without_waiting_for_window():
+    process = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(process, window=10, max_batch=4)
+        tasks = [asyncio.create_task(batcher.submit(i)) for i in range(5)]
+        # Окно 10 с: дождаться могут только запросы заполненного пакета
+        done, pending = await asyncio.wait(tasks, timeout=0.2)
+        for task in pending:
+            task.cancel()
+        return [task.result() for task in tasks[:4] if task in done], len(pending)
+
+    results, pending = asyncio.run(run())
+    assert results == [0, 2, 4, 6]
+    assert pending == 1
+    assert process.batches == [[0, 1, 2, 3]]
+
+
+def test_batch_error_reaches_every_waiter():
+    process = Recorder(error=ValueError("пакет не обработан"))
+
+    async def run():
+        batcher = MicroBatcher(process, window=0.01, max_batch=32)
+        return await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(process.batches) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelled_waiter_is_not_sent():
+    process = Recorder()
+
+    async def run():
+        batcher = MicroBatcher(process, window=0.05, max_batch=32)
+        cancelled = asyncio.create_task(batcher.submit("отменен"))
+        kept = asyncio.create_task(batcher.submit("ждет"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await kept, batcher.stats()
+
+    result, stats = asyncio.run(run())
+    assert result == "ждетждет"
+    assert process.batches == [["ждет"]]
+    assert stats["queries"] == 1
+
+
+def test_batch_metrics_are_aggregated_across_event_loops(monkeypatch):
+    import weakref
+    import search_ask
+    from metrics import metrics
+
+    loops = [asyncio.new_event_loop() for _ in range(2)]
+    batchers = weakref.WeakKeyDictionary()
+    for loop, (items, batches, delay) in zip(loops, [(6, 2, 0.03), (2, 2, 0.01)]):
+        batcher = batchers[loop] = MicroBatcher(Recorder(), max_batch=4)
+        batcher.items, batcher.batches, batcher.queue_delay_total, batcher.queue_delay_max = items, batches, delay, delay
+    monkeypatch.setattr(search_ask, "_query_batchers", batchers)
+    try:
+        lines = [line for line in metrics.render_prometheus().splitlines() if line.startswith("ozon_batch")]
+    finally:
+        for loop in loops:
+            loop.close()
+    values = dict(line.split() for line in lines)
+    assert len(values) == len(lines)  # по одной серии на метрику
+    assert float(values["ozon_batch_queries_total"]) == 8
+    assert float(values["ozon_batch_fill_ratio"]) == pytest.approx(8 / 16)
+    assert float(values["ozon_batch_mean_queue_delay_seconds"]) == pytest.approx(0.04 / 8)
+    assert float(values["ozon_batch_max_queue_delay_seconds"]) == pytest.approx(0.03)
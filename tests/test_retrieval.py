@@ -0,0 +1,24 @@
+import numpy as np
+
+from retrieval import RetrievalEngine, row_norms
+
+
+def test_row_norms_match_linalg_across_blocks():
+    matrix = np.random.default_rng(0).standard_normal((1000, 64), dtype=np.float32)
+    # Блок меньше матрицы, последний блок неполный
+    norms = row_norms(matrix, block_bytes=64 * 4 * 300)
+    np.testing.assert_allclose(norms, np.linalg.norm(matrix, axis=1), rtol=1e-5)
+
+
+def test_normalized_memmap_is_not_copied(tmp_path):
+    matrix = np.random.default_rng(0).standard_normal((100, 64), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.save(tmp_path / "embeddings.npy", matrix)
+    embeddings = np.load(tmp_path / "embeddings.npy", mmap_mode="r")
+    assert np.shares_memory(RetrievalEngine(embeddings).matrix, embeddings)
+
+
+def test_unnormalized_rows_are_normalized():
+    matrix = np.array([[3, 4], [0, 0], [1, 0]], dtype=np.float32)
+    engine = RetrievalEngine(matrix)
+    np.testing.assert_allclose(np.linalg.norm(engine.matrix, axis=1), [1, 0, 1])
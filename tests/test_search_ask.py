@@ -0,0 +1,233 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import search_ask
+
+
+@pytest.fixture
+def busy_queue(monkeypatch):
+    """Все места для одновременных вопросов заняты."""
+    semaphore = asyncio.Semaphore(0)
+    monkeypatch.setattr(search_ask, "_question_semaphore", lambda: semaphore)
+
+
+async def read_stream(query: str, timeout: float) -> list[str]:
+    return [delta async for delta in search_ask.ask_on_ozon_api_stream(query, timeout=timeout)]
+
+
+@pytest.mark.parametrize("ask", [search_ask.ask_on_ozon_api_async, read_stream])
+def test_timeout_includes_waiting_in_queue(busy_queue, ask):
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await ask("вопрос", timeout=0.05)
+        return loop.time() - started
+
+    assert asyncio.run(run()) < 1
+
+
+def test_sqlite_cache_is_used_off_the_event_loop(monkeypatch, tmp_path):
+    import threading
+    from openai import AsyncOpenAI
+    from answer_cache import QueryCache
+    from openai_stub import start_stub
+
+    server, _, base_url = start_stub(dim=8)
+    monkeypatch.setattr(search_ask, "async_client", AsyncOpenAI(api_key="stub", base_url=base_url))
+    cache = QueryCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(search_ask, "_query_cache", cache)
+    threads = []
+    for level in (cache.embeddings, cache.answers):
+        for name in ("get", "set"):
+            method = getattr(level, name)
+            monkeypatch.setattr(level, name, lambda *args, method=method: threads.append(threading.current_thread()) or method(*args))
+
+    async def run():
+        await search_ask.embed_query_async("вопрос")
+        await search_ask.embed_queries_async(["вопрос", "другой вопрос"])
+        return threading.current_thread()
+
+    try:
+        loop_thread = asyncio.run(run())
+    finally:
+        server.shutdown()
+    assert threads and loop_thread not in threads
+
+
+@pytest.mark.parametrize("packing", ["stop", "skip"])
+@pytest.mark.parametrize("seed", range(20))
+def test_message_fits_budget_when_counts_are_understated(encoding, packing, seed):
+    import random
+
+    rng = random.Random(seed)
+    words = ["метод", "/v2/product/info", "offer_id", " ", "\n", '"""', "товар", "..."]
+    strings = ["".join(rng.choice(words) for _ in range(rng.randint(1, 200))) for _ in range(30)]
+    # Заранее посчитанное число токенов меньше настоящего, как при склейке токенов на стыках
+    counts = [max(len(encoding.encode(string)) - rng.randint(0, 20), 0) for string in strings]
+    budget = rng.randint(200, 2000)
+    message = search_ask.build_message("вопрос", strings, model=search_ask.GPT_MODEL, token_budget=budget,
+                                       token_counts=counts, packing=packing)
+    assert len(encoding.encode(message)) <= budget
+
+
+def test_packing_strategy_is_part_of_answer_key():
+    from answer_cache import QueryCache
+
+    keys = {QueryCache.answer_key("вопрос", [1, 2], "model", 100, "fingerprint", packing) for packing in ("stop", "skip")}
+    assert len(keys) == 2
+
+
+PATH_QUESTION = "Что возвращает /v2/product/info?"
+HYBRID_TEXTS = [
+    "Метод /v1/warehouse/list возвращает список складов.",
+    "Остатки на складах FBO и FBS.",
+    "Цены и скидки на товары.",
+    "Метод /v2/product/info возвращает описание товара по offer_id.",
+    "Отчеты о продажах за период.",
+]
+PATH_CHUNK = 3
+
+
+@pytest.fixture
+def hybrid_kb(tmp_path):
+    """База знаний из HYBRID_TEXTS с BM25-индексом; эмбединг i-й части - i-й единичный вектор."""
+    from knowledge_base import KnowledgeBase
+    from lexical_index import LexicalIndex
+
+    embeddings = np.eye(len(HYBRID_TEXTS), dtype=np.float32)
+    kb = KnowledgeBase(HYBRID_TEXTS, embeddings, embedding_model=search_ask.EMBEDDING_MODEL)
+    kb.save(str(tmp_path))
+    LexicalIndex.build(kb.texts, fingerprint=kb.fingerprint).save(str(tmp_path))
+    kb = KnowledgeBase.load(str(tmp_path))
+    assert kb.lexical_index is not None
+    return kb
+
+
+@pytest.fixture
+def embeddings_stub(monkeypatch):
+    """Заглушка API эмбедингов с пустым кэшем запросов; возвращает счетчики заглушки."""
+    from openai import OpenAI, AsyncOpenAI
+    from answer_cache import QueryCache
+    from openai_stub import start_stub
+
+    server, state, base_url = start_stub(dim=len(HYBRID_TEXTS))
+    monkeypatch.setattr(search_ask, "openai", OpenAI(api_key="stub", base_url=base_url))
+    monkeypatch.setattr(search_ask, "async_client", AsyncOpenAI(api_key="stub", base_url=base_url))
+    monkeypatch.setattr(search_ask, "_query_cache", QueryCache())
+    yield state
+    server.shutdown()
+
+
+def test_known_path_skips_embedding_request(hybrid_kb, embeddings_stub):
+    indices, _ = search_ask.retrieve(PATH_QUESTION, hybrid_kb, top_n=3)
+    assert indices[0] == PATH_CHUNK
+    assert embeddings_stub.requests == 0
+    indices, _ = asyncio.run(search_ask.retrieve_async(PATH_QUESTION, hybrid_kb, top_n=3))
+    assert indices[0] == PATH_CHUNK
+    assert embeddings_stub.requests == 0
+    # Вопрос без пути идет за эмбедингом как обычно
+    search_ask.retrieve("Как узнать остатки на складах?", hybrid_kb, top_n=3)
+    assert embeddings_stub.requests == 1
+
+
+def test_rrf_puts_path_chunk_first(hybrid_kb):
+    # По вектору часть с путем третья, первая - часть без общих с вопросом слов
+    query_embedding = np.array([0.3, 1, 0.5, 0.4, 0], dtype=np.float32)
+    query_embedding /= np.linalg.norm(query_embedding)
+    vector_indices, _ = search_ask.ranked_indices(query_embedding, hybrid_kb, top_n=len(HYBRID_TEXTS))
+    assert list(vector_indices[:3]) == [1, 2, PATH_CHUNK]
+    indices, _ = search_ask.hybrid_ranked_indices(PATH_QUESTION, query_embedding, hybrid_kb, top_n=len(HYBRID_TEXTS))
+    assert indices[0] == PATH_CHUNK
+
+
+def test_stream_stages_exclude_consumer_time_and_use_reported_usage(monkeypatch, encoding):
+    from openai import AsyncOpenAI
+    from answer_cache import QueryCache
+    from knowledge_base import KnowledgeBase
+    from metrics import metrics, trace_request
+    from openai_stub import start_stub
+
+    server, _, base_url = start_stub(dim=len(HYBRID_TEXTS), answer_words=10)
+    monkeypatch.setattr(search_ask, "async_client", AsyncOpenAI(api_key="stub", base_url=base_url))
+    monkeypatch.setattr(search_ask, "_query_cache", QueryCache())
+    kb = KnowledgeBase(HYBRID_TEXTS, np.eye(len(HYBRID_TEXTS), dtype=np.float32), embedding_model=search_ask.EMBEDDING_MODEL)
+
+    async def knowledge_base():
+        return kb
+
+    monkeypatch.setattr(search_ask, "get_knowledge_base_async", knowledge_base)
+    consumer_delay = 0.05  # как редактирование сообщения в Telegram после каждой части
+
+    async def run():
+        parts = []
+        with trace_request() as trace:
+            async for delta in search_ask.ask_on_ozon_api_stream("Как узнать остатки на складах?"):
+                parts.append(delta)
+                await asyncio.sleep(consumer_delay)
+        return parts, trace
+
+    tokens = metrics.histograms.get("ozon_completion_tokens", {}).get(())
+    tokens_before = (tokens.count, tokens.sum) if tokens is not None else (0, 0)
+    try:
+        parts, trace = asyncio.run(run())
+    finally:
+        server.shutdown()
+    stages = dict(trace.spans)
+    consumer = consumer_delay * len(parts)
+    assert consumer > 0.5
+    assert stages["completion"] < consumer / 2
+    assert stages["total"] < consumer / 2
+    # Число токенов - из usage последней части потока, а не число частей
+    tokens = metrics.histograms["ozon_completion_tokens"][()]
+    assert (tokens.count, tokens.sum) == (tokens_before[0] + 1, tokens_before[1] + len("".join(parts)) // 4)
+
+
+def test_hot_reload_keeps_in_flight_question_on_old_version(monkeypatch, encoding, tmp_path):
+    import time
+    from openai import AsyncOpenAI
+    from answer_cache import QueryCache
+    from knowledge_base import KnowledgeBase, new_version_path, publish_version
+    from openai_stub import start_stub
+
+    dim = 8
+    path = str(tmp_path / "knowledge_base")
+
+    def publish(texts):
+        version = new_version_path(path)
+        embeddings = np.random.default_rng(len(texts)).standard_normal((len(texts), dim)).astype(np.float32)
+        KnowledgeBase(texts, embeddings, embedding_model=search_ask.EMBEDDING_MODEL).save(version)
+        publish_version(path, version, keep=0)  # старая версия удаляется с диска сразу
+
+    publish([f"старая версия, часть {i}" for i in range(3)])
+    server, _, base_url = start_stub(dim=dim, latency=0.3)  # вопрос ждет эмбединг, пока публикуется новая версия
+    monkeypatch.setattr(search_ask, "async_client", AsyncOpenAI(api_key="stub", base_url=base_url))
+    monkeypatch.setattr(search_ask, "_query_cache", QueryCache())
+    monkeypatch.setattr(search_ask, "KB_PATH", path)
+    monkeypatch.setattr(search_ask, "KB_RELOAD_INTERVAL", 0.01)
+    monkeypatch.setattr(search_ask, "_knowledge_base", None)
+    monkeypatch.setattr(search_ask, "_knowledge_base_version", None)
+
+    async def question():
+        kb = await search_ask.get_knowledge_base_async()
+        _, _, messages = await search_ask.prepare_chat_async("Что в базе знаний?", kb)
+        return messages[-1]["content"]
+
+    async def run():
+        in_flight = asyncio.create_task(question())
+        await asyncio.sleep(0.1)
+        assert not in_flight.done()  # база открыта, вопрос ждет эмбединг
+        publish([f"новая версия, часть {i}" for i in range(4)])
+        await asyncio.sleep(0.05)
+        return await in_flight
+
+    try:
+        message = asyncio.run(run())
+    finally:
+        server.shutdown()
+    assert "старая версия" in message and "новая версия" not in message
+    time.sleep(0.02)
+    kb = search_ask.get_knowledge_base()
+    assert len(kb) == 4 and kb.texts[0] == "новая версия, часть 0"
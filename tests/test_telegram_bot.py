@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import telegram_bot
+
+
+class FakeMessage:
+    """Сообщение чата: answer() добавляет новое, edit_text() меняет текст этого."""
+
+    def __init__(self, chat: list, text: str = ""):
+        self.chat = chat
+        self.text = text
+
+    async def answer(self, text: str, **kwargs):
+        reply = FakeMessage(self.chat, text)
+        self.chat.append(reply)
+        return reply
+
+    async def edit_text(self, text: str, **kwargs):
+        self.text = text
+        return self
+
+
+def ask_in_chat(monkeypatch, stream) -> list[str]:
+    monkeypatch.setattr(telegram_bot, "STREAM_ANSWERS", True)
+    monkeypatch.setattr(telegram_bot, "ask_on_ozon_api_stream", lambda question: stream())
+    chat = []
+    asyncio.run(telegram_bot.answer_question(FakeMessage(chat), "вопрос"))
+    return [message.text for message in chat]
+
+
+def test_error_replaces_partial_answer(monkeypatch):
+    async def stream():
+        yield "Начало ответа"
+        raise RuntimeError("сбой")
+
+    assert ask_in_chat(monkeypatch, stream) == ["Произошла ошибка: сбой"]
+
+
+def test_timeout_replaces_placeholder(monkeypatch):
+    async def stream():
+        raise asyncio.TimeoutError
+        yield
+
+    assert ask_in_chat(monkeypatch, stream) == [telegram_bot.TIMEOUT_ANSWER]
+
+
+def test_empty_stream_replaces_placeholder(monkeypatch):
+    async def stream():
+        return
+        yield
+
+    assert ask_in_chat(monkeypatch, stream) == [telegram_bot.EMPTY_ANSWER]
+
+
+def test_overflow_message_waits_for_retry_after(monkeypatch):
+    from aiogram.exceptions import TelegramRetryAfter
+    from aiogram.methods import SendMessage
+
+    class FloodMessage(FakeMessage):
+        failures = 1
+
+        async def answer(self, text: str, **kwargs):
+            if FloodMessage.failures:
+                FloodMessage.failures -= 1
+                raise TelegramRetryAfter(SendMessage(chat_id=1, text=text), "Flood control", retry_after=0)
+            reply = FloodMessage(self.chat, text)
+            self.chat.append(reply)
+            return reply
+
+    chat = []
+    streamer = telegram_bot.MessageStreamer(FloodMessage(chat, telegram_bot.PLACEHOLDER), limit=10)
+    chat.append(streamer.message)
+
+    async def run():
+        await streamer.feed("первая строка\nвторая")
+        await streamer.flush()
+
+    asyncio.run(run())
+    assert [message.text for message in chat] == ["первая", "строка", "вторая"]
+
+
+def test_telegram_calls_are_their_own_stage(monkeypatch):
+    from metrics import trace_request
+
+    async def stream():
+        yield "Ответ"
+
+    with trace_request() as trace:
+        assert ask_in_chat(monkeypatch, stream) == ["Ответ"]
+    # Заглушка и итоговое редактирование
+    assert [stage for stage, _ in trace.spans] == ["telegram", "telegram"]
@@ -0,0 +1,15 @@
+import functools
+import tiktoken  # для подсчета токенов
+
+DEFAULT_MODEL = "gpt-3.5-turbo"  # модель определяет только кодировку
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Кодировка tiktoken для модели (создается один раз на процесс, общая для сборки базы и для запросов)"""
+    return tiktoken.encoding_for_model(model)
+
+
+def num_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Возвращает число токенов в строке для заданной модели"""
+    return len(get_encoding(model).encode(text))